@@ -0,0 +1,443 @@
+'''
+    JSON pricing endpoints on the Flask server of the app.
+
+        GET  /api/health      status of the server (does not touch pandas)
+        POST /api/premium     net single and net level premiums
+        POST /api/reserves    prospective reserve curves
+        POST /api/tables      net level premiums on several tables and blends
+        POST /api/solve       rate, term or benefit that gives a target premium
+        POST /api/valuation   reserves at a valuation date from the issue dates
+        POST /api/nonforfeiture  paid-up and extended term values, cost of the options
+        POST /api/cashflows   expected benefits and premiums of the contracts by year
+
+    The POST endpoints receive {"contracts": [...]} with any number of contracts, each one a dict
+    with the calc_premium parameters plus table, gender, rate and value (default 1). Missing
+    terms (or null) mean whole life. Contracts are grouped by (table, gender, rate), so the
+    commutations are taken from the cache once per group. Example:
+
+        {"contracts": [{"table": " AT2000", "gender": "F", "age": 30, "prod": "D",
+                        "term_benef": 10, "term_pay": 10, "rate": 0.05, "value": 1000}]}
+
+    Responses are encoded with orjson when it is installed.
+'''
+import json
+import math
+import flask
+import numpy as np
+import pandas as pd
+from batch import commutations, unique_contracts, calc_premium_batch, PREMIUM_DTYPE
+from batch import typed_contracts, invalid_integers, parse_flags, FLAG_COLUMNS
+from kernels import reserve_curves
+from results import allocate
+from calc import available_tables, comparison_tables
+from blending import calc_premium_blends_batch, mix_name, BLEND_METHODS
+from portfolio import normalize_policies
+from solvers import solve_portfolio, KINDS, UNKNOWNS
+from valuation import value_at_date, METHODS
+from nonforfeiture import nonforfeiture_values, election_costs
+from cashflows import cash_flow_bands, aggregate_bands, STREAMS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#limit of contracts per request
+MAX_CONTRACTS = 100000
+#fields of every contract (value defaults to 1), table first: /api/tables takes the tables
+#from the body
+CONTRACT_FIELDS = ['table', 'gender', 'age', 'prod']
+
+
+def clean_values(values):
+    '''
+        Converts numpy arrays and scalars to lists of floats, nan and inf to None, result arrays
+        (results.py) to dicts of their fields
+    '''
+    if isinstance(values, np.ndarray):
+        if values.dtype.names:
+            return {name: clean_values(values[name]) for name in values.dtype.names}
+        if values.dtype == bool:
+            return values.tolist()
+        values = values.astype(np.float64)
+        return np.where(np.isfinite(values), values, None).tolist()
+    if isinstance(values, (float, np.floating)):
+        return float(values) if math.isfinite(values) else None
+    if isinstance(values, dict):
+        return {key: clean_values(value) for key, value in values.items()}
+    if isinstance(values, (list, tuple)):
+        return [clean_values(value) for value in values]
+    if isinstance(values, np.integer):
+        return int(values)
+    return values
+
+
+def json_response(data, status=200):
+    '''
+        Encodes a response with orjson (or json)
+    '''
+    data = clean_values(data)
+    body = orjson.dumps(data) if orjson is not None else json.dumps(data)
+    return flask.Response(body, status=status, mimetype='application/json')
+
+
+def read_contracts(default_rate, required=CONTRACT_FIELDS):
+    '''
+        Contracts of the request body as a dataframe with the optional columns filled
+        Input:
+            default_rate: rate of the contracts without rate --> float or function
+            required: fields of every contract --> list of str
+    '''
+    body = flask.request.get_json(force=True, silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('contracts'), list):
+        raise ValueError('O corpo deve ter a lista "contracts"')
+    if len(body['contracts']) > MAX_CONTRACTS:
+        raise ValueError('Máximo de {} contratos por requisição'.format(MAX_CONTRACTS))
+
+    contracts = pd.DataFrame(body['contracts'])
+    if contracts.empty:
+        raise ValueError('Lista "contracts" vazia')
+    missing = [name for name in required if name not in contracts.columns]
+    if missing:
+        raise ValueError('Campos ausentes nos contratos: {}'.format(', '.join(missing)))
+    contracts['value'] = contracts['value'].fillna(1) if 'value' in contracts.columns else 1
+    for name in ['term_benef', 'term_pay']:
+        if name in contracts.columns:
+            contracts[name] = contracts[name].astype(np.float64)
+    if callable(default_rate):
+        default_rate = default_rate()
+    contracts = normalize_policies(contracts, default_rate, required + ['value'])
+    #raises the column and row of invalid contracts instead of truncating them
+    typed_contracts(contracts)
+    for name in FLAG_COLUMNS:
+        contracts[name] = parse_flags(contracts[name].values)[0]
+    for name in ['value', 'rate']:
+        if not np.isfinite(contracts[name].values.astype(np.float64)).all():
+            raise ValueError('{} deve ser numérico (contrato {})'.format(
+                name, int(np.flatnonzero(~np.isfinite(contracts[name].values))[0])))
+    return contracts, body
+
+
+def read_durations(body):
+    '''
+        Evaluation times "t" of the request body, None when not given
+    '''
+    durations = body.get('t')
+    if durations is None:
+        return None
+    if not isinstance(durations, list) or invalid_integers(durations).any():
+        raise ValueError('"t" deve ser uma lista de inteiros não negativos')
+    return np.asarray(durations, dtype=np.int64)
+
+
+def groups(handler, contracts):
+    '''
+        Iterates the contracts by (table, gender, rate), with the commutations of the group
+        Output:
+            iterator of (group dataframe, commutations), commutations is None for unknown tables
+    '''
+    for (table, gender, rate), group in contracts.groupby(['table', 'gender', 'rate'],
+                                                          sort=False):
+        try:
+            handler.select_table(table, gender)
+            if handler.df_.empty:
+                raise Exception('Tábua {} {} não encontrada'.format(table, gender))
+        except Exception:
+            yield group, None
+            continue
+        handler.gen_commutations(rate)
+        yield group, commutations(handler)
+
+
+def calc_premiums(handler, contracts):
+    '''
+        Premiums of the contracts, in the order of the request
+    '''
+    size = len(contracts)
+    result = allocate(PREMIUM_DTYPE, size)
+    position = np.arange(size)
+    contracts = contracts.assign(position=position)
+    for group, comm in groups(handler, contracts):
+        if comm is None:
+            continue
+        unit, inverse = unique_contracts(group)
+        premium = calc_premium_batch(comm, unit)
+        rows = group['position'].values
+        value = group['value'].values
+        for name in ['pup', 'pna']:
+            result[name][rows] = premium[name][inverse]*value
+        result['anui'][rows] = premium['anui'][inverse]
+        result['valid'][rows] = premium['valid'][inverse]
+    return result
+
+
+def read_blends(body):
+    '''
+        Blends of the body field "blends", each one {"name", "method", "mix": [{"table",
+        "gender", "weight"}]}, name and method (lx or qx, default lx) are optional
+        Output:
+            list of (name, mix, method)
+    '''
+    blends = body.get('blends') or []
+    if not isinstance(blends, list):
+        raise ValueError('"blends" deve ser uma lista')
+    result = []
+    for blend in blends:
+        try:
+            mix = [(item['table'], item['gender'], item['weight']) for item in blend['mix']]
+        except (TypeError, KeyError):
+            raise ValueError('Cada combinação deve ter a lista "mix" com table, gender e weight')
+        method = blend.get('method') or 'lx'
+        if method not in BLEND_METHODS:
+            raise ValueError('"method" deve ser um de {}'.format(BLEND_METHODS))
+        result.append((blend.get('name') or mix_name(mix), mix, method))
+    return result
+
+
+def calc_blend_premiums(handler, contracts, blends):
+    '''
+        Net level premiums of the contracts on the blends, in the order of the request
+        Output:
+            dict blend name --> np.array
+    '''
+    result = {name: np.full(len(contracts), np.nan) for name, mix, method in blends}
+    contracts = contracts.assign(position=np.arange(len(contracts)))
+    for rate, group in contracts.groupby('rate', sort=False):
+        unit, inverse = unique_contracts(group)
+        rows = group['position'].values
+        value = group['value'].values
+        for method in dict.fromkeys(method for name, mix, method in blends):
+            names = [name for name, mix, method_ in blends if method_ == method]
+            mixes = [mix for name, mix, method_ in blends if method_ == method]
+            pna = calc_premium_blends_batch(handler, unit, mixes, rate, method)['pna']
+            for b, name in enumerate(names):
+                result[name][rows] = pna[inverse, b]*value
+    return result
+
+
+def register_api(server, handler_factory, default_rate):
+    '''
+        Registers the endpoints on a Flask server
+        Input:
+            server: Flask app
+            handler_factory: function returning a new InsuranceHandler (one per request)
+            default_rate: rate of the contracts without rate, or a function returning it (the
+                          current rate of reloaded data) --> float or function
+    '''
+    @server.route('/api/health')
+    def api_health():
+        return json_response({'status': 'ok'})
+
+    @server.route('/api/premium', methods=['POST'])
+    def api_premium():
+        try:
+            contracts, body = read_contracts(default_rate)
+        except Exception as e:
+            return json_response({'error': str(e)}, 400)
+        return json_response(calc_premiums(handler_factory(), contracts))
+
+    @server.route('/api/reserves', methods=['POST'])
+    def api_reserves():
+        '''
+            Optional body field "t": list of evaluation times, default 0 to the end of the
+            table of each contract
+        '''
+        try:
+            contracts, body = read_contracts(default_rate)
+            t = read_durations(body)
+        except Exception as e:
+            return json_response({'error': str(e)}, 400)
+
+        size = len(contracts)
+        pna = np.full(size, np.nan)
+        curves = [None]*size
+        contracts = contracts.assign(position=np.arange(size))
+        for group, comm in groups(handler_factory(), contracts):
+            if comm is None:
+                continue
+            durations = np.arange(0, comm[-1] + 1) if t is None else t
+            rows = group['position'].values
+            value = group['value'].values
+            unit, inverse = unique_contracts(group)
+            premium = calc_premium_batch(comm, unit)
+            reserves, valid = reserve_curves(comm, unit, premium['pna'], durations)
+            reserves = np.where(valid & premium['valid'][:, None], reserves, np.nan)
+            reserves = reserves[inverse]*value[:, None]
+            pna[rows] = premium['pna'][inverse]*value
+            for row, curve in zip(rows, reserves):
+                curves[row] = curve
+        return json_response({'pna': pna, 'reserves': curves})
+
+    @server.route('/api/tables', methods=['POST'])
+    def api_tables():
+        '''
+            Optional body fields "tables": list of tables, default the tables of the
+            comparison chart in the data, and "blends": blended tables (see read_blends),
+            priced on all the blends in one pass. The contracts do not need "table", and
+            tables that are not in the data are answered with status 400
+        '''
+        try:
+            contracts, body = read_contracts(default_rate, CONTRACT_FIELDS[1:])
+            blends = read_blends(body)
+        except Exception as e:
+            return json_response({'error': str(e)}, 400)
+
+        handler = handler_factory()
+        tables = body.get('tables')
+        if tables is None or tables == []:
+            tables = comparison_tables(handler)
+        elif not isinstance(tables, list) or not all(isinstance(tb, str) for tb in tables):
+            return json_response({'error': '"tables" deve ser uma lista de nomes de tábuas'},
+                                 400)
+        unknown = [tb for tb in tables if tb not in available_tables(handler)]
+        if unknown:
+            return json_response({'error': 'Tábuas não encontradas: {}'.format(
+                ', '.join(unknown))}, 400)
+        result = {}
+        for table in tables:
+            result[table] = calc_premiums(handler, contracts.assign(table=table))['pna']
+        response = {'tables': tables, 'pna': result}
+        if blends:
+            try:
+                response['blends'] = calc_blend_premiums(handler, contracts, blends)
+            except Exception as e:
+                return json_response({'error': str(e)}, 400)
+        return json_response(response)
+
+    @server.route('/api/solve', methods=['POST'])
+    def api_solve():
+        '''
+            Body fields "unknown" (rate, term or benefit), "kind" (pna or pup, default pna) and
+            "columns" (term columns changed by the term solver, default ["term_benef"]). Each
+            contract has a "target" premium for its value, or the premium paid when solving
+            the benefit.
+        '''
+        try:
+            contracts, body = read_contracts(default_rate)
+            unknown = body.get('unknown')
+            kind = body.get('kind', 'pna')
+            if unknown not in UNKNOWNS or kind not in KINDS:
+                raise ValueError('"unknown" deve ser um de {} e "kind" um de {}'.format(UNKNOWNS,
+                                                                                      KINDS))
+            if 'target' not in contracts.columns:
+                raise ValueError('Contratos sem "target"')
+        except Exception as e:
+            return json_response({'error': str(e)}, 400)
+
+        kwargs = {}
+        if unknown == 'term':
+            kwargs['columns'] = tuple(body.get('columns') or ['term_benef'])
+        result = solve_portfolio(handler_factory(), contracts.reset_index(drop=True), unknown,
+                                 kind, **kwargs)
+        return json_response({name: result[name].values for name in result.columns})
+
+    @server.route('/api/valuation', methods=['POST'])
+    def api_valuation():
+        '''
+            Body fields "valuation_date" and "method" (linear or unearned, default linear), each
+            contract has an "issue_date"
+        '''
+        try:
+            contracts, body = read_contracts(default_rate)
+            method = body.get('method', 'linear')
+            if method not in METHODS:
+                raise ValueError('"method" deve ser um de {}'.format(METHODS))
+            if 'issue_date' not in contracts.columns or not body.get('valuation_date'):
+                raise ValueError('Informe "valuation_date" e o "issue_date" dos contratos')
+            valuation_date = pd.Timestamp(body['valuation_date'])
+            #missing or invalid issue dates are reported as invalid policies
+            contracts['issue_date'] = pd.to_datetime(contracts['issue_date'], errors='coerce')
+        except Exception as e:
+            return json_response({'error': str(e)}, 400)
+
+        result = value_at_date(handler_factory(), contracts.reset_index(drop=True),
+                               valuation_date, method)
+        return json_response({name: result[name].values for name in result.columns})
+
+    @server.route('/api/nonforfeiture', methods=['POST'])
+    def api_nonforfeiture():
+        '''
+            Optional body fields "t": list of evaluation times, default 0 to the end of the
+            table of each contract, and "paidup_rate" and "extended_rate": election rates (a
+            rate or a rate per duration from 0), which add the expected cost of the options
+            over all the durations ("cost"), the reserve released by the elections ("released")
+            and the difference ("excess")
+        '''
+        try:
+            contracts, body = read_contracts(default_rate)
+            t = read_durations(body)
+            rates = [body.get(name) for name in ['paidup_rate', 'extended_rate']]
+            if any(rate is not None for rate in rates):
+                rates = [np.asarray(rate or 0., dtype=np.float64) for rate in rates]
+                if any(rate.ndim > 1 or (rate < 0).any() for rate in rates):
+                    raise ValueError('As taxas de opção devem ser positivas')
+            else:
+                rates = None
+        except Exception as e:
+            return json_response({'error': str(e)}, 400)
+
+        size = len(contracts)
+        names = ['reserve', 'paidup', 'extended_term', 'extended_value']
+        curves = {name: [None]*size for name in names}
+        costs = {name: np.full(size, np.nan) for name in ['cost', 'released', 'excess']}
+        contracts = contracts.assign(position=np.arange(size))
+        handler = handler_factory()
+        for group, comm in groups(handler, contracts):
+            if comm is None:
+                continue
+            durations = np.arange(0, comm[-1] + 1) if t is None else t
+            rows = group['position'].values
+            value = group['value'].values[:, None]
+            premium = calc_premium_batch(comm, group)
+            values = nonforfeiture_values(comm, group, premium['pna'], durations)
+            valid = values['valid'] & premium['valid'][:, None]
+            for name, scale in [('reserve', value), ('paidup', 1.), ('extended_term', 1.),
+                                ('extended_value', value)]:
+                for row, curve in zip(rows, np.where(valid, values[name]*scale, np.nan)):
+                    curves[name][row] = curve
+            if rates is not None:
+                result = election_costs(handler, group, rates[0], rates[1])
+                for name, key in [('cost', 'cost'), ('released', 'reserve'),
+                                  ('excess', 'excess')]:
+                    costs[name][rows] = result[key]
+        response = dict(curves)
+        if rates is not None:
+            response.update(costs)
+        return json_response(response)
+
+    @server.route('/api/cashflows', methods=['POST'])
+    def api_cashflows():
+        '''
+            Expected cash flows of all the contracts by payment time from issue (see
+            cashflows.py), "benefits", "premiums" and "net" (benefits - premiums). Contracts may
+            have a "premium" for their value, default the net level premium
+        '''
+        try:
+            contracts, body = read_contracts(default_rate)
+        except Exception as e:
+            return json_response({'error': str(e)}, 400)
+
+        totals = {stream: [] for stream in STREAMS}
+        invalid = 0
+        handler = handler_factory()
+        for group, comm in groups(handler, contracts):
+            if comm is None:
+                invalid += len(group)
+                continue
+            premium = calc_premium_batch(comm, group)
+            invalid += int((~premium['valid']).sum())
+            premiums = None
+            if 'premium' in group.columns:
+                premiums = group['premium'].astype(np.float64).values
+                premiums = np.where(np.isnan(premiums), premium['pna']*group['value'].values,
+                                    premiums)
+            bands = cash_flow_bands(handler, group, premiums)
+            for stream in STREAMS:
+                totals[stream].append(aggregate_bands(bands[stream]))
+        horizon = max([len(total) for stream in STREAMS for total in totals[stream]], default=0)
+        totals = {stream: sum((np.pad(total, (0, horizon - len(total)))
+                               for total in totals[stream]), np.zeros(horizon))
+                  for stream in STREAMS}
+        return json_response({'t': np.arange(horizon), 'benefits': totals['benefits'],
+                              'premiums': totals['premiums'],
+                              'net': totals['benefits'] - totals['premiums'], 'invalid': invalid})
@@ -1,22 +1,40 @@
 # Import required libraries
+import os
+import hashlib
 import pickle
+import hmac
 import copy
 import pathlib
 import dash
 import math
+import logging
+import threading
 import datetime as dt
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
+import flask
 from dash.dependencies import Input, Output
 from dash.dependencies import State, ClientsideFunction
 import dash_core_components as dcc
 import dash_html_components as html
-from calc import InsuranceHandler
 from calc import real_br_money_mask
+from calc import FIGURE_DIGITS
 from calc import generate_main_plot
 from calc import generate_reserves_plot
+from calc import generate_reserves_heatmap
+from calc import calc_reserve_surface
 from calc import generate_tables_plot
+from storage import CommutationCache
+from registry import DataRegistry
+from tiles import SurfaceTiles, TILES_PATH
+from jobs import JobQueue, job_key, DONE, ERROR
+from portfolio import value_portfolio, decode_upload, RESULTS_PATH
+from calc import generate_portfolio_plot
+from api import register_api
+from profiling import RequestProfiler
+from validity import age_limits, duration_limits
 
 # Multi-dropdown options
 from controls import PRODUCTS, DEF_PRODUCT, GENDER, DEF_GENDER
@@ -34,22 +52,49 @@ class DashCallbackVariables:
 PATH = pathlib.Path(__file__).parent
 DATA_PATH = PATH.joinpath("data").resolve()
 
-df = pd.read_excel(DATA_PATH.joinpath("life_tables.xlsx"))
-df_interest = pd.read_excel(DATA_PATH.joinpath("risk_free.xlsx"))
+#optional compact storage of the life tables (built with "python storage.py"), shared by the
+#workers through a memory map instead of one dataframe per worker
+TABLE_STORE = os.environ.get("TABLE_STORE")
+#optional table sources (csv, parquet, xml, SQLite files or directories, separated by the
+#path separator), read and validated on the first use of each table (see loaders.py)
+TABLE_SOURCES = os.environ.get("TABLE_SOURCES")
+#seconds between the checks of the data files, changed files are reloaded without restarting
+#the workers (see registry.py), 0 disables the watcher
+RELOAD_INTERVAL = float(os.environ.get("RELOAD_INTERVAL", 0))
+#token of the reload endpoint, the endpoint is disabled without it
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+#directory of the profiles of the calculations asked with the header X-Profile or the parameter
+#?profile=1 (see profiling.py), profiling is disabled without it
+PROFILE_PATH = os.environ.get("PROFILE_PATH")
+#value required on the header or parameter of the profiles, any value without it
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
 
-handler = InsuranceHandler(df)
+#life tables and rates, callbacks take the current snapshot when they start
+registry = DataRegistry(TABLE_STORE, TABLE_SOURCES.split(os.pathsep) if TABLE_SOURCES else None,
+                        DATA_PATH)
+
+handler = registry.snapshot.handler(cache=CommutationCache())
+
+#precomputed main plot surfaces (built with "python tiles.py")
+tiles = SurfaceTiles(TILES_PATH) if TILES_PATH.exists() else None
+
+#heavy calculations run in background threads, polled by the browser
+job_queue = JobQueue()
 callbacks_vars = DashCallbackVariables()
 
 app = dash.Dash(
     __name__, meta_tags=[{"name": "viewport",
-                          "content": "width=device-width"}]
+                          "content": "width=device-width"}],
+    #gzip responses (flask-compress)
+    compress=True
 )
 server = app.server
 
+profiler = RequestProfiler(PROFILE_PATH, PROFILE_TOKEN)
+profiler.register(server)
+
 # Create controls
-DEF_INTEREST_RATE = df_interest[df_interest['month'] \
-                                == df_interest['month'].\
-                                max()]['selic_year'].values[0]/100
+DEF_INTEREST_RATE = registry.snapshot.rate
 
 callbacks_vars.i_rate_reserve =  DEF_INTEREST_RATE
 
@@ -62,13 +107,28 @@ reserve_chart = go.Figure(layout = go.Layout(
         plot_bgcolor='rgba(0,0,0,0)'
         ))
 
+reserve_heatmap = go.Figure(layout = go.Layout(
+        title= "Reservas por taxa de juros",
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)'
+        ))
+
+#reserve surfaces (rates x durations) of unit benefit by (table hash, contract), the most
+#recent ones
+reserve_surfaces = OrderedDict()
+MAX_RESERVE_SURFACES = 64
+#the surfaces are changed by the callbacks and by the reload listener (discard_stale)
+reserve_surfaces_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
 table_chart = go.Figure(layout = go.Layout(
         title= "Comparação de Tábuas",
         paper_bgcolor='rgba(0,0,0,0)',
         plot_bgcolor='rgba(0,0,0,0)'
         ))
 
-tables = list(df['table'].unique())
+tables = registry.snapshot.tables
 table_options = [{'value':tb, 'label':tb} for i, tb in enumerate(tables)]
 DEF_TABLE = ' AT2000'
 
@@ -103,9 +163,14 @@ layout = dict(
 )
 
 # Create app layout
-app.layout = html.Div(
+app_layout = html.Div(
     [
         dcc.Store(id="aggregate_data"),
+        #inputs of the figures the browser has, so unchanged figures are not sent again
+        dcc.Store(id="figure_keys"),
+        #background job calculating the surface and the tables comparison
+        dcc.Store(id="figure_job"),
+        dcc.Interval(id="job_interval", interval=500, disabled=True),
         # empty Div to trigger javascript file for graph resizing
         html.Div(id="output-clientside"),
         html.Div(
@@ -159,6 +224,7 @@ app.layout = html.Div(
                             id = 'calc_button',
                             type='submit',
                         ),
+                        html.P(id="job_status", className="control_label"),
                         html.P(
                             "Produto:",
                             className="control_label",
@@ -469,24 +535,111 @@ app.layout = html.Div(
             ],
             className="row flex-display",
         ),
+        html.Div(
+            [
+                html.Div(
+                    [dcc.Graph(id="reserve_heatmap")],
+                    className="pretty_container twelve columns",
+                ),
+            ],
+            className="row flex-display",
+        ),
+        #portfolio valuation
+        dcc.Store(id="portfolio_job"),
+        dcc.Interval(id="portfolio_interval", interval=1000, disabled=True),
+        html.Div(
+            [
+                html.Div(
+                    [
+                        html.P("Carteira",
+                               className="section-title"),
+                        dcc.Upload(
+                            id="portfolio_upload",
+                            children=html.Div(
+                                ["Arraste ou ", html.A("selecione"),
+                                 " o arquivo de apólices (csv ou xlsx)"]
+                            ),
+                            className="dcc_control",
+                            style={"borderWidth": "1px",
+                                   "borderStyle": "dashed",
+                                   "borderRadius": "5px",
+                                   "textAlign": "center",
+                                   "padding": "20px"},
+                        ),
+                        html.P(id="portfolio_status", className="control_label"),
+                        html.A("Baixar resultado",
+                               id="portfolio_download",
+                               href="",
+                               style={"display": "none"}),
+                    ],
+                    className="pretty_container four columns",
+                ),
+                html.Div(
+                    [dcc.Graph(id="portfolio_graph")],
+                    className="pretty_container eight columns",
+                ),
+            ],
+            className="row flex-display",
+        ),
     ],
     id="mainContainer",
     style={"display": "flex", "flex-direction": "column"},
 )
 
+def serve_layout():
+    '''
+        Layout of each page load, with the tables and the default rate of the current data
+    '''
+    snapshot = registry.snapshot
+    if snapshot.generation == 0:
+        return app_layout
+    layout_ = copy.deepcopy(app_layout)
+    layout_["table_selector"].options = [{'value':tb, 'label':tb} for tb in snapshot.tables]
+    layout_["interest-rate-input"].value = snapshot.rate
+    return layout_
+
+app.layout = serve_layout
+
 @app.callback(
     [
-        Output("age-input", "max")
+        Output("age-input", "max"),
+        Output("reserv-input", "max")
     ],
     [
         Input("gender_selector", "value"),
-        Input("table_selector", "value")
+        Input("table_selector", "value"),
+        Input("product_selector", "value"),
+        Input("age-input", "value"),
+        Input("term-input", "value"),
+        Input("dif-input", "value"),
+        Input("antecip_selector", "value"),
+        Input("whole_life_selector", "value"),
+        Input("term-p-input", "value"),
+        Input("dif-p-input", "value"),
+        Input("antecip_p_selector", "value"),
+        Input("whole_p_life_selector", "value")
     ]
 )
-def filter_dataframe(gender, table):
-    max_age = df.query('gender == "{}" and table == "{}"'. \
-                       format(gender, table))['age'].max()
-    return [max_age]
+def filter_dataframe(gender, table, prod, age, term_bnf, dif_bnf, postecip_bnf,
+                     whole_life_bnf, term_pay, dif_pay, postecip_pay, whole_life_pay):
+    '''
+        Limits of the age and of the reserve time of the contract on the table, from the
+        closed form validity ranges (see validity.py)
+    '''
+    max_age = int(registry.snapshot.max_age(table, gender))
+    periods = [term_bnf, dif_bnf, term_pay, dif_pay]
+    if any(value is None or value < 0 for value in periods):
+        return [max_age, 100]
+
+    contract = {'age': [age or 0], 'prod': [prod],
+                'dif_benef': [0 if prod == 'd' else dif_bnf],
+                'term_benef': [np.inf if whole_life_bnf else term_bnf],
+                'antecip_benef': [not postecip_bnf],
+                'dif_pay': [dif_pay], 'term_pay': [np.inf if whole_life_pay else term_pay],
+                'antecip_pay': [not postecip_pay]}
+    age_max = age_limits(max_age, contract)[0]
+    t_max = duration_limits(max_age, contract)[0]
+    return [int(age_max) if age_max >= 0 else max_age, int(t_max) if t_max >= 0 else 100]
 
 @app.callback(
     [
@@ -548,13 +701,14 @@ def bind_prod_value(product, product_value):
     [
         Output("pupText", "children"),
         Output("pnaText", "children"),
-        Output("count_graph", "figure"),
         Output("reservpText", "children"),
         Output("reservrText", "children"),
         Output("main_graph", "figure"),
-        Output("individual_graph", "figure"),
+        Output("reserve_heatmap", "figure"),
         Output("paidupText", "children"),
-        Output("extendedText", "children")
+        Output("extendedText", "children"),
+        Output("figure_keys", "data"),
+        Output("figure_job", "data")
     ],
     [
         Input("calc_button", "n_clicks"),
@@ -574,26 +728,37 @@ def bind_prod_value(product, product_value):
         Input("whole_p_life_selector", "value"),
         Input("reserv-input", "value")
     ],
+    [
+        State("figure_keys", "data"),
+        State("figure_job", "data")
+    ]
 )
+@profiler.profiled
 def update_value_click(nclicks, prod,
                        gender, age, table, i_rate,
                        term_bnf, dif_bnf, value_bnf,
                        postecip_bnf, whole_life_bnf,
                        term_pay, dif_pay, postecip_pay,
-                       whole_life_pay, reserv_t):
+                       whole_life_pay, reserv_t, client_keys, client_job):
 
-    global main_fig
     global handler
     global reserve_chart
-    global table_chart
+    global reserve_heatmap
 
     antecip_bnf = True
     antecip_pay = True
+    #inputs of the figures the browser has and the job of its figures, kept per client in the
+    #figure_keys and figure_job stores
+    client_keys = client_keys or {}
+    figure_keys = dict(client_keys)
+    figure_job = dash.no_update
 
     if nclicks is None:
         nclicks = 0
 
     if nclicks != callbacks_vars.n_clicks[1]:
+        #the handler keeps the snapshot until the next calculation
+        handler = registry.snapshot.handler(cache=handler.cache)
         handler.select_table(table, gender)
         handler.gen_commutations(i_rate)
 
@@ -612,6 +777,11 @@ def update_value_click(nclicks, prod,
         if prod == 'd':
             dif_bnf = 0
 
+        contract = [table, gender, prod, dif_bnf, term_bnf, antecip_bnf,
+                    dif_pay, term_pay, antecip_pay, value_bnf]
+        #figures of reloaded tables are sent again
+        version = [handler.table_hash, registry.snapshot.generation]
+
         try:
             handler.calc_premium(age=age,
                              dif_benef=dif_bnf,
@@ -625,17 +795,11 @@ def update_value_click(nclicks, prod,
             a = handler.calc_reserves(reserv_t, 'retrosp', i_rate)
             a = handler.calc_reserves(reserv_t, 'prosp', i_rate)
 
-            main_fig = generate_main_plot(handler_copy=handler,
-                                          dif_benef=dif_bnf,
-                                          term_benef=term_bnf,
-                                          product=prod,
-                                          antecip_benef=antecip_bnf,
-                                          value_bnf=value_bnf,
-                                          dif_pay=dif_pay,
-                                          term_pay=term_pay,
-                                          antecip_pay=antecip_pay)
-
-            table_chart = generate_tables_plot(handler_copy=handler,
+            #the surface and the tables comparison are calculated in background
+            contract_job = job_key(*contract + [age, i_rate] + version)
+            figure_job = job_queue.submit(
+                                     profiler.job(calc_figures), key=contract_job,
+                                     handler_copy=copy.copy(handler),
                                      gender=gender, age=age,
                                      i_rate=i_rate, dif_bnf=dif_bnf,
                                      term_bnf = term_bnf,
@@ -647,11 +811,33 @@ def update_value_click(nclicks, prod,
                                      value_bnf = value_bnf)
 
             reserve_chart = generate_reserves_plot(handler_copy=handler,
-                                                    value_bnf=value_bnf)
+                                                    value_bnf=value_bnf,
+                                                    digits=FIGURE_DIGITS)
+            #figures are keyed by the inputs without the value and by the value, see changed
+            shape = repr(contract[:-1] + [age, i_rate] + version)
+            figure_keys['reserves'] = [shape, value_bnf]
+
+            #the reserve surface is of unit benefit, cached by contract without the value
+            surface_key = (handler.table_hash, repr(contract[:-1] + [age, i_rate]))
+            with reserve_surfaces_lock:
+                surface = reserve_surfaces.get(surface_key)
+                if surface is not None:
+                    reserve_surfaces.move_to_end(surface_key)
+            if surface is None:
+                surface = calc_reserve_surface(handler)
+                with reserve_surfaces_lock:
+                    reserve_surfaces[surface_key] = surface
+                    while len(reserve_surfaces) > MAX_RESERVE_SURFACES:
+                        reserve_surfaces.popitem(last=False)
+            reserve_heatmap = generate_reserves_heatmap(handler_copy=handler,
+                                                        value_bnf=value_bnf,
+                                                        digits=FIGURE_DIGITS,
+                                                        surface=surface)
+            figure_keys['reserve_heatmap'] = [shape, value_bnf]
 
 
-        except:
-            pass
+        except Exception as e:
+            logger.exception('Calculation of %s failed: %s', contract, e)
 
         callbacks_vars.update_n_clicks(nclicks, 1)
 
@@ -668,10 +854,208 @@ def update_value_click(nclicks, prod,
     if len(s2) > 1:
         s2 = [str(s2[0]) + "/" + str(real_br_money_mask(s2[1]*value_bnf))]
 
+    #figures the browser already has are not sent again, and when only the value changed the
+    #browser gets a Patch with the values of the traces (field y or z), a zero value changes
+    #the durations shown
+    def changed(name, fig, field):
+        client = client_keys.get(name)
+        if client is None:
+            return fig
+        if client == figure_keys[name]:
+            return dash.no_update
+        if isinstance(client, list) and client[0] == figure_keys[name][0] and \
+                client[1] and figure_keys[name][1]:
+            return value_patch(fig, field)
+        return fig
+    if figure_job == client_job:
+        figure_job = dash.no_update
+
     return [[real_br_money_mask(v1)], [real_br_money_mask(v2)],
-             main_fig, [real_br_money_mask(r1)],
-             [real_br_money_mask(r2)], reserve_chart, table_chart,
-             [real_br_money_mask(s1)], s2]
+             [real_br_money_mask(r1)],
+             [real_br_money_mask(r2)], changed('reserves', reserve_chart, 'y'),
+             changed('reserve_heatmap', reserve_heatmap, 'z'),
+             [real_br_money_mask(s1)], s2, figure_keys, figure_job]
+
+def value_patch(fig, field):
+    '''
+        Partial update of a figure the browser has: the field (y or z) of each trace, the
+        values that change with the benefit value
+    '''
+    patch = dash.Patch()
+    for i, trace in enumerate(fig.data):
+        patch['data'][i][field] = trace[field]
+    return patch
+
+def calc_figures(handler_copy, gender, age, i_rate, dif_bnf, term_bnf, antecip_bnf,
+                 prod, dif_pay, term_pay, antecip_pay, value_bnf, progress=None):
+    '''
+        Background job with the main surface and the tables comparison
+        Output:
+            (main figure, tables figure)
+    '''
+    main = generate_main_plot(handler_copy=handler_copy,
+                              dif_benef=dif_bnf,
+                              term_benef=term_bnf,
+                              product=prod,
+                              antecip_benef=antecip_bnf,
+                              value_bnf=value_bnf,
+                              dif_pay=dif_pay,
+                              term_pay=term_pay,
+                              antecip_pay=antecip_pay,
+                              tiles=tiles,
+                              digits=FIGURE_DIGITS,
+                              progress=(lambda p: progress(0.8*p)) if progress else None)
+
+    tables = generate_tables_plot(handler_copy=handler_copy,
+                                  age=age,
+                                  i_rate=i_rate, dif_bnf=dif_bnf,
+                                  term_bnf = term_bnf,
+                                  antecip_bnf = antecip_bnf,
+                                  prod = prod,
+                                  dif_pay = dif_pay,
+                                  term_pay = term_pay,
+                                  antecip_pay = antecip_pay,
+                                  value_bnf = value_bnf,
+                                  digits=FIGURE_DIGITS)
+    return main, tables
+
+@app.callback(
+    [
+        Output("count_graph", "figure"),
+        Output("individual_graph", "figure"),
+        Output("job_interval", "disabled"),
+        Output("job_status", "children")
+    ],
+    [
+        Input("figure_job", "data"),
+        Input("job_interval", "n_intervals")
+    ]
+)
+def poll_figure_job(job_id, n_intervals):
+    '''
+        Polls the background job of the figures, the interval is enabled while it runs
+    '''
+    if job_id is None:
+        return [main_fig, table_chart, True, ""]
+
+    status = job_queue.status(job_id)
+    if status['state'] == DONE:
+        main, tables = job_queue.result(job_id)
+        return [main, tables, True, ""]
+    if status['state'] == ERROR or status['state'] is None:
+        return [dash.no_update, dash.no_update, True, status['error']]
+
+    return [dash.no_update, dash.no_update, False,
+            "Calculando... {:.0%}".format(status['progress'])]
+
+@app.callback(
+    [
+        Output("portfolio_job", "data")
+    ],
+    [
+        Input("portfolio_upload", "contents")
+    ],
+    [
+        State("portfolio_upload", "filename"),
+        State("interest-rate-input", "value")
+    ]
+)
+def upload_portfolio(contents, filename, i_rate):
+    '''
+        Submits the valuation of an uploaded policy file
+    '''
+    if contents is None:
+        return [None]
+
+    content = decode_upload(contents)
+    snapshot = registry.snapshot
+    file_key = job_key(hashlib.sha1(content).hexdigest(), filename, i_rate, snapshot.generation)
+    handler_ = snapshot.handler(cache=handler.cache)
+    job_id = job_queue.submit(value_portfolio, key=file_key,
+                              handler=handler_, content=content,
+                              filename=filename, rate=i_rate,
+                              out_path=RESULTS_PATH.joinpath(file_key + ".csv"))
+    return [{"id": job_id, "file": file_key}]
+
+@app.callback(
+    [
+        Output("portfolio_interval", "disabled"),
+        Output("portfolio_status", "children"),
+        Output("portfolio_download", "href"),
+        Output("portfolio_download", "style"),
+        Output("portfolio_graph", "figure")
+    ],
+    [
+        Input("portfolio_job", "data"),
+        Input("portfolio_interval", "n_intervals")
+    ]
+)
+def poll_portfolio_job(job, n_intervals):
+    '''
+        Polls the portfolio valuation, the interval is enabled while it runs
+    '''
+    hidden = {"display": "none"}
+    if job is None:
+        return [True, "", "", hidden, generate_portfolio_plot(None)]
+
+    status = job_queue.status(job["id"])
+    if status['state'] == DONE:
+        result = job_queue.result(job["id"])
+        text = "{} apólices avaliadas, {} inválidas".format(result['policies'],
+                                                          result['invalid'])
+        return [True, text, "/portfolio/{}.csv".format(job["file"]), {},
+                generate_portfolio_plot(result['summary'])]
+    if status['state'] == ERROR or status['state'] is None:
+        return [True, status['error'], "", hidden, dash.no_update]
+
+    return [False, "Avaliando... {:.0%}".format(status['progress']), "", hidden,
+            dash.no_update]
+
+@server.route("/portfolio/<file_key>.csv")
+def download_portfolio(file_key):
+    '''
+        Downloads the result of a portfolio valuation
+    '''
+    path = RESULTS_PATH.joinpath(file_key + ".csv")
+    if not file_key.isalnum() or not path.exists():
+        flask.abort(404)
+    response = flask.send_file(str(path), mimetype="text/csv")
+    response.headers["Content-Disposition"] = "attachment; filename=carteira.csv"
+    return response
+
+#JSON endpoints (see api.py), one handler per request sharing the commutations cache
+register_api(server, lambda: registry.snapshot.handler(cache=handler.cache),
+             lambda: registry.snapshot.rate)
+
+def discard_stale(stale):
+    '''
+        Drops the cached values of the tables changed by a reload
+    '''
+    handler.cache.discard(stale)
+    with reserve_surfaces_lock:
+        for key in [key for key in reserve_surfaces if key[0] in stale]:
+            del reserve_surfaces[key]
+
+registry.add_listener(discard_stale)
+if RELOAD_INTERVAL > 0:
+    registry.watch(RELOAD_INTERVAL)
+
+@server.route("/admin/reload", methods=["POST"])
+def reload_data():
+    '''
+        Reloads the changed data files, with the header X-Admin-Token
+    '''
+    token = flask.request.headers.get("X-Admin-Token", "")
+    #bytes, compare_digest rejects non-ASCII str
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        flask.abort(404)
+    try:
+        stale = registry.reload()
+    except Exception as e:
+        return flask.jsonify({"error": str(e)}), 400
+    snapshot = registry.snapshot
+    return flask.jsonify({"generation": snapshot.generation, "reloaded": stale is not None,
+                          "changed_tables": len(stale or ()), "tables": len(snapshot.tables)})
 
 # Main
 if __name__ == "__main__":
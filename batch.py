@@ -0,0 +1,790 @@
+'''
+    Vectorized version of the InsuranceHandler formulas.
+
+    The functions price whole batches of contracts with numpy arrays instead of one scalar call
+    per contract. Contracts are given as columns (a pandas dataframe or a dict of arrays) with
+    the same names as the calc_premium parameters:
+        age, dif_benef, term_benef, antecip_benef, prod, dif_pay, term_pay, antecip_pay
+    term_benef and term_pay use np.inf for whole life. Combinations rejected by the scalar
+    engine (__verify_prod__ or indexes out of the table) come back as nan with valid = False.
+
+    typed_contracts converts the columns once to a structured array with integer periods and
+    whole life flags (CONTRACT_DTYPE), checking the values, and valid_contracts finds the
+    invalid combinations of a batch with a vectorized mask. Typed arrays are accepted wherever
+    contract columns are. contract_errors gives the rows typed_contracts rejects, so bulk inputs
+    (portfolio files, the JSON API) report them instead of truncating fractional values or
+    reading any text as a true flag (parse_flags).
+
+    Large books have many policies with the same shape (age and contract columns) that differ
+    only on the benefit value. unique_contracts finds the shapes, so they are priced once at
+    unit benefit and the results are scattered back to the policies scaled by their values.
+
+    For select tables (selection.py) the commutations are 2-D [issue age, attained age] and each
+    contract uses the row of its issue age.
+'''
+import numpy as np
+import pandas as pd
+from results import allocate
+
+#defaults of calc_premium, used for missing columns
+CONTRACT_DEFAULTS = {'dif_benef': 0, 'term_benef': np.inf, 'antecip_benef': True,
+                     'prod': 'a', 'dif_pay': 0, 'term_pay': np.inf, 'antecip_pay': True}
+
+#contract columns that define the shape of a policy
+SHAPE_COLUMNS = ['age'] + list(CONTRACT_DEFAULTS)
+
+#typed contracts: integer periods, whole life flags instead of np.inf terms
+CONTRACT_DTYPE = np.dtype([('age', np.int64), ('dif_benef', np.int64), ('term_benef', np.int64),
+                           ('whole_benef', bool), ('antecip_benef', bool), ('prod', '<U1'),
+                           ('dif_pay', np.int64), ('term_pay', np.int64), ('whole_pay', bool),
+                           ('antecip_pay', bool)])
+PRODUCT_CODES = ['a', 'A', 'd', 'D']
+#result of calc_premium_batch (see results.py)
+PREMIUM_DTYPE = np.dtype([('pup', np.float64), ('anui', np.float64), ('pna', np.float64),
+                          ('valid', bool)])
+FLAG_COLUMNS = ['antecip_benef', 'antecip_pay']
+#spellings of the flags in files and requests (lower case, without spaces)
+FLAG_VALUES = {'true': True, 'verdadeiro': True, 'sim': True, '1': True, '1.0': True,
+               'false': False, 'falso': False, 'nao': False, 'não': False, '0': False,
+               '0.0': False}
+
+
+def commutations(handler):
+    '''
+        Commutations of a handler, after select_table and gen_commutations
+        Output:
+            (Dx, Nx, Cx, Mx, max_age), 2-D [issue age, attained age] for select tables
+    '''
+    if handler.select_comm is not None:
+        return tuple(handler.select_comm) + (int(handler.max_age),)
+    return handler.Dx, handler.Nx, handler.Cx, handler.Mx, int(handler.max_age)
+
+
+def select_rows(comm, age):
+    '''
+        Rows of the commutations used by contracts with the issue ages given, None when the
+        commutations are of an ultimate table
+    '''
+    return np.asarray(age).astype(np.int64) if np.ndim(comm[0]) == 2 else None
+
+
+def parse_flags(values):
+    '''
+        Flags of a contract column, from bools, 1/0 or the spellings of FLAG_VALUES
+        Input:
+            values: np.array or list
+        Output:
+            (flags, invalid): np.array of bool, invalid entries (other values) are False
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind == 'b':
+        return values, np.zeros(values.shape, dtype=bool)
+    if values.dtype.kind in 'iuf':
+        return values == 1, ~np.isin(values, [0, 1])
+    flags = np.zeros(values.shape, dtype=bool)
+    invalid = np.zeros(values.shape, dtype=bool)
+    for i, value in enumerate(values.ravel()):
+        if isinstance(value, (bool, np.bool_)):
+            flags.flat[i] = value
+        elif isinstance(value, (int, float, np.integer, np.floating)) and value in (0, 1):
+            flags.flat[i] = value == 1
+        elif isinstance(value, str) and value.strip().lower() in FLAG_VALUES:
+            flags.flat[i] = FLAG_VALUES[value.strip().lower()]
+        else:
+            invalid.flat[i] = True
+    return flags, invalid
+
+
+def contract_columns(contracts, size=None):
+    '''
+        Contract columns as numpy arrays, with the calc_premium defaults for missing columns
+        Input:
+            contracts: pandas dataframe or dict of arrays
+            size: number of contracts, default len(contracts['age'])
+        Output:
+            dict of np.array
+    '''
+    if isinstance(contracts, np.ndarray) and contracts.dtype == CONTRACT_DTYPE:
+        contracts = untyped_contracts(contracts)
+    size = len(contracts['age']) if size is None else size
+    columns = {'age': np.asarray(contracts['age'])}
+    for name, default in CONTRACT_DEFAULTS.items():
+        values = contracts[name] if name in contracts else default
+        columns[name] = np.broadcast_to(np.asarray(values), (size,))
+    columns['term_benef'] = columns['term_benef'].astype(np.float64)
+    columns['term_pay'] = columns['term_pay'].astype(np.float64)
+    for name in FLAG_COLUMNS:
+        columns[name] = parse_flags(columns[name])[0]
+    columns['prod'] = columns['prod'].astype('<U1')
+    return columns
+
+
+def unique_contracts(contracts, columns=SHAPE_COLUMNS):
+    '''
+        Unique contract shapes of a batch
+        Input:
+            contracts: contract columns (see contract_columns)
+            columns: columns compared, extra columns (e.g. t) must be in contracts
+                     --> list of str
+        Output:
+            (shapes, inverse): columns of the unique shapes (dict of np.array) and the position
+            of the shape of each contract (np.array of int), shapes[name][inverse] gives back
+            the column of the contracts
+    '''
+    c = contract_columns(contracts)
+    c.update({name: np.asarray(contracts[name]) for name in columns if name not in c})
+    #hashed key of the shape, combining the codes of one column at a time
+    key = np.zeros(len(c['age']), dtype=np.int64)
+    for name in columns:
+        codes, uniques = pd.factorize(c[name], use_na_sentinel=False)
+        key, _ = pd.factorize(key*len(uniques) + codes)
+    inverse = key
+    first = np.empty(inverse.max() + 1 if inverse.size else 0, dtype=np.int64)
+    first[inverse[::-1]] = np.arange(len(inverse))[::-1]
+    return {name: c[name][first] for name in columns}, inverse
+
+
+def commutations_for_rates(handler, rates, ages=None):
+    '''
+        Commutations of the table selected in a handler for one rate per row
+        Input:
+            handler: InsuranceHandler after select_table
+            rates: interest rates --> np.array
+            ages: issue age of each row, required for select tables --> np.array
+        Output:
+            (Dx, Nx, Cx, Mx, max_age) with (rates x ages) arrays
+    '''
+    if handler.select_lx is not None:
+        lx = handler.select_lx[np.asarray(ages).astype(np.int64)]
+        dx = handler.select_dx[np.asarray(ages).astype(np.int64)]
+    else:
+        lx = handler.df_['lx'].values.astype(np.float64)
+        dx = handler.df_['dx'].values.astype(np.float64)
+    return columns_commutations(lx, dx, handler.df_['age'].values, rates) + \
+        (int(handler.max_age),)
+
+
+def columns_commutations(lx, dx, age, rates):
+    '''
+        Commutations of life table columns, one rate per row
+        Input:
+            lx, dx: life table columns, the same for all rows or one row each --> np.array
+            age: ages of the columns --> np.array
+            rates: interest rates --> np.array
+        Output:
+            (Dx, Nx, Cx, Mx) with (rates x ages) arrays
+    '''
+    #same operations of InsuranceHandler.__pv_calc__, so the results match the scalar engine
+    rate = np.asarray(rates, dtype=np.float64)[:, None]
+    Dx = lx*(1/(1 + rate)**age)
+    Cx = dx*(1/(1 + rate)**(age + 1))
+    Nx = Dx[:, ::-1].cumsum(axis=1)[:, ::-1]
+    Mx = Cx[:, ::-1].cumsum(axis=1)[:, ::-1]
+    return Dx, Nx, Cx, Mx
+
+
+def invalid_integers(values):
+    '''
+        Entries that are not non-negative integers (missing and non-numeric entries included)
+        Input:
+            values: np.array or list
+        Output:
+            np.array of bool
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind not in 'biuf':
+        values = pd.to_numeric(pd.Series(values.ravel()), errors='coerce').values
+    values = np.asarray(values, dtype=np.float64)
+    return ~(np.isfinite(values) & (values >= 0) & (values == np.floor(values)))
+
+
+def contract_errors(contracts):
+    '''
+        Entries of contract columns rejected by typed_contracts
+        Input:
+            contracts: contract columns (see contract_columns)
+        Output:
+            dict column --> np.array of bool (invalid rows), only the columns with errors
+    '''
+    if isinstance(contracts, np.ndarray) and contracts.dtype == CONTRACT_DTYPE:
+        contracts = untyped_contracts(contracts)
+    c = contract_columns(contracts)
+    errors = {}
+    for name in FLAG_COLUMNS:
+        invalid = parse_flags(contracts[name])[1] if name in contracts else None
+        if invalid is not None and invalid.any():
+            errors[name] = np.broadcast_to(invalid, (len(c['age']),))
+    for name in ['age', 'dif_benef', 'term_benef', 'dif_pay', 'term_pay']:
+        values = c[name]
+        if name.startswith('term'):
+            values = np.where(np.isposinf(values), 0, values)
+        invalid = invalid_integers(values)
+        if invalid.any():
+            errors[name] = invalid
+    invalid = ~np.isin(c['prod'], PRODUCT_CODES)
+    if invalid.any():
+        errors['prod'] = invalid
+    return errors
+
+
+def typed_contracts(contracts):
+    '''
+        Typed contracts, checked once
+        Input:
+            contracts: contract columns (see contract_columns)
+        Output:
+            np.array of CONTRACT_DTYPE
+        Raises ValueError for negative or fractional ages and periods, unknown products and
+        flags that are not true or false, with the column and the first invalid row
+    '''
+    for name, invalid in contract_errors(contracts).items():
+        if name == 'prod':
+            message = 'prod deve ser um de {}'.format(PRODUCT_CODES)
+        elif name in FLAG_COLUMNS:
+            message = '{} deve ser verdadeiro ou falso (true/false, 1/0)'.format(name)
+        else:
+            message = '{} deve ter inteiros não negativos'.format(name)
+        raise ValueError('{} (contrato {})'.format(message, int(np.flatnonzero(invalid)[0])))
+
+    c = contract_columns(contracts)
+    typed = np.zeros(len(c['age']), dtype=CONTRACT_DTYPE)
+    for side in ['benef', 'pay']:
+        term = c['term_' + side]
+        whole = np.isinf(term)
+        c['term_' + side] = np.where(whole, 0, term)
+        typed['whole_' + side] = whole
+    for name in ['age', 'dif_benef', 'term_benef', 'dif_pay', 'term_pay']:
+        typed[name] = np.asarray(c[name], dtype=np.float64)
+    for name in ['antecip_benef', 'prod', 'antecip_pay']:
+        typed[name] = c[name]
+    return typed
+
+
+def untyped_contracts(typed):
+    '''
+        Contract columns of typed contracts, np.inf for whole life terms
+    '''
+    columns = {name: typed[name] for name in SHAPE_COLUMNS}
+    columns['term_benef'] = np.where(typed['whole_benef'], np.inf, typed['term_benef'])
+    columns['term_pay'] = np.where(typed['whole_pay'], np.inf, typed['term_pay'])
+    return columns
+
+
+def pup_indexes(x, n, m, whole, antecip, prod, max_age):
+    '''
+        Indexes of the commutations used by __calc_pup__ and the mask of valid combinations
+        (__verify_prod__ and indexes inside the table)
+        Input:
+            x, n, m: age, deferral and term (0 for whole life) --> np.array of int
+            whole: whole life flags --> np.array of bool
+            antecip, prod: np.array
+            max_age: max age of the table --> int
+        Output:
+            (dict of index arrays, valid)
+    '''
+    is_a = prod == 'a'
+    add_one = np.where(antecip & is_a, 0, 1)
+    m_ = np.where(whole, max_age - x - n - add_one, m)
+
+    #__verify_prod__
+    criteria = x + n + m - (1 - add_one)
+    valid = ~((prod == 'd') & (n > 0))
+    valid &= ~(((prod == 'd') | (prod == 'D')) & whole)
+    valid &= criteria <= max_age
+
+    #indexes used by each product, out of the table the scalar engine raises IndexError
+    i = {'x': x, 'start': x + n, 'end': x + n + m_, 'd': x + m_,
+         'a_start': x + n + add_one, 'a_end': x + n + m_ + add_one}
+    used = np.where(is_a, np.maximum(i['a_start'], i['a_end']),
+                    np.where(prod == 'd', i['d'], np.maximum(i['start'], i['end'])))
+    lowest = np.where(prod == 'd', i['d'], i['start'])
+    valid &= (x >= 0) & (x <= max_age) & (used <= max_age) & (lowest >= 0)
+    valid &= np.isin(prod, PRODUCT_CODES)
+    return i, valid
+
+
+def valid_contracts(typed, max_age):
+    '''
+        Vectorized mask of the typed contracts accepted by calc_premium on a table
+        Input:
+            typed: np.array of CONTRACT_DTYPE
+            max_age: max age of the table --> int
+        Output:
+            np.array of bool
+    '''
+    _, valid_benef = pup_indexes(typed['age'], typed['dif_benef'], typed['term_benef'],
+                                 typed['whole_benef'], typed['antecip_benef'], typed['prod'],
+                                 max_age)
+    _, valid_pay = pup_indexes(typed['age'], typed['dif_pay'], typed['term_pay'],
+                               typed['whole_pay'], typed['antecip_pay'], 'a', max_age)
+    return valid_benef & valid_pay
+
+
+def calc_pup_parts_batch(comm, age, dif, term, antecip, prod, rows=None):
+    '''
+        Numerator and denominator (Dx) of the net single premiums of __calc_pup__.
+        The numerator is linear on the commutations, so applying it to the derivatives of the
+        commutations gives the derivative of the numerator.
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) as returned by commutations, the arrays may also
+                  have one row per contract (see commutations_for_rates)
+            age, dif, term, antecip, prod: arrays (or scalars) with the parameters of __calc_pup__
+            rows: row of 2-D commutations used by each contract, default one row per contract
+        Output:
+            (numerator, denominator, valid) --> (np.array, np.array, np.array of bool)
+    '''
+    Dx, Nx, Cx, Mx, max_age = comm
+    arrays = [np.asarray(age), np.asarray(dif), np.asarray(term, dtype=np.float64),
+              np.asarray(antecip, dtype=bool), np.asarray(prod)]
+    if np.ndim(Dx) == 2:
+        arrays.append(np.empty(np.shape(Dx)[0]) if rows is None else np.asarray(rows))
+    age, dif, term, antecip, prod = np.broadcast_arrays(*arrays)[:5]
+    x = age.astype(np.int64)
+    whole = np.isinf(term)
+    remove_term = np.where(whole, 0, 1)
+    i, valid = pup_indexes(x, dif.astype(np.int64), np.where(whole, 0, term).astype(np.int64),
+                           whole, antecip, prod, max_age)
+
+    if np.ndim(Dx) == 2:
+        rows = np.arange(np.shape(Dx)[0]) if rows is None else \
+            np.clip(np.broadcast_to(np.asarray(rows), x.shape), 0, np.shape(Dx)[0] - 1)
+        take = lambda values, index: values[rows, np.clip(index, 0, max_age)]
+    else:
+        take = lambda values, index: values[np.clip(index, 0, max_age)]
+
+    num = np.select([prod == 'D', prod == 'd', prod == 'A', prod == 'a'],
+                    [take(Mx, i['start']) - take(Mx, i['end']) + take(Dx, i['end']),
+                     take(Dx, i['d']),
+                     take(Mx, i['start']) - remove_term*take(Mx, i['end']),
+                     take(Nx, i['a_start']) - remove_term*take(Nx, i['a_end'])],
+                    np.nan)
+    return num, take(Dx, x), valid
+
+
+def calc_pup_batch(comm, age, dif, term, antecip, prod, rows=None):
+    '''
+        Vectorized __calc_pup__
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) as returned by commutations
+            age, dif, term, antecip, prod: arrays (or scalars) with the parameters of __calc_pup__
+            rows: issue ages of the contracts for select tables (see select_rows)
+        Output:
+            (net single premiums, valid) --> (np.array, np.array of bool)
+    '''
+    num, den, valid = calc_pup_parts_batch(comm, age, dif, term, antecip, prod, rows)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pup = num / den
+    return np.where(valid, pup, np.nan), valid
+
+
+def calc_premium_batch(comm, contracts):
+    '''
+        Vectorized calc_premium
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) as returned by commutations
+            contracts: contract columns (see contract_columns)
+        Output:
+            np.array of PREMIUM_DTYPE (fields pup, anui, pna and valid)
+    '''
+    c = contract_columns(contracts)
+    rows = select_rows(comm, c['age'])
+    pup, valid_benef = calc_pup_batch(comm, c['age'], c['dif_benef'], c['term_benef'],
+                                      c['antecip_benef'], c['prod'], rows)
+    anui, valid_pay = calc_pup_batch(comm, c['age'], c['dif_pay'], c['term_pay'],
+                                     c['antecip_pay'], 'a', rows)
+    result = allocate(PREMIUM_DTYPE, len(c['age']))
+    result['pup'] = pup
+    result['anui'] = anui
+    result['valid'] = valid_benef & valid_pay
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result['pna'] = np.where(result['valid'], pup / anui, np.nan)
+    return result
+
+
+def calc_premium_rates_batch(handler, contracts, rates):
+    '''
+        Premiums of a batch of contracts for several interest rates, in one vectorized call
+        Input:
+            handler: InsuranceHandler after select_table
+            contracts: contract columns (see contract_columns)
+            rates: interest rates --> np.array
+        Output:
+            dict with the arrays pup, anui, pna (contracts x rates) and valid (contracts)
+    '''
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    rates = np.asarray(rates, dtype=np.float64)
+    #one row of commutations per (contract, rate)
+    repeated = {name: np.repeat(values, len(rates)) for name, values in c.items()}
+    comm = commutations_for_rates(handler, np.tile(rates, size), repeated['age'])
+    pup, valid_benef = calc_pup_batch(comm, repeated['age'], repeated['dif_benef'],
+                                      repeated['term_benef'], repeated['antecip_benef'],
+                                      repeated['prod'])
+    anui, valid_pay = calc_pup_batch(comm, repeated['age'], repeated['dif_pay'],
+                                     repeated['term_pay'], repeated['antecip_pay'], 'a')
+    valid = valid_benef & valid_pay
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pna = np.where(valid, pup/anui, np.nan)
+    #the validity does not depend on the rate
+    shape = (size, len(rates))
+    return {'pup': pup.reshape(shape), 'anui': anui.reshape(shape), 'pna': pna.reshape(shape),
+            'valid': valid.reshape(shape).all(axis=1)}
+
+
+def calc_reserve_parts_batch(comm, contracts, t, rows=None):
+    '''
+        Values of the benefits (A) and of the payments (a) of __calc_prov_prosp__ at integer
+        durations
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) of the reserves rate
+            contracts: contract columns (see contract_columns)
+            t: evaluation time of each contract --> int or np.array
+            rows: row of 2-D commutations used by each contract, default the issue ages for
+                  select tables (see select_rows)
+        Output:
+            dict with the arrays A, a and valid
+    '''
+    c = contract_columns(contracts)
+    x = c['age'].astype(np.int64)
+    t = np.broadcast_to(np.asarray(t, dtype=np.int64), x.shape)
+    rows = select_rows(comm, x) if rows is None else rows
+    n = c['dif_benef'].astype(np.int64)
+    m = c['term_benef']
+    i = c['dif_pay'].astype(np.int64)
+    k = c['term_pay']
+    prod = c['prod']
+    pay_antecip = c['antecip_pay']
+    benef_antecip = c['antecip_benef']
+
+    adjust_pay = np.where(pay_antecip, 1, 0)
+    adjust_benef = np.where(benef_antecip & (prod == 'a'), 1, 0)
+
+    #payment
+    pay_dif = (0 < t) & (t <= i - adjust_pay)
+    pay_after = i - adjust_pay < t
+    a_dif, valid_a_dif = calc_pup_batch(comm, x + t, np.maximum(i - t, 0), k, pay_antecip, 'a',
+                                        rows)
+    a_after, valid_a_after = calc_pup_batch(comm, x + t, 0, np.maximum(i + k - t, 0),
+                                            pay_antecip, 'a', rows)
+    a = np.where(pay_dif, a_dif, np.where(pay_after, a_after, 0.))
+    valid = np.where(pay_dif, valid_a_dif, np.where(pay_after, valid_a_after, True))
+
+    #benefit
+    benef_dif = (0 < t) & (t <= n - adjust_benef)
+    benef_term = (n - adjust_benef < t) & (t <= n + m - adjust_benef)
+    A_dif, valid_A_dif = calc_pup_batch(comm, x + t, np.maximum(n - t, 0), m,
+                                        benef_antecip, prod, rows)
+    A_term, valid_A_term = calc_pup_batch(comm, x + t, 0, np.maximum(n + m - t, 0),
+                                          benef_antecip, prod, rows)
+    A = np.where(benef_dif, A_dif, np.where(benef_term, A_term, 0.))
+    valid &= np.where(benef_dif, valid_A_dif, np.where(benef_term, valid_A_term, True))
+
+    #adjustment for points with zero reserves
+    zero = (t == 0) | ((t < n) & (t < i)) | ((t > m + n) & (t > k + i))
+    A = np.where(zero, 0., A)
+    a = np.where(zero, 0., a)
+    return {'A': A, 'a': a, 'valid': valid}
+
+
+def calc_reserves_batch(comm, contracts, pna, t, rows=None):
+    '''
+        Vectorized prospective reserves (__calc_prov_prosp__) at integer durations
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) of the reserves rate
+            contracts: contract columns (see contract_columns)
+            pna: net level premiums of the contracts --> np.array
+            t: evaluation time of each contract --> int or np.array
+            rows: row of 2-D commutations used by each contract, default the issue ages for
+                  select tables (see select_rows)
+        Output:
+            (reserves, valid) --> (np.array, np.array of bool)
+    '''
+    parts = calc_reserve_parts_batch(comm, contracts, t, rows)
+    V = parts['A'] - pna*parts['a']
+    return np.where(parts['valid'], V, np.nan), parts['valid']
+
+
+def calc_retro_reserves_batch(comm, contracts, pna, t, rows=None):
+    '''
+        Vectorized retrospective reserves (__calc_prov_retro__) at integer durations
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) of the reserves rate
+            contracts: contract columns (see contract_columns)
+            pna: net level premiums of the contracts --> np.array
+            t: evaluation time of each contract --> int or np.array
+            rows: row of 2-D commutations used by each contract, default the issue ages for
+                  select tables (see select_rows)
+        Output:
+            (reserves, valid) --> (np.array, np.array of bool)
+    '''
+    c = contract_columns(contracts)
+    x = c['age'].astype(np.int64)
+    t = np.broadcast_to(np.asarray(t, dtype=np.int64), x.shape)
+    rows = select_rows(comm, x) if rows is None else rows
+    n = c['dif_benef'].astype(np.int64)
+    m = c['term_benef']
+    i = c['dif_pay'].astype(np.int64)
+    k = c['term_pay']
+    prod = c['prod']
+    pay_antecip = c['antecip_pay']
+    benef_antecip = c['antecip_benef']
+
+    adjust_pay = np.where(pay_antecip, 1, 0)
+    adjust_benef = np.where(benef_antecip & (prod == 'a'), 1, 0)
+
+    #present value factor
+    E, valid = calc_pup_batch(comm, x, 0, t, pay_antecip, 'd', rows)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        E = 1/E
+
+    #payments made until t
+    pay_after = i - adjust_pay < t
+    a, valid_a = calc_pup_batch(comm, x, i, np.minimum(t - i, k), pay_antecip, 'a', rows)
+    a = np.where(pay_after, a, 0.)
+    valid &= np.where(pay_after, valid_a, True)
+
+    #benefits paid until t, endowments are seen as life insurances until the end of the term
+    #and pure endowments have no benefit paid before it
+    benef_after = n - adjust_benef < t
+    no_benefit = (prod == 'd') & (t <= m)
+    prod_ = np.where((prod == 'D') & (t <= m + n), 'A', prod)
+    A, valid_A = calc_pup_batch(comm, x, n, np.minimum(t - n, m), benef_antecip, prod_, rows)
+    A = np.where(benef_after & ~no_benefit, A, 0.)
+    valid &= np.where(benef_after & ~no_benefit, valid_A, True)
+
+    #adjustment for points with zero reserves
+    zero = (t == 0) | ((t < n) & (t < i)) | ((t > m + n) & (t > k + i))
+    A = np.where(zero, 0., A)
+    a = np.where(zero, 0., a)
+
+    V = (pna*a - A)*E
+    return np.where(valid, V, np.nan), valid
+
+
+def extended_term_batch(price_comm, x, n, limit, antecip, prod, V, rows=None, chunk=8192):
+    '''
+        Term of the extended insurance of __calc_paidup__: the period from 1 to limit - 1 with
+        the net single premium closest to the reserve. Periods rejected by the engine are
+        skipped, so the term is the position among the accepted ones (0 when there is none).
+        Input:
+            price_comm: commutations of the pricing rate
+            x, n: age at the evaluation time and deferral of the search --> np.array of int
+            limit: end of the periods searched --> np.array of int
+            antecip, prod: benefit of the search --> np.array
+            V: reserves --> np.array
+            rows: rows of 2-D commutations
+            chunk: contracts searched at once, bounds the memory --> int
+        Output:
+            np.array of int
+    '''
+    size = len(x)
+    term = np.zeros(size, dtype=np.int64)
+    periods = np.arange(1, max(int(np.max(limit, initial=1)), 1))
+    if not size or not len(periods):
+        return term
+    rows = np.zeros(size, dtype=np.int64) if rows is None else np.broadcast_to(rows, (size,))
+    for start in range(0, size, chunk):
+        part = slice(start, start + chunk)
+        shape = (len(x[part]), len(periods))
+        grid = lambda values: np.repeat(values[part], len(periods))
+        values, valid = calc_pup_batch(price_comm, grid(x), grid(n), np.tile(periods, shape[0]),
+                                       grid(antecip), grid(prod), grid(rows))
+        values = values.reshape(shape)
+        valid = valid.reshape(shape) & (periods[None, :] < limit[part, None])
+        with np.errstate(invalid='ignore'):
+            distance = np.abs(V[part, None] - values)
+        #argmin of the scalar engine: the first nan, else the first minimum
+        distance = np.where(np.isinf(distance), np.finfo(np.float64).max, distance)
+        distance = np.where(np.isnan(distance), -1., distance)
+        best = np.argmin(np.where(valid, distance, np.inf), axis=1)
+        position = np.cumsum(valid, axis=1)[np.arange(shape[0]), best]
+        term[part] = np.where(valid.any(axis=1), position, 0)
+    return term
+
+
+def calc_nonforfeiture_batch(comm, contracts, pna, t, price_comm=None, rows=None):
+    '''
+        Vectorized nonforfeiture values of __calc_paidup__ at integer durations: the paid-up
+        benefit (reserve over the value of the benefits, per unit of benefit) and the extended
+        term insurance bought by the reserve (for endowments, the endowment bought when the
+        reserve is larger than the insurance of the remaining term)
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) of the reserves rate
+            contracts: contract columns (see contract_columns)
+            pna: net level premiums of the contracts --> np.array
+            t: evaluation time of each contract --> int or np.array
+            price_comm: commutations of the pricing rate, used to find the extended term,
+                        default comm
+            rows: row of 2-D commutations used by each contract
+        Output:
+            dict with the arrays paidup, extended_term, extended_value (the endowment, nan
+            for the other cases) and valid
+    '''
+    price_comm = comm if price_comm is None else price_comm
+    c = contract_columns(contracts)
+    x = c['age'].astype(np.int64)
+    t = np.broadcast_to(np.asarray(t, dtype=np.int64), x.shape)
+    rows = select_rows(comm, x) if rows is None else rows
+    n = c['dif_benef'].astype(np.int64)
+    m = c['term_benef']
+    i = c['dif_pay'].astype(np.int64)
+    k = c['term_pay']
+    prod = c['prod']
+    antecip = c['antecip_benef']
+    max_age = comm[-1]
+
+    parts = calc_reserve_parts_batch(comm, c, t, rows)
+    A = parts['A']
+    V = A - pna*parts['a']
+    #paid-up values exist while the premiums are paid (inf or nan when the benefit ended)
+    window = (i < t) & (t < k)
+    valid = parts['valid']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        paidup = np.where(window, V/A, 0.)
+
+    #endowments: insurance of the remaining term, and the endowment bought with the rest
+    endowment = window & (prod == 'D')
+    remaining_n = np.where(t <= n, np.maximum(n - t, 0), 0)
+    remaining_m = np.where(t <= n, m, m - t)
+    insurance, valid_ins = calc_pup_batch(price_comm, x + t, remaining_n, remaining_m, antecip,
+                                          'A', rows)
+    insurance = np.where(valid_ins, insurance, 0.)
+    endowment &= V >= insurance
+    pure, valid_pure = calc_pup_batch(price_comm, x + t, 0, m + n - t, antecip, 'd', rows)
+    pure = np.where(valid_pure, pure, 1.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        value = (V - insurance)/pure
+
+    #the others: the shortest term with the value closest to the reserve
+    search = window & ~endowment & (prod != 'd')
+    rows_ = np.broadcast_to(rows, x.shape) if np.ndim(comm[0]) == 2 else None
+    limit = np.minimum(m, max_age - t)
+    term = np.zeros(len(x), dtype=np.int64)
+    index = np.flatnonzero(search & valid)
+    term[index] = extended_term_batch(price_comm, (x + t)[index], np.minimum(n - t, 0)[index],
+                                      limit[index].astype(np.int64), antecip[index],
+                                      np.where(prod == 'D', 'A', prod)[index], V[index],
+                                      None if rows_ is None else rows_[index])
+
+    return {'paidup': np.where(valid, paidup, np.nan),
+            'extended_term': np.where(valid, np.where(endowment, m, term), np.nan),
+            'extended_value': np.where(valid & endowment, value, np.nan),
+            'valid': valid}
+
+
+def calc_reserve_curves_batch(comm, contracts, pna, durations, kind='prosp'):
+    '''
+        Reserve curves of a batch of contracts
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) of the reserves rate
+            contracts: contract columns (see contract_columns)
+            pna: net level premiums of the contracts --> np.array
+            durations: evaluation times, the same for all contracts --> np.array of int
+            kind: prosp or retrosp --> str
+        Output:
+            (reserves, valid) --> (np.array contracts x durations, np.array of bool)
+    '''
+    if kind not in RESERVE_KINDS:
+        raise Exception('kind must be one of {}'.format(list(RESERVE_KINDS)))
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    durations = np.asarray(durations, dtype=np.int64)
+    repeated = {name: np.repeat(values, len(durations)) for name, values in c.items()}
+    pna = np.repeat(np.asarray(pna, dtype=np.float64), len(durations))
+    reserves, valid = RESERVE_KINDS[kind](comm, repeated, pna, np.tile(durations, size))
+    return reserves.reshape(size, len(durations)), valid.reshape(size, len(durations))
+
+
+RESERVE_KINDS = {'prosp': calc_reserves_batch, 'retrosp': calc_retro_reserves_batch}
+
+
+def calc_reserve_rates_batch(handler, contracts, pna, rates, durations):
+    '''
+        Prospective reserves of a batch of contracts for several valuation rates, the same of
+        calc_reserves(t, rate=rate), in one vectorized call
+        Input:
+            handler: InsuranceHandler after select_table
+            contracts: contract columns (see contract_columns)
+            pna: net level premiums of the contracts (at the pricing rate) --> np.array
+            rates: valuation rates --> np.array
+            durations: evaluation times --> np.array of int
+        Output:
+            (reserves, valid) --> (np.array contracts x rates x durations, same shape of bool)
+    '''
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    rates = np.asarray(rates, dtype=np.float64)
+    durations = np.asarray(durations, dtype=np.int64)
+    #one row of commutations per (contract, rate), repeated for each duration
+    pairs = size*len(rates)
+    comm = commutations_for_rates(handler, np.tile(rates, size), np.repeat(c['age'], len(rates)))
+    repeated = {name: np.repeat(values, len(rates)*len(durations)) for name, values in c.items()}
+    pna = np.repeat(np.asarray(pna, dtype=np.float64), len(rates)*len(durations))
+    reserves, valid = calc_reserves_batch(comm, repeated, pna, np.tile(durations, pairs),
+                                          np.repeat(np.arange(pairs), len(durations)))
+    shape = (size, len(rates), len(durations))
+    return reserves.reshape(shape), valid.reshape(shape)
+
+
+def decrement_columns(handler, ages, horizon):
+    '''
+        Life table columns of each contract year, from the issue age to the horizon
+        Input:
+            handler: InsuranceHandler after select_table
+            ages: issue ages --> np.array of int
+            horizon: number of years --> int
+        Output:
+            (lx, dx, inside) --> np.array contracts x years, lx and dx are zero beyond the table
+            (inside = False), select tables use the row of the issue age
+    '''
+    max_age = int(handler.max_age)
+    x = np.asarray(ages).astype(np.int64)[:, None]
+    size = len(x)
+    k = np.arange(horizon)[None, :]
+    if handler.select_lx is not None:
+        lx = handler.select_lx[x[:, 0]]
+        dx = handler.select_dx[x[:, 0]]
+    else:
+        lx = handler.df_['lx'].values.astype(np.float64)[None, :]
+        dx = handler.df_['dx'].values.astype(np.float64)[None, :]
+    inside = x + k <= max_age
+    attained = np.broadcast_to(np.clip(x + k, 0, max_age), inside.shape)
+    l_k = np.where(inside, np.take_along_axis(np.broadcast_to(lx, (size, lx.shape[1])),
+                                              attained, axis=1), 0.)
+    d_k = np.where(inside, np.take_along_axis(np.broadcast_to(dx, (size, dx.shape[1])),
+                                              attained, axis=1), 0.)
+    return l_k, d_k, inside
+
+
+def cash_flow_masks(contracts, horizon):
+    '''
+        Years of each contract with unit cash flows, the same conventions of the reserves
+        (a reserve at t is taken before the payments at the start of year t)
+        Input:
+            contracts: contract columns (see contract_columns)
+            horizon: number of years --> int
+        Output:
+            dict of np.array of bool (contracts x years):
+                death: death benefit paid at the end of the year
+                start: survival benefit paid at the start of the year (annuity due, pure
+                       endowment at the end of the term)
+                end: survival benefit paid at the end of the year (annuity immediate)
+                paying: premium of the year, paid at the start (antecip_pay) or at the end
+    '''
+    c = contract_columns(contracts)
+    k = np.arange(horizon)[None, :]
+
+    def during(start, term):
+        return (start[:, None] <= k) & (k < (start + term)[:, None])
+
+    n = c['dif_benef']
+    m = c['term_benef']
+    prod = c['prod'][:, None]
+    benefit = during(n, m)
+    #the pure endowment is paid at the end of the term, held in the reserve until then
+    survival = ((prod == 'd') | (prod == 'D')) & (k == (n + m)[:, None])
+    annuity = (prod == 'a') & benefit
+    return {'death': np.where((prod == 'A') | (prod == 'D'), benefit, False),
+            'start': (annuity & c['antecip_benef'][:, None]) | survival,
+            'end': annuity & ~c['antecip_benef'][:, None],
+            'paying': during(c['dif_pay'], c['term_pay'])}
@@ -0,0 +1,238 @@
+'''
+    Blended life tables, as the male/female mix of unisex pricing.
+
+    A blend is a weighted mix of (table, gender) pairs, given as a list of (table, gender,
+    weight) or a dict {(table, gender): weight}. Weights are normalized to sum 1. Methods:
+        lx: mix of the lives at age 0, lx = RADIX*sum(w_j*lx_j/lx_j[0]), so the mix of the
+            survivors changes with the age (the mortality of a mixed cohort);
+        qx: the same mix at every age, qx = sum(w_j*qx_j).
+    Ages beyond the end of a table have no survivors of it (qx = 1), and a blend ends at the
+    max age of its longest table. Select tables are not blended.
+
+    Blends are identified by the content hashes of their tables, the weights and the method
+    (blend_key), which is the table hash of InsuranceHandler.select_blend: the commutations of
+    a blend are cached by its weights, and calc_premium_blends_batch shares the same entries.
+    calc_premium_blends_batch prices a batch of contracts on many blends in one vectorized
+    pass: the blended columns of all blends are the product of the weights matrix by the
+    columns of the tables.
+'''
+import copy
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from batch import contract_columns, columns_commutations, calc_pup_batch
+
+BLEND_METHODS = ['lx', 'qx']
+#radix of the blended tables
+RADIX = 1000000.
+
+
+def normalize_mix(mix):
+    '''
+        Mix of tables with the weights summing 1
+        Input:
+            mix: list of (table, gender, weight) or dict {(table, gender): weight}
+        Output:
+            list of (table, gender, weight)
+    '''
+    if isinstance(mix, dict):
+        mix = [(table, gender, weight) for (table, gender), weight in mix.items()]
+    mix = [(table, gender, float(weight)) for table, gender, weight in mix]
+    weights = np.array([weight for table, gender, weight in mix])
+    if not len(mix) or not np.isfinite(weights).all() or (weights < 0).any() or \
+            weights.sum() <= 0:
+        raise Exception('Os pesos da combinação de tábuas devem ser positivos')
+    total = weights.sum()
+    return [(table, gender, weight/total) for table, gender, weight in mix]
+
+
+def mix_name(mix):
+    '''
+        Label of a blend, as "AT2000 M 50% + AT2000 F 50%"
+    '''
+    return ' + '.join('{} {} {:.0%}'.format(table.strip(), gender, weight)
+                      for table, gender, weight in normalize_mix(mix))
+
+
+def component_columns(handler, keys):
+    '''
+        lx and dx of tables aligned on the ages from 0 to the largest max age, zero beyond the
+        end of each table
+        Input:
+            handler: InsuranceHandler, not changed
+            keys: list of (table, gender)
+        Output:
+            (lx, dx, hashes, max_ages) --> (np.array tables x ages, same, list of str, np.array)
+    '''
+    handler_ = copy.copy(handler)
+    columns = []
+    for table, gender in keys:
+        handler_.select_table(table, gender)
+        if handler_.df_.empty:
+            raise Exception('Tábua {} {} não encontrada'.format(table, gender))
+        if handler_.select_lx is not None:
+            raise Exception('Tábuas seletas não podem ser combinadas: {} {}'.format(table,
+                                                                                  gender))
+        if handler_.df_['age'].values[0] != 0:
+            raise Exception('Tábua {} {} não começa na idade 0'.format(table, gender))
+        columns.append((handler_.df_['lx'].values.astype(np.float64),
+                        handler_.df_['dx'].values.astype(np.float64), handler_.table_hash))
+
+    size = max(len(lx) for lx, dx, tb_hash in columns)
+    lx = np.zeros((len(columns), size))
+    dx = np.zeros((len(columns), size))
+    for j, (lx_, dx_, tb_hash) in enumerate(columns):
+        lx[j, :len(lx_)] = lx_
+        dx[j, :len(dx_)] = dx_
+    max_ages = np.array([len(lx_) - 1 for lx_, dx_, tb_hash in columns])
+    return lx, dx, [tb_hash for lx_, dx_, tb_hash in columns], max_ages
+
+
+def blend_columns(lx, dx, weights, method='lx'):
+    '''
+        Blended lx and dx
+        Input:
+            lx, dx: columns of the tables (see component_columns) --> np.array tables x ages
+            weights: weights of the tables in each blend, rows summing 1
+                     --> np.array blends x tables
+            method: lx or qx --> str
+        Output:
+            (lx, dx) --> np.array blends x ages
+    '''
+    if method not in BLEND_METHODS:
+        raise Exception('method must be one of {}'.format(BLEND_METHODS))
+    if method == 'lx':
+        radix = lx[:, :1]
+        return RADIX*(weights @ (lx/radix)), RADIX*(weights @ (dx/radix))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = weights @ np.where(lx > 0, dx/lx, 1.)
+    alive = np.cumprod(1 - q[:, :-1], axis=1)
+    lx_ = RADIX*np.concatenate([np.ones((len(q), 1)), alive], axis=1)
+    return lx_, lx_*q
+
+
+def blend_key(hashes, weights, method='lx'):
+    '''
+        Identifier of a blend: content hashes of the tables with positive weights, the weights
+        and the method
+    '''
+    parts = sorted([tb_hash, repr(float(weight))] for tb_hash, weight in zip(hashes, weights)
+                   if weight > 0)
+    return hashlib.sha1(json.dumps([method, parts]).encode()).hexdigest()
+
+
+def blend_max_ages(weights, max_ages):
+    '''
+        Max age of each blend, the max age of its longest table with positive weight
+    '''
+    return np.where(weights > 0, max_ages[None, :], 0).max(axis=1)
+
+
+def mix_weights(mixes):
+    '''
+        Tables and weights matrix of a list of mixes
+        Output:
+            (list of (table, gender), np.array blends x tables)
+    '''
+    mixes = [normalize_mix(mix) for mix in mixes]
+    keys = list(dict.fromkeys((table, gender) for mix in mixes for table, gender, w in mix))
+    weights = np.zeros((len(mixes), len(keys)))
+    for b, mix in enumerate(mixes):
+        for table, gender, weight in mix:
+            weights[b, keys.index((table, gender))] += weight
+    return keys, weights
+
+
+def blend_table(handler, mix, method='lx'):
+    '''
+        Life table of a blend
+        Input:
+            handler: InsuranceHandler, not changed
+            mix: see normalize_mix
+            method: lx or qx --> str
+        Output:
+            (life table with age, lx and dx --> pandas dataframe, blend key --> str)
+    '''
+    keys, weights = mix_weights([mix])
+    lx, dx, hashes, max_ages = component_columns(handler, keys)
+    lx, dx = blend_columns(lx, dx, weights, method)
+    size = blend_max_ages(weights, max_ages)[0] + 1
+    df_ = pd.DataFrame({'age': np.arange(size), 'lx': lx[0, :size], 'dx': dx[0, :size]})
+    return df_, blend_key(hashes, weights[0], method)
+
+
+def blend_commutations(cache, lx, dx, keys, rate):
+    '''
+        Commutations of blends of the same length, read from the cache when available
+        Input:
+            cache: storage.CommutationCache or None
+            lx, dx: blended columns --> np.array blends x ages
+            keys: blend keys --> list of str
+            rate: interest rate --> float
+        Output:
+            (Dx, Nx, Cx, Mx) --> np.array blends x ages
+    '''
+    comm = np.empty((4,) + lx.shape)
+    missing = []
+    for b, key in enumerate(keys):
+        cached = cache.get((key, rate)) if cache is not None else None
+        if cached is None:
+            missing.append(b)
+        else:
+            comm[:, b] = cached
+    if missing:
+        values = columns_commutations(lx[missing], dx[missing], np.arange(lx.shape[1]),
+                                      np.full(len(missing), rate))
+        comm[:, missing] = values
+        if cache is not None:
+            for row, b in enumerate(missing):
+                cache.set((keys[b], rate), *[values_[row] for values_ in values])
+    return comm[0], comm[1], comm[2], comm[3]
+
+
+def calc_premium_blends_batch(handler, contracts, mixes, rate, method='lx'):
+    '''
+        Premiums of a batch of contracts on several blends, in one vectorized pass
+        Input:
+            handler: InsuranceHandler, its commutations cache is used
+            contracts: contract columns (see batch.contract_columns)
+            mixes: list of blends (see normalize_mix)
+            rate: interest rate --> float
+            method: lx or qx --> str
+        Output:
+            dict with the arrays pup, anui, pna and valid (contracts x blends) and the blend
+            keys
+    '''
+    keys, weights = mix_weights(mixes)
+    lx, dx, hashes, max_ages = component_columns(handler, keys)
+    lx, dx = blend_columns(lx, dx, weights, method)
+    blend_keys = [blend_key(hashes, row, method) for row in weights]
+    max_ages = blend_max_ages(weights, max_ages)
+
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    result = {name: np.full((size, len(mixes)), np.nan) for name in ['pup', 'anui', 'pna']}
+    result['valid'] = np.zeros((size, len(mixes)), dtype=bool)
+    #the blends of each max age are priced together, one row of commutations per blend
+    for max_age in np.unique(max_ages):
+        group = np.flatnonzero(max_ages == max_age)
+        comm = blend_commutations(handler.cache, lx[group, :max_age + 1],
+                                  dx[group, :max_age + 1], [blend_keys[b] for b in group],
+                                  rate) + (int(max_age),)
+        repeated = {name: np.repeat(values, len(group)) for name, values in c.items()}
+        rows = np.tile(np.arange(len(group)), size)
+        pup, valid_benef = calc_pup_batch(comm, repeated['age'], repeated['dif_benef'],
+                                          repeated['term_benef'], repeated['antecip_benef'],
+                                          repeated['prod'], rows)
+        anui, valid_pay = calc_pup_batch(comm, repeated['age'], repeated['dif_pay'],
+                                         repeated['term_pay'], repeated['antecip_pay'], 'a',
+                                         rows)
+        valid = valid_benef & valid_pay
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pna = np.where(valid, pup/anui, np.nan)
+        for name, values in [('pup', pup), ('anui', anui), ('pna', pna), ('valid', valid)]:
+            result[name][:, group] = values.reshape(size, len(group))
+    result['keys'] = blend_keys
+    return result
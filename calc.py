@@ -2,7 +2,15 @@ import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import copy
-from controls import PRODUCTS
+from controls import PRODUCTS, GENDER, UNISEX_NAME, UNISEX_WEIGHTS
+from selection import split_select, select_commutations
+from storage import content_hash
+from blending import blend_table, mix_name, calc_premium_blends_batch
+from batch import typed_contracts, calc_premium_rates_batch
+from batch import calc_reserve_rates_batch, commutations
+from kernels import reserve_curves
+from results import allocate
+from validity import age_limits, duration_limits
 
 class InsuranceHandler():
     '''
@@ -15,10 +23,12 @@ class InsuranceHandler():
             Annuity: a
 
     '''
-    def __init__(self, df):
+    def __init__(self, df, store=None, cache=None):
         '''
             Class constructor:
-                Input: pandas dataframe --> required
+                Input: pandas dataframe --> required (may be None when store is provided)
+                       store: compact table storage (storage.TableStore), default None
+                       cache: commutations cache (storage.CommutationCache), default None
             All variables are populated according to the methods used.
             Example:
                 When calc_premium is called all the variables required on premiums calculation are
@@ -26,8 +36,21 @@ class InsuranceHandler():
         '''
         #all life tables
         self.df = df
+        #compact storage of the life tables, used instead of df when provided
+        self.store = store
+        #commutations cache shared by the handlers
+        self.cache = cache
+        #table and gender selected
+        self.table = None
+        self.gender = None
+        #content hash of the selected table, key of the commutations cache
+        self.table_hash = None
         #filtered life table which will be used on the calculations
         self.df_ = None
+        #select tables [issue age, attained age] and their commutations, None for ultimate tables
+        self.select_lx = None
+        self.select_dx = None
+        self.select_comm = None
         #interest rate provided
         self.last_i_rate_used = None
         #max age of the table
@@ -95,7 +118,7 @@ class InsuranceHandler():
             Output:
                   An np.array with Dx commutation
         '''
-        lx = self.df_['lx'].values
+        lx = self.df_['lx'].values if self.select_lx is None else self.select_lx[self.age]
         age = self.df_['age'].values
 
         return lx*self.__pv_calc__(age, i)
@@ -121,7 +144,7 @@ class InsuranceHandler():
             Output:
                   An np.array with Cx commutation
         '''
-        dx = self.df_['dx'].values
+        dx = self.df_['dx'].values if self.select_dx is None else self.select_dx[self.age]
         age = self.df_['age'].values
         age_ = age + 1
 
@@ -431,11 +454,41 @@ class InsuranceHandler():
             Output:
 
         '''
-        query_string = 'table == "{}" and gender == "{}"'.\
-                                          format(table, gender)
-        self.df_ = self.df.query(query_string).\
-                                          reset_index(drop=True).copy()
+        if self.store is not None:
+            self.df_ = self.store.table(table, gender)
+            self.table_hash = self.store.info(table, gender)['hash']
+        else:
+            query_string = 'table == "{}" and gender == "{}"'.\
+                                              format(table, gender)
+            self.df_ = self.df.query(query_string).\
+                                              reset_index(drop=True).copy()
+        #select and ultimate tables keep the ultimate rows on df_
+        self.df_, self.select_lx, self.select_dx = split_select(self.df_)
+        if self.store is None:
+            self.table_hash = content_hash(self.df_['lx'].values, self.df_['dx'].values,
+                                           self.select_lx, self.select_dx)
+        self.max_age = self.df_['age'].max()
+        self.table = table
+        self.gender = gender
+
+    def select_blend(self, mix, method='lx'):
+        '''
+            This method selects a blend of life tables, as a unisex table (see blending.py)
+            Input:
+                mix: list of (table, gender, weight) or dict {(table, gender): weight}
+                method: lx (mix of the lives at age 0) or qx (mix at every age) --> str
+            Output:
+
+        '''
+        df_, table_hash = blend_table(self, mix, method)
+        self.df_ = df_
+        #the commutations of a blend are cached by the hash of its tables and weights
+        self.table_hash = table_hash
+        self.select_lx = None
+        self.select_dx = None
         self.max_age = self.df_['age'].max()
+        self.table = mix_name(mix)
+        self.gender = None
 
     def gen_commutations(self, i_rate):
         '''
@@ -449,12 +502,34 @@ class InsuranceHandler():
             raise Exception('Life table must be filtered')
 
         self.last_i_rate_used = i_rate
+        self.select_comm = None
+
+        if self.select_lx is not None:
+            #calc_premium uses the row of the issue age
+            key = (self.table_hash, i_rate, 'select')
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is None:
+                cached = select_commutations(self.select_lx, self.select_dx,
+                                             self.df_['age'].values, i_rate)
+                if self.cache is not None:
+                    self.cache.set(key, *cached)
+            self.select_comm = cached
+            return
+
+        key = (self.table_hash, i_rate)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            self.Dx, self.Nx, self.Cx, self.Mx = cached
+            return
 
         self.Dx = self.__calc_Dx__()
         self.Nx = self.__calc_Nx__()
         self.Cx = self.__calc_Cx__()
         self.Mx = self.__calc_Mx__()
 
+        if self.cache is not None:
+            self.cache.set(key, self.Dx, self.Nx, self.Cx, self.Mx)
+
     def calc_premium(self, age, dif_benef=0, term_benef=np.inf,
                      antecip_benef=True, prod='a',
                      dif_pay=0, term_pay=np.inf, antecip_pay=True):
@@ -473,6 +548,8 @@ class InsuranceHandler():
             Ouput:
         '''
         self.age = age
+        if self.select_comm is not None:
+            self.Dx, self.Nx, self.Cx, self.Mx = [values[age] for values in self.select_comm]
 
         self.pup = self.__calc_pup__(dif_benef, age, term_benef,
                                      antecip_benef, prod)
@@ -513,6 +590,27 @@ class InsuranceHandler():
 
         return result
 
+#significant digits of the values sent on the figures, None sends the full float64 values
+FIGURE_DIGITS = 6
+
+def round_values(values, digits=None):
+    '''
+        Rounds the values of a plot to significant digits, reducing the size of the figure sent
+        to the browser without changing what it shows for any benefit value
+        Input:
+            values: values --> list or np.array
+            digits: number of significant digits, None keeps the values --> int
+        Output:
+            np.array
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if digits is None:
+        return values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.floor(np.log10(np.abs(values)))
+    scale = 10.**np.where(np.isfinite(magnitude), digits - 1 - magnitude, 0)
+    return np.where(np.isfinite(values), np.round(values*scale)/scale, values)
+
 def real_br_money_mask(my_value):
     a = '{:,.2f}'.format(float(my_value))
     b = a.replace(',','v')
@@ -520,45 +618,81 @@ def real_br_money_mask(my_value):
     return 'R$ ' + c.replace('v','.')
 
 
+#rates and ages of the main plot surface
+MAIN_PLOT_RATES = [0.020, 0.025, 0.030,
+                   0.035, 0.040, 0.045, 0.050,
+                   0.055, 0.060, 0.065, 0.070,
+                   0.075, 0.080, 0.085, 0.090,
+                   0.095, 0.100]
+MAIN_PLOT_AGES = list(range(0, 81))
+#rates of the main surface priced per call, the progress is reported after each block
+MAIN_PLOT_RATE_BLOCK = 4
+
+def calc_main_surface(handler_copy, dif_benef,
+                      term_benef, product,
+                      antecip_benef,
+                      dif_pay=0, term_pay=np.inf,
+                      antecip_pay=True, progress=None):
+    '''
+        Calculates the net level premium of a unit benefit for all the rates and ages of
+        the main plot
+        Input:
+            handler_copy: InsuranceHandler with the life table selected
+            progress: function called with the fraction of the work done, default None
+            the other parameters are the same of calc_premium
+        Output:
+            np.array (ages x rates) with the net level premiums, nan where the combination of
+            age and periods is not valid
+    '''
+    handler_copy_ = copy.copy(handler_copy)
+    surface = np.full((len(MAIN_PLOT_AGES), len(MAIN_PLOT_RATES)), np.nan)
+
+    #the valid ages do not depend on the rate, they are found once (see validity.py)
+    contracts = typed_contracts({'age': MAIN_PLOT_AGES, 'dif_benef': dif_benef,
+                                 'term_benef': term_benef, 'antecip_benef': antecip_benef,
+                                 'prod': product, 'dif_pay': dif_pay, 'term_pay': term_pay,
+                                 'antecip_pay': antecip_pay})
+    valid = contracts['age'] <= age_limits(int(handler_copy_.max_age), contracts[:1])[0]
+    blocks = range(0, len(MAIN_PLOT_RATES), MAIN_PLOT_RATE_BLOCK)
+    for block in blocks:
+        columns = slice(block, block + MAIN_PLOT_RATE_BLOCK)
+        if valid.any():
+            premium = calc_premium_rates_batch(handler_copy_, contracts[valid],
+                                               MAIN_PLOT_RATES[columns])
+            surface[valid, columns] = premium['pna']
+        if progress is not None:
+            progress(min(block + MAIN_PLOT_RATE_BLOCK, len(MAIN_PLOT_RATES))/
+                     len(MAIN_PLOT_RATES))
+
+    return surface
+
 def generate_main_plot(handler_copy, dif_benef,
                        term_benef, product,
                        antecip_benef, value_bnf,
                        dif_pay=0, term_pay=np.inf,
-                       antecip_pay=True):
-
-    handler_copy_ = copy.copy(handler_copy)
-    values = []
-    for i_rate in [0.020, 0.025, 0.030,
-                   0.035, 0.040, 0.045, 0.050,
-                   0.055, 0.060, 0.065, 0.070,
-                   0.075, 0.080, 0.085, 0.090,
-                   0.095, 0.100]:
-
-        handler_copy_.gen_commutations(i_rate)
-        for age in range(0, 81):
-            cell = []
-            try:
-                handler_copy_.calc_premium(age=age,
-                                           dif_benef=dif_benef,
-                                           term_benef=term_benef,
-                                           antecip_benef=antecip_benef,
-                                           prod=product,
-                                           dif_pay=dif_pay,
-                                           term_pay=term_pay,
-                                           antecip_pay=antecip_pay)
-
-                cell = [age, i_rate*100, handler_copy_.pna*value_bnf]
-                values.append(cell)
-            except:
-                pass
-
-    df_3d = pd.DataFrame(np.array(values))
-    df_matrix = pd.crosstab(index=df_3d[0], columns= df_3d[1],
-                                values=df_3d[2], aggfunc=np.sum)
-
-    fig = go.Figure(data=[go.Surface(z=df_matrix,
+                       antecip_pay=True, tiles=None, digits=None,
+                       progress=None):
+
+    #precomputed surfaces are used when available (see tiles.py)
+    surface = None
+    if tiles is not None:
+        surface = tiles.lookup(handler_copy, dif_benef, term_benef, product, antecip_benef,
+                               dif_pay, term_pay, antecip_pay)
+    if surface is None:
+        surface = calc_main_surface(handler_copy, dif_benef, term_benef, product,
+                                    antecip_benef, dif_pay, term_pay, antecip_pay,
+                                    progress)
+
+    #ages without any valid premium are not shown
+    valid = ~np.isnan(surface).all(axis=1)
+    df_matrix = pd.DataFrame(surface[valid]*value_bnf,
+                             index=np.array(MAIN_PLOT_AGES)[valid],
+                             columns=np.array(MAIN_PLOT_RATES)*100)
+
+    #the rates are rounded too, 0.035*100 = 3.5000000000000004
+    fig = go.Figure(data=[go.Surface(z=round_values(df_matrix.values, digits),
                                  y=np.array(list(df_matrix.index)),
-                                 x=np.array(list(df_matrix.columns)))])
+                                 x=round_values(df_matrix.columns, None if digits is None else 4))])
 
 
     fig.update_layout(title=PRODUCTS[product], margin=dict(l=65, r=50, b=65, t=90),
@@ -569,31 +703,51 @@ def generate_main_plot(handler_copy, dif_benef,
 
     return fig
 
-def generate_reserves_plot(handler_copy, value_bnf):
+#last duration of the reserves plot
+RESERVE_PLOT_MAX_T = 99
+RESERVE_CURVE_DTYPE = np.dtype([('t', np.int64), ('retro', np.float64), ('prosp', np.float64)])
 
-    handler_copy_ = copy.copy(handler_copy)
-    retro = []
-    prosp = []
-    t_ = []
-
-    for t in range(0,100):
-        try:
-            retro.append(handler_copy_.calc_reserves(t, kind='retrosp')*value_bnf)
-            prosp.append(handler_copy_.calc_reserves(t)*value_bnf)
-            t_.append(t)
-        except:
-            pass
-
-    l1 = len(t_)
-    l2 = len(retro)
-    l3 = len(prosp)
-    t_ = t_[:min(l1,l2,l3)]
-    retro = retro[:min(l1,l2,l3)]
-    prosp = prosp[:min(l1,l2,l3)]
-
-    reserves_df = pd.DataFrame().from_dict({'t':t_,
-                                            'Retrospectiva':retro,
-                                            'Prospectiva':prosp})
+def last_contract(handler_copy):
+    '''
+        Contract columns of the last contract priced (calc_premium)
+    '''
+    return {'age': [handler_copy.age], 'dif_benef': [handler_copy.dif_benef],
+            'term_benef': [handler_copy.term_benef],
+            'antecip_benef': [handler_copy.antecip_benef], 'prod': [handler_copy.prod],
+            'dif_pay': [handler_copy.dif_pay], 'term_pay': [handler_copy.term_pay],
+            'antecip_pay': [handler_copy.antecip_pay]}
+
+def calc_reserve_curves(handler_copy, durations=None):
+    '''
+        Retrospective and prospective reserves of a unit benefit of the last contract priced
+        (calc_premium), at the durations where both are defined
+        Input:
+            handler_copy: InsuranceHandler after calc_premium
+            durations: evaluation times, default up to the last duration with both reserves
+                       (at most RESERVE_PLOT_MAX_T) --> np.array of int
+        Output:
+            np.array of RESERVE_CURVE_DTYPE
+    '''
+    contract = last_contract(handler_copy)
+    if durations is None:
+        max_age = int(handler_copy.max_age)
+        last = min(duration_limits(max_age, contract)[0],
+                   duration_limits(max_age, contract, 'retrosp')[0], RESERVE_PLOT_MAX_T)
+        durations = np.arange(0, last + 1)
+    comm = commutations(handler_copy)
+    retro, valid_retro = reserve_curves(comm, contract, [handler_copy.pna], durations,
+                                        'retrosp')
+    prosp, valid_prosp = reserve_curves(comm, contract, [handler_copy.pna], durations)
+    valid = valid_retro[0] & valid_prosp[0]
+    curves = allocate(RESERVE_CURVE_DTYPE, int(valid.sum()))
+    curves['t'] = np.asarray(durations)[valid]
+    curves['retro'] = retro[0, valid]
+    curves['prosp'] = prosp[0, valid]
+    return curves
+
+def generate_reserves_plot(handler_copy, value_bnf, digits=None):
+
+    curves = calc_reserve_curves(handler_copy)
 
     layout = go.Layout(title= "Reservas",
             paper_bgcolor='rgba(0,0,0,0)',
@@ -601,20 +755,82 @@ def generate_reserves_plot(handler_copy, value_bnf):
             )
     fig = go.Figure(layout=layout)
 
-    fig.add_trace(go.Scatter(x=reserves_df['t'].values,
-                             y=reserves_df['Retrospectiva'].values,
+    fig.add_trace(go.Scatter(x=curves['t'],
+                             y=round_values(curves['retro']*value_bnf, digits),
                              mode='lines',
                             name='Retrospectivo'))
 
-    fig.add_trace(go.Scatter(x=reserves_df['t'].values,
-                    y=reserves_df['Prospectiva'].values,
+    fig.add_trace(go.Scatter(x=curves['t'],
+                    y=round_values(curves['prosp']*value_bnf, digits),
                     mode='lines+markers',
                     name='Prospectivo'))
 
     return fig
 
-def generate_tables_plot(handler_copy,
-                         gender, age,
+def calc_reserve_surface(handler_copy, rates=MAIN_PLOT_RATES):
+    '''
+        Prospective reserves of a unit benefit of the last contract priced (calc_premium) for
+        several valuation rates and all durations
+        Input:
+            handler_copy: InsuranceHandler after calc_premium
+            rates: valuation rates --> list of float
+        Output:
+            (rates, durations, np.array rates x durations), nan where the reserve is not defined
+    '''
+    contract = last_contract(handler_copy)
+    durations = np.arange(0, duration_limits(int(handler_copy.max_age), contract)[0] + 1)
+    reserves, valid = calc_reserve_rates_batch(handler_copy, contract, [handler_copy.pna],
+                                               rates, durations)
+    return rates, durations, np.where(valid[0], reserves[0], np.nan)
+
+def generate_reserves_heatmap(handler_copy, value_bnf, digits=None, surface=None):
+    '''
+        Heatmap of the prospective reserves by valuation rate and duration
+        Input:
+            handler_copy: InsuranceHandler after calc_premium
+            value_bnf: benefit value --> float
+            surface: result of calc_reserve_surface, calculated when not given
+    '''
+    rates, durations, reserves = calc_reserve_surface(handler_copy) if surface is None else surface
+    #durations without any reserve and the zeros after the end of the contract are not shown
+    shown = ~np.isnan(reserves).all(axis=0)
+    nonzero = np.flatnonzero((np.nan_to_num(reserves) != 0).any(axis=0))
+    if nonzero.size:
+        shown &= durations <= durations[nonzero[-1]] + 1
+
+    layout = go.Layout(title="Reservas por taxa de juros",
+                       paper_bgcolor='rgba(0,0,0,0)',
+                       plot_bgcolor='rgba(0,0,0,0)',
+                       xaxis_title='t',
+                       yaxis_title='Taxa de Juros a.a')
+    fig = go.Figure(layout=layout)
+    fig.add_trace(go.Heatmap(z=round_values(reserves[:, shown]*value_bnf, digits),
+                             x=durations[shown],
+                             y=round_values(np.array(rates)*100,
+                                            None if digits is None else 4),
+                             colorscale='Viridis'))
+    return fig
+
+#tables of the comparison chart
+COMPARISON_TABLES = ['IBGE 2009', 'BR-EMSsb-v.2015',
+                     'BR-EMSmt-v.2015', ' AT2000', 'AT-49']
+
+def available_tables(handler):
+    '''
+        Tables in the data of a handler --> set of str
+    '''
+    if handler.store is not None:
+        return {tb for tb, gender in handler.store.keys()}
+    return set(handler.df['table'].unique())
+
+def comparison_tables(handler):
+    '''
+        Tables of the comparison chart available in the data of a handler
+    '''
+    available = available_tables(handler)
+    return [tb for tb in COMPARISON_TABLES if tb in available]
+
+def generate_tables_plot(handler_copy, age,
                          i_rate, dif_bnf,
                          term_bnf,
                          antecip_bnf,
@@ -622,35 +838,52 @@ def generate_tables_plot(handler_copy,
                          dif_pay,
                          term_pay,
                          antecip_pay,
-                         value_bnf):
-
-    handler_copy_ = copy.copy(handler_copy)
-    tables = ['IBGE 2009', 'BR-EMSsb-v.2015',
-              'BR-EMSmt-v.2015', ' AT2000', 'AT-49']
-    pna_ =[]
-    tbs_ = []
-    for tb in tables:
-        try:
-            handler_copy_.select_table(tb, gender)
-            handler_copy_.gen_commutations(i_rate)
-            handler_copy_.calc_premium(age=age,
-                                       dif_benef=dif_bnf,
-                                       term_benef=term_bnf,
-                                       antecip_benef=antecip_bnf,
-                                       prod=prod,
-                                       dif_pay=dif_pay,
-                                       term_pay=term_pay,
-                                       antecip_pay=antecip_pay)
-            pna_.append(handler_copy_.pna*value_bnf)
-            tbs_.append(tb)
-        except:
-            pass
+                         value_bnf,
+                         digits=None):
+    '''
+        Net level premiums of a contract on the comparison tables, for each gender and for the
+        unisex blend (UNISEX_WEIGHTS), priced on all the tables in one vectorized pass
+    '''
+    tables = comparison_tables(handler_copy)
+    series = {name: [[(tb, gender, 1.)] for tb in tables] for gender, name in GENDER.items()}
+    series[UNISEX_NAME] = [[(tb, gender, weight) for gender, weight in UNISEX_WEIGHTS.items()]
+                           for tb in tables]
+    contract = {'age': [age], 'dif_benef': [dif_bnf], 'term_benef': [term_bnf],
+                'antecip_benef': [antecip_bnf], 'prod': [prod], 'dif_pay': [dif_pay],
+                'term_pay': [term_pay], 'antecip_pay': [antecip_pay]}
+    mixes = [mix for mixes_ in series.values() for mix in mixes_]
+    pna = calc_premium_blends_batch(handler_copy, contract, mixes, i_rate)['pna'][0]*value_bnf
 
     layout = go.Layout(title= "Comparação de Tábuas",
             paper_bgcolor='rgba(0,0,0,0)',
-            plot_bgcolor='rgba(0,0,0,0)'
+            plot_bgcolor='rgba(0,0,0,0)',
+            barmode='group'
             )
 
-    fig = go.Figure([go.Bar(x=tbs_, y=pna_)], layout=layout)
+    bars = [go.Bar(name=name, x=tables,
+                   y=round_values(pna[s*len(tables):(s + 1)*len(tables)], digits))
+            for s, name in enumerate(series)]
+    fig = go.Figure(bars, layout=layout)
+
+    return fig
+
+def generate_portfolio_plot(summary):
+    '''
+        Reserves of a portfolio by product and table
+        Input:
+            summary: aggregates of portfolio.value_portfolio, None for an empty chart
+    '''
+    layout = go.Layout(title= "Reservas da Carteira",
+            barmode='group',
+            paper_bgcolor='rgba(0,0,0,0)',
+            plot_bgcolor='rgba(0,0,0,0)'
+            )
+    fig = go.Figure(layout=layout)
+    if summary is None:
+        return fig
 
+    for table, df_table in summary.groupby('table'):
+        fig.add_trace(go.Bar(x=[PRODUCTS.get(prod, prod) for prod in df_table['prod']],
+                             y=df_table['reserve'].values,
+                             name=table))
     return fig
@@ -0,0 +1,209 @@
+'''
+    Banded storage of the expected cash flows of a book.
+
+    Deferred and temporary contracts have cash flows only in a window of the projection years,
+    so instead of dense (policies x years) matrices each stream keeps, for each policy, the
+    (start, length) of its window and the offset of its values in one contiguous buffer:
+
+        index   np.array of BAND_DTYPE, one row per policy
+        values  np.array of float64, the windows of all the policies one after the other
+
+    The times are payment times from issue (the value of a time t is discounted by v**t), with
+    the conventions of __calc_pup__: annuities due pay at n to n + m - 1 and immediate ones at
+    n + 1 to n + m, death benefits of the year k are paid at k + 1, pure endowments at n + m and
+    premiums at i to i + k - 1 (i + 1 to i + k when postecipated). Values are expected cash
+    flows per policy at issue (l_x+t/l_x for survival payments, d_x+t-1/l_x for deaths) times the
+    benefit value, up to the end of the table. The windows are found in closed form and the
+    values are calculated only inside them, so memory is proportional to the years in force.
+
+    Aggregation works on the bands directly: aggregate_bands sums the values by time (and
+    group) and present_values discounts each window. At the pricing rate, the present values of
+    the benefits are the net single premiums (pup times the value) and the ones of the net
+    premiums are the same.
+'''
+import numpy as np
+from batch import commutations, contract_columns, calc_premium_batch
+from profit import contract_values
+
+#window of each policy in the values buffer
+BAND_DTYPE = np.dtype([('start', np.int64), ('length', np.int64), ('offset', np.int64)])
+STREAMS = ['benefits', 'premiums']
+
+
+def band_windows(c, max_age):
+    '''
+        Payment times of the benefits and premiums of the contracts, from start to end - 1
+        Input:
+            c: contract columns (see batch.contract_columns)
+            max_age: max age of the table --> int
+        Output:
+            dict stream --> (start, end) --> np.array of int
+    '''
+    x = c['age'].astype(np.int64)
+    n = c['dif_benef'].astype(np.int64)
+    i = c['dif_pay'].astype(np.int64)
+    prod = c['prod']
+    #survival payments end with the table, deaths of its last year are paid one year later
+    last = max_age - x + 1
+    m = np.where(np.isinf(c['term_benef']), last, np.minimum(c['term_benef'], last))
+    k = np.where(np.isinf(c['term_pay']), last, np.minimum(c['term_pay'], last))
+    m = m.astype(np.int64)
+    k = k.astype(np.int64)
+
+    step = np.where(c['antecip_benef'], 0, 1)
+    start = np.select([prod == 'a', prod == 'd', prod == 'D'],
+                      [n + step, n + m, n + np.minimum(m, 1)], n + 1)
+    end = np.select([prod == 'a', prod == 'd'], [n + m + step, n + m + 1], n + m + 1)
+    end = np.minimum(end, np.where((prod == 'A') | (prod == 'D'), last + 1, last))
+
+    step_pay = np.where(c['antecip_pay'], 0, 1)
+    return {'benefits': (start, end),
+            'premiums': (i + step_pay, np.minimum(i + k + step_pay, last))}
+
+
+def band_index(start, end):
+    '''
+        Band index of windows, empty when end <= start
+    '''
+    length = np.maximum(end - start, 0)
+    index = np.zeros(len(length), dtype=BAND_DTYPE)
+    index['start'] = start
+    index['length'] = length
+    index['offset'] = np.cumsum(length) - length
+    return index
+
+
+def band_elements(index):
+    '''
+        Policy and time of each value of the buffer
+        Output:
+            (policies, times) --> np.array of int
+    '''
+    policies = np.repeat(np.arange(len(index)), index['length'])
+    times = np.arange(index['length'].sum()) + \
+        np.repeat(index['start'] - index['offset'], index['length'])
+    return policies, times
+
+
+def table_values(handler, ages, attained):
+    '''
+        lx and dx at attained ages, zero outside the table, select tables use the rows of the
+        issue ages
+    '''
+    max_age = int(handler.max_age)
+    inside = (attained >= 0) & (attained <= max_age)
+    attained = np.clip(attained, 0, max_age)
+    if handler.select_lx is not None:
+        lx = handler.select_lx[ages, attained]
+        dx = handler.select_dx[ages, attained]
+    else:
+        lx = handler.df_['lx'].values.astype(np.float64)[attained]
+        dx = handler.df_['dx'].values.astype(np.float64)[attained]
+    return np.where(inside, lx, 0.), np.where(inside, dx, 0.)
+
+
+def cash_flow_bands(handler, contracts, premiums=None):
+    '''
+        Expected cash flows of a batch of contracts in banded storage
+        Input:
+            handler: InsuranceHandler after select_table and gen_commutations
+            contracts: contract columns (see batch.contract_columns), with an optional value
+                       column (benefit, default 1)
+            premiums: premium of each contract for its value, default the net level premium
+                      --> np.array
+        Output:
+            dict stream --> (index, values), contracts not accepted by calc_premium have empty
+            windows
+    '''
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    x = c['age'].astype(np.int64)
+    value = contract_values(contracts, size)
+    net = calc_premium_batch(commutations(handler), c)
+    premiums = net['pna']*value if premiums is None else \
+        np.broadcast_to(np.asarray(premiums, dtype=np.float64), (size,))
+
+    windows = band_windows(c, int(handler.max_age))
+    bands = {}
+    for stream in STREAMS:
+        start, end = windows[stream]
+        index = band_index(start, np.where(net['valid'], end, start))
+        policies, t = band_elements(index)
+        issue = x[policies]
+        l_0, _ = table_values(handler, issue, issue)
+        l_t, _ = table_values(handler, issue, issue + t)
+        survival = l_t/l_0
+        if stream == 'premiums':
+            values = survival*premiums[policies]
+        else:
+            prod = c['prod'][policies]
+            _, d_t = table_values(handler, issue, issue + t - 1)
+            #deaths are paid after the deferral, an endowment of term 0 is a pure endowment
+            death = np.where(t > c['dif_benef'][policies], d_t/l_0, 0.)
+            endowment = t == (c['dif_benef'] + c['term_benef'])[policies]
+            values = np.select([prod == 'a', prod == 'd', prod == 'A'],
+                               [survival, survival, death],
+                               death + np.where(endowment, survival, 0.))
+            values = values*value[policies]
+        bands[stream] = (index, values)
+    return bands
+
+
+def horizon_of(index):
+    '''
+        Number of times of a stream, from 0 to the end of its last window
+    '''
+    ends = index['start'] + index['length']
+    return int(ends[index['length'] > 0].max(initial=0))
+
+
+def aggregate_bands(bands, horizon=None, groups=None, n_groups=None):
+    '''
+        Totals of a stream by time, and by group
+        Input:
+            bands: (index, values) of a stream
+            horizon: number of times, default up to the end of the last window --> int
+            groups: group of each policy, 0 to n_groups - 1 --> np.array of int
+            n_groups: number of groups, default groups.max() + 1 --> int
+        Output:
+            np.array times, or groups x times
+    '''
+    index, values = bands
+    horizon = horizon_of(index) if horizon is None else horizon
+    policies, t = band_elements(index)
+    inside = t < horizon
+    if groups is None:
+        return np.bincount(t[inside], weights=values[inside], minlength=horizon)
+    groups = np.asarray(groups, dtype=np.int64)
+    n_groups = int(groups.max(initial=-1)) + 1 if n_groups is None else n_groups
+    cells = groups[policies[inside]]*horizon + t[inside]
+    totals = np.bincount(cells, weights=values[inside], minlength=n_groups*horizon)
+    return totals.reshape(n_groups, horizon)
+
+
+def present_values(bands, rate):
+    '''
+        Present value at issue of the window of each policy
+        Input:
+            bands: (index, values) of a stream
+            rate: interest rate --> float
+        Output:
+            np.array, one value per policy
+    '''
+    index, values = bands
+    policies, t = band_elements(index)
+    discounted = values*(1 + rate)**-t.astype(np.float64)
+    return np.bincount(policies, weights=discounted, minlength=len(index))
+
+
+def dense_bands(bands, horizon=None):
+    '''
+        Dense (policies x times) matrix of a stream, for small books and checks
+    '''
+    index, values = bands
+    horizon = horizon_of(index) if horizon is None else horizon
+    policies, t = band_elements(index)
+    inside = t < horizon
+    dense = np.zeros((len(index), horizon))
+    dense[policies[inside], t[inside]] = values[inside]
+    return dense
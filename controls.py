@@ -7,6 +7,11 @@ GENDER = {"M":"Masculino",
 
 DEF_GENDER = "F"
 
+# Unisex blend of the tables comparison (see blending.py)
+UNISEX_NAME = "Unissex"
+UNISEX_WEIGHTS = {"M": 0.5,
+                  "F": 0.5}
+
 PRODUCTS = {"a":"Anuidade",
             "A": "Seguro",
             "d":"Dotal Puro",
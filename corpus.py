@@ -0,0 +1,340 @@
+'''
+    Regression and benchmark corpus.
+
+    The cases come from data/simu.xlsx (net single premiums by age of five products on one
+    table and rate) and from generated contracts: every product code on every table of
+    life_tables.xlsx, both genders, with the edge cases whole life, immediate (postecipated)
+    annuities, deferred benefits, postponed payments and the ages around the last valid issue
+    age (validity.age_limits) and the end of the table. Each case is a batch of contracts of
+    one shape, one per issue age, run by every path:
+
+        scalar      InsuranceHandler.calc_premium and calc_reserves, one contract and duration
+                    at a time
+        numpy       calc_premium_batch and the reserve kernels (kernels.reserve_curves) with
+        numba       the backend of the name, the whole case in one call
+        python
+
+    The results of each path must match the scalar path: the same valid contracts and
+    durations (the exceptions of the scalar engine are invalid points) and values within the
+    tolerances. Retrospective reserves are compared where the pure endowment is at least
+    verify.MIN_PURE_ENDOWMENT, as in verify.py. Spreadsheet premiums are compared with the
+    scalar path, zero in the sheet is a premium that is not calculated. The time of each path
+    is recorded per case, so an optimization is measured and checked in the same run:
+
+        python corpus.py
+        python corpus.py --table " AT2000" --repeat 3 --out corpus.csv
+        python corpus.py --path scalar --path python --quick
+'''
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from calc import InsuranceHandler
+from batch import commutations, calc_premium_batch
+from kernels import reserve_curves, BACKENDS, numba
+from validity import age_limits
+from verify import DATA_PATH, MIN_PURE_ENDOWMENT, DEF_RTOL, DEF_ATOL
+
+#columns of simu.xlsx, unit benefit paid by a single premium
+SHEET_CONTRACTS = {
+    'anu_antecip_2_15': dict(prod='a', dif_benef=2, term_benef=15, antecip_benef=True),
+    'anu_postecip_2_15': dict(prod='a', dif_benef=2, term_benef=15, antecip_benef=False),
+    'dotal_misto_10': dict(prod='D', dif_benef=0, term_benef=10, antecip_benef=True),
+    'dotal_puro_20': dict(prod='d', dif_benef=0, term_benef=20, antecip_benef=True),
+    'seguro_2_20': dict(prod='A', dif_benef=2, term_benef=20, antecip_benef=True),
+}
+SHEET_PAYMENT = dict(dif_pay=0, term_pay=1, antecip_pay=True)
+#the postecipated annuity column repeats the values of the annuity due, so it is run by the
+#paths but not compared with the sheet
+SHEET_UNCHECKED = ['anu_postecip_2_15']
+
+#generated contract shapes, run on every table and gender
+CONTRACTS = {
+    'a_whole_due': dict(prod='a', dif_benef=0, term_benef=np.inf, antecip_benef=True,
+                        dif_pay=0, term_pay=1, antecip_pay=True),
+    'a_whole_immediate': dict(prod='a', dif_benef=0, term_benef=np.inf, antecip_benef=False,
+                              dif_pay=0, term_pay=np.inf, antecip_pay=False),
+    'a_deferred_postponed': dict(prod='a', dif_benef=10, term_benef=20, antecip_benef=True,
+                                 dif_pay=2, term_pay=8, antecip_pay=True),
+    'A_whole': dict(prod='A', dif_benef=0, term_benef=np.inf, antecip_benef=True,
+                    dif_pay=0, term_pay=np.inf, antecip_pay=True),
+    'A_term_postponed': dict(prod='A', dif_benef=2, term_benef=20, antecip_benef=True,
+                             dif_pay=3, term_pay=10, antecip_pay=False),
+    'd_20': dict(prod='d', dif_benef=0, term_benef=20, antecip_benef=True,
+                 dif_pay=0, term_pay=20, antecip_pay=True),
+    'd_30_postponed': dict(prod='d', dif_benef=0, term_benef=30, antecip_benef=True,
+                           dif_pay=5, term_pay=10, antecip_pay=False),
+    'D_10': dict(prod='D', dif_benef=0, term_benef=10, antecip_benef=True,
+                 dif_pay=0, term_pay=10, antecip_pay=True),
+    'D_deferred_postponed': dict(prod='D', dif_benef=5, term_benef=15, antecip_benef=True,
+                                 dif_pay=1, term_pay=5, antecip_pay=False),
+}
+#rate of the generated cases
+DEF_RATE = 0.0416
+#step of the issue ages, the ages around the limits are always included
+AGE_STEP = 5
+QUICK_AGE_STEP = 20
+
+RESERVE_KINDS = ['prosp', 'retrosp']
+
+
+def case_ages(max_age, contract, step=AGE_STEP):
+    '''
+        Issue ages of a case: every step years, the last valid issue age, the ages next to it
+        and the last ages of the table
+    '''
+    limit = int(age_limits(max_age, dict(contract, age=[0]))[0])
+    edges = [limit - 1, limit, limit + 1, max_age - 1, max_age]
+    ages = set(range(0, max_age + 1, step)) | {age for age in edges if 0 <= age <= max_age}
+    return np.array(sorted(ages))
+
+
+def sheet_cases(df, file=DATA_PATH.joinpath("simu.xlsx")):
+    '''
+        Cases of the simulation spreadsheet: one per product column, with the expected net
+        single premiums (nan where the sheet has zero)
+    '''
+    sheet = pd.read_excel(file)
+    rate = float(sheet['taxa'].dropna().iloc[0])
+    table = str(sheet['tábua'].dropna().iloc[0]).strip()
+    gender = str(sheet['sexo'].dropna().iloc[0]).strip()
+    #the spreadsheet table names are not padded as in life_tables.xlsx
+    names = [tb for tb in df['table'].unique() if tb.strip() == table]
+    if not names:
+        raise Exception('Tábua {} da planilha não encontrada'.format(table))
+
+    cases = []
+    for column, contract in SHEET_CONTRACTS.items():
+        expected = sheet[column].values.astype(np.float64)
+        cases.append({'name': 'sheet ' + column, 'table': names[0], 'gender': gender,
+                      'rate': rate, 'contract': dict(contract, **SHEET_PAYMENT),
+                      'ages': sheet['age'].values.astype(np.int64),
+                      'expected': None if column in SHEET_UNCHECKED else
+                      np.where(expected == 0, np.nan, expected)})
+    return cases
+
+
+def generated_cases(df, tables=None, rate=DEF_RATE, step=AGE_STEP):
+    '''
+        Cases of CONTRACTS on the tables (default all of df) and genders
+    '''
+    keys = df[['table', 'gender']].drop_duplicates().values.tolist()
+    cases = []
+    for table, gender in keys:
+        if tables is not None and table not in tables:
+            continue
+        max_age = int(df.loc[(df['table'] == table) & (df['gender'] == gender), 'age'].max())
+        for name, contract in CONTRACTS.items():
+            cases.append({'name': name, 'table': table, 'gender': gender, 'rate': rate,
+                          'contract': contract, 'ages': case_ages(max_age, contract, step),
+                          'expected': None})
+    return cases
+
+
+def case_durations(handler, case):
+    '''
+        Durations of the reserves of a case, from 0 to the end of the table for the youngest
+        contract
+    '''
+    return np.arange(0, int(handler.max_age) - int(case['ages'].min()) + 2)
+
+
+def scalar_path(handler, case, durations):
+    '''
+        Results of the scalar InsuranceHandler, nan where it raises or gives no value
+    '''
+    ages = case['ages']
+    result = {name: np.full(len(ages), np.nan) for name in ['pup', 'pna']}
+    for kind in RESERVE_KINDS:
+        result[kind] = np.full((len(ages), len(durations)), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for j, age in enumerate(ages):
+            try:
+                handler.calc_premium(age=int(age), **case['contract'])
+            except Exception:
+                continue
+            result['pup'][j] = handler.pup
+            result['pna'][j] = handler.pna
+            for t in durations:
+                for kind in RESERVE_KINDS:
+                    try:
+                        value = handler.calc_reserves(int(t), kind)
+                    except Exception:
+                        continue
+                    if value is not None:
+                        result[kind][j, t] = value
+    return result
+
+
+def batch_path(handler, case, durations, backend):
+    '''
+        Results of the vectorized engine with a backend of the kernels, nan where not valid
+    '''
+    comm = commutations(handler)
+    contracts = dict(case['contract'], age=case['ages'])
+    premium = calc_premium_batch(comm, contracts)
+    valid = premium['valid']
+    result = {name: np.where(valid, premium[name], np.nan) for name in ['pup', 'pna']}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for kind in RESERVE_KINDS:
+            reserves, valid_ = reserve_curves(comm, contracts, premium['pna'], durations, kind,
+                                              backend)
+            result[kind] = np.where(valid[:, None] & valid_, reserves, np.nan)
+    return result
+
+
+def run_path(path, handler, case, durations):
+    if path == 'scalar':
+        return scalar_path(handler, case, durations)
+    return batch_path(handler, case, durations, path)
+
+
+def compare_values(name, values, expected, ages, rtol, atol, checked=None):
+    '''
+        Compares the values of a path with the expected ones, nan (not calculated) must match
+        Input:
+            values, expected: np.array contracts or contracts x durations
+            ages: issue ages of the contracts, used in the messages --> np.array
+            checked: mask of the values compared, default all
+        Output:
+            (number of values compared, list of error messages)
+    '''
+    with np.errstate(invalid='ignore'):
+        values = np.where(np.isfinite(values), values, np.nan)
+        expected = np.where(np.isfinite(expected), expected, np.nan)
+        calculated = ~np.isnan(values)
+        wrong = calculated != ~np.isnan(expected)
+        wrong |= calculated & ~(np.abs(values - expected) <= atol + rtol*np.abs(expected))
+    if checked is not None:
+        wrong &= checked
+    position = lambda index: 'x={}'.format(ages[index[0]]) + \
+        ''.join(' t={}'.format(i) for i in index[1:])
+    errors = ['{}[{}]: {:.17g} != {:.17g}'.format(name, position(index), values[index],
+                                                   expected[index])
+              for index in zip(*np.nonzero(wrong))]
+    return int(np.size(values) if checked is None else checked.sum()), errors
+
+
+def pure_endowments(handler, case, durations):
+    '''
+        Pure endowments tEx of the contracts of a case at the durations (0 beyond the table)
+    '''
+    lx = handler.df_['lx'].values.astype(np.float64)
+    x = case['ages'][:, None] + durations[None, :]
+    inside = x < len(lx)
+    survival = np.where(inside, lx[np.minimum(x, len(lx) - 1)], 0.)/lx[case['ages']][:, None]
+    return survival/(1 + handler.last_i_rate_used)**durations[None, :]
+
+
+def compare_case(handler, case, durations, results, reference, rtol, atol):
+    '''
+        Compares the results of the paths with the reference path and the spreadsheet
+        Output:
+            (number of values compared, list of error messages)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conditioned = pure_endowments(handler, case, durations) >= MIN_PURE_ENDOWMENT
+    checked = 0
+    errors = []
+    label = '{} {}/{}'.format(case['name'], case['table'].strip(), case['gender'])
+    for path, result in results.items():
+        if path == reference:
+            continue
+        for name in ['pup', 'pna'] + RESERVE_KINDS:
+            mask = conditioned if name == 'retrosp' else None
+            checked_, errors_ = compare_values(name, result[name], results[reference][name],
+                                               case['ages'], rtol, atol, mask)
+            checked += checked_
+            errors += ['{} {} {}'.format(path, label, error) for error in errors_]
+    if case['expected'] is not None:
+        checked_, errors_ = compare_values('pup', results[reference]['pup'], case['expected'],
+                                           case['ages'], rtol, atol)
+        checked += checked_
+        errors += ['simu.xlsx {} {}'.format(label, error) for error in errors_]
+    return checked, errors
+
+
+def run_corpus(df, cases, paths, reference='scalar', repeat=1, rtol=DEF_RTOL, atol=DEF_ATOL):
+    '''
+        Runs the cases on the paths, comparing their results and recording their times
+        Input:
+            df: life tables --> pandas dataframe
+            cases: see sheet_cases and generated_cases
+            paths: scalar or backends of kernels.py --> list of str
+            reference: path the others are compared with --> str
+            repeat: runs of each path per case, the fastest one is recorded --> int
+            rtol, atol: tolerances --> float
+        Output:
+            (timings --> pandas dataframe with case, table, gender, path, contracts, values,
+             seconds and errors, list of error messages)
+    '''
+    paths = [reference] + [path for path in paths if path != reference]
+    handler = InsuranceHandler(df)
+    rows = []
+    errors = []
+    for case in cases:
+        handler.select_table(case['table'], case['gender'])
+        handler.gen_commutations(case['rate'])
+        durations = case_durations(handler, case)
+        results = {}
+        seconds = {}
+        for path in paths:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                results[path] = run_path(path, handler, case, durations)
+                elapsed = time.perf_counter() - start
+                seconds[path] = min(seconds.get(path, np.inf), elapsed)
+        checked, errors_ = compare_case(handler, case, durations, results, reference, rtol,
+                                        atol)
+        errors += errors_
+        for path in paths:
+            rows.append({'case': case['name'], 'table': case['table'],
+                         'gender': case['gender'], 'path': path,
+                         'contracts': len(case['ages']), 'values': checked,
+                         'seconds': seconds[path],
+                         'errors': sum(error.startswith(path + ' ') for error in errors_)})
+    return pd.DataFrame(rows), errors
+
+
+def summary(timings, reference='scalar'):
+    '''
+        Total time of each path and its speedup over the reference path
+    '''
+    total = timings.groupby('path', sort=False)[['contracts', 'seconds', 'errors']].sum()
+    total['speedup'] = total.loc[reference, 'seconds']/total['seconds']
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the regression and benchmark corpus')
+    parser.add_argument('--path', action='append', choices=['scalar'] + BACKENDS,
+                        help='path to run, default scalar and the installed compiled backends')
+    parser.add_argument('--table', action='append', help='table of the generated cases')
+    parser.add_argument('--rate', type=float, default=DEF_RATE)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--quick', action='store_true', help='fewer issue ages per case')
+    parser.add_argument('--rtol', type=float, default=DEF_RTOL)
+    parser.add_argument('--atol', type=float, default=DEF_ATOL)
+    parser.add_argument('--out', help='csv file of the timings')
+    args = parser.parse_args(argv)
+
+    paths = args.path or ['scalar', 'numpy'] + (['numba'] if numba is not None else [])
+    df = pd.read_excel(DATA_PATH.joinpath("life_tables.xlsx"))
+    cases = sheet_cases(df) + generated_cases(df, args.table, args.rate,
+                                              QUICK_AGE_STEP if args.quick else AGE_STEP)
+    timings, errors = run_corpus(df, cases, paths, repeat=args.repeat, rtol=args.rtol,
+                                 atol=args.atol)
+    if args.out:
+        timings.to_csv(args.out, index=False)
+
+    for error in errors:
+        print(error)
+    print(summary(timings).to_string())
+    checked = timings.loc[timings['path'] == timings['path'].iloc[0], 'values'].sum()
+    print('{} cases, {} values checked, {} errors'.format(len(cases), int(checked), len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
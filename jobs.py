@@ -0,0 +1,136 @@
+'''
+    Background jobs for the heavy calculations of the app.
+
+    Heavy work (surfaces, table comparisons, scenario runs, portfolio valuations) is submitted
+    to a JobQueue and runs outside the request thread. The browser polls the job status with
+    a dcc.Interval and gets the result when it is ready. Jobs are identified by a key built
+    from their parameters, so submitting the same calculation again reuses the running or
+    finished job instead of calculating it twice.
+
+    The queue lives in the worker process, so with several gunicorn workers the polling
+    requests must reach the worker that received the job (sticky sessions or a single worker
+    with threads).
+'''
+import uuid
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+
+class Job():
+    '''
+        State of a submitted job
+    '''
+    def __init__(self, job_id, key):
+        self.id = job_id
+        self.key = key
+        self.state = PENDING
+        #fraction of the work done, from 0 to 1
+        self.progress = 0.
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.future = None
+
+    def set_progress(self, progress):
+        self.progress = min(max(float(progress), 0.), 1.)
+
+
+class JobQueue():
+    '''
+        Executes jobs in a thread pool and keeps the results of the last ones
+    '''
+    def __init__(self, max_workers=2, max_jobs=64, executor=None):
+        '''
+            Input:
+                max_workers: number of threads, used when executor is not given --> int
+                max_jobs: number of jobs kept, the oldest finished jobs are dropped --> int
+                executor: concurrent.futures executor, default ThreadPoolExecutor
+        '''
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def __run__(self, job, func, args, kwargs):
+        job.state = RUNNING
+        try:
+            job.result = func(*args, progress=job.set_progress, **kwargs)
+            job.progress = 1.
+            job.state = DONE
+        except Exception as e:
+            job.error = '{}: {}'.format(type(e).__name__, e)
+            job.traceback = traceback.format_exc()
+            job.state = ERROR
+
+    def __drop_old__(self):
+        finished = [job for job in self.jobs.values() if job.state in (DONE, ERROR)]
+        while len(self.jobs) > self.max_jobs and finished:
+            job = finished.pop(0)
+            del self.jobs[job.id]
+            if self.keys.get(job.key) == job.id:
+                del self.keys[job.key]
+
+    def submit(self, func, *args, key=None, **kwargs):
+        '''
+            Submits a job
+            Input:
+                func: function executed, receives the keyword argument progress, a function
+                      used to report the fraction of the work done
+                args, kwargs: arguments of func
+                key: identifies the calculation, jobs with the same key are reused --> str
+            Output:
+                job id --> str
+        '''
+        with self.lock:
+            if key is not None and key in self.keys:
+                job = self.jobs[self.keys[key]]
+                if job.state != ERROR:
+                    return job.id
+
+            job = Job(uuid.uuid4().hex, key)
+            self.jobs[job.id] = job
+            if key is not None:
+                self.keys[key] = job.id
+            self.__drop_old__()
+
+        job.future = self.executor.submit(self.__run__, job, func, args, kwargs)
+        return job.id
+
+    def get(self, job_id):
+        '''
+            Returns the Job or None when the id is unknown (or already dropped)
+        '''
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self, job_id):
+        '''
+            Returns a dict with the state, progress and error of a job
+        '''
+        job = self.get(job_id)
+        if job is None:
+            return {'state': None, 'progress': 0., 'error': 'Job não encontrado'}
+        return {'state': job.state, 'progress': job.progress, 'error': job.error}
+
+    def result(self, job_id):
+        '''
+            Returns the result of a finished job, None otherwise
+        '''
+        job = self.get(job_id)
+        return job.result if job is not None and job.state == DONE else None
+
+
+def job_key(*params):
+    '''
+        Key of a job from its parameters
+    '''
+    return hashlib.sha1(repr(params).encode()).hexdigest()
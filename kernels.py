@@ -0,0 +1,392 @@
+'''
+    Compiled kernels for the branchy reserve calculations.
+
+    The prospective and retrospective reserves (__calc_prov_prosp__, __calc_prov_retro__) and
+    the nonforfeiture values (__calc_paidup__) branch on the evaluation time t against the
+    deferral and term of the benefits (n, m) and of the payments (i, k). The loops of this
+    module follow those branches one contract and duration at a time, as the scalar engine
+    does, and are compiled by numba when it is installed. The numpy backend applies the same
+    branches as masks over the whole batch (batch.py), and gives the same values bit for bit.
+
+    Backends:
+        numba       compiled loops, selected automatically when numba is installed
+        numpy       vectorized masks of batch.py, the default without numba
+        python      the loops without compilation, only useful to check them
+
+    Contracts go to the loops as typed arrays (batch.typed_contracts), with the products as
+    their index in batch.PRODUCT_CODES and the commutations as 2-D arrays (one row for ultimate
+    tables, the issue age rows for select tables).
+'''
+import numpy as np
+from batch import contract_columns, typed_contracts, select_rows, PRODUCT_CODES
+from batch import calc_reserve_curves_batch, calc_nonforfeiture_batch
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ['numba', 'numpy', 'python']
+DEF_BACKEND = 'numba' if numba is not None else 'numpy'
+
+#product codes of the loops
+CODE_a, CODE_A, CODE_d, CODE_D = [PRODUCT_CODES.index(prod) for prod in ['a', 'A', 'd', 'D']]
+#distance of infinite values in the extended term search
+MAX_DISTANCE = np.finfo(np.float64).max
+
+
+def jit(func):
+    '''
+        Compiles a loop with numba when it is installed. Divisions by zero follow numpy (inf
+        or nan instead of an exception), as in the other backends.
+    '''
+    if numba is None:
+        return func
+    return numba.njit(cache=True, nogil=True, error_model='numpy')(func)
+
+
+@jit
+def clip_index(index, max_age):
+    return min(max(index, 0), max_age)
+
+
+@jit
+def pup_value(Dx, Nx, Mx, max_age, row, x, n, m, whole, antecip, prod):
+    '''
+        __calc_pup__ of one contract, (nan, False) for the combinations the engine rejects
+        (see batch.pup_indexes)
+    '''
+    add_one = 0 if antecip and prod == CODE_a else 1
+    m_ = max_age - x - n - add_one if whole else m
+
+    #__verify_prod__
+    criteria = x + n + (0 if whole else m) - (1 - add_one)
+    if prod == CODE_d and n > 0:
+        return np.nan, False
+    if (prod == CODE_d or prod == CODE_D) and whole:
+        return np.nan, False
+    if criteria > max_age:
+        return np.nan, False
+
+    start = x + n
+    end = x + n + m_
+    pure = x + m_
+    a_start = x + n + add_one
+    a_end = x + n + m_ + add_one
+    if prod == CODE_a:
+        used = max(a_start, a_end)
+    elif prod == CODE_d:
+        used = pure
+    else:
+        used = max(start, end)
+    lowest = pure if prod == CODE_d else start
+    if x < 0 or x > max_age or used > max_age or lowest < 0:
+        return np.nan, False
+
+    remove_term = 0. if whole else 1.
+    if prod == CODE_D:
+        num = Mx[row, clip_index(start, max_age)] - Mx[row, clip_index(end, max_age)] + \
+            Dx[row, clip_index(end, max_age)]
+    elif prod == CODE_d:
+        num = Dx[row, clip_index(pure, max_age)]
+    elif prod == CODE_A:
+        num = Mx[row, clip_index(start, max_age)] - \
+            remove_term*Mx[row, clip_index(end, max_age)]
+    else:
+        num = Nx[row, clip_index(a_start, max_age)] - \
+            remove_term*Nx[row, clip_index(a_end, max_age)]
+    return num/Dx[row, clip_index(x, max_age)], True
+
+
+@jit
+def prosp_parts(Dx, Nx, Mx, max_age, row, x, n, m, whole_m, antecip_benef, prod,
+                i, k, whole_k, antecip_pay, t):
+    '''
+        Values of the benefits (A) and payments (a) of __calc_prov_prosp__ at t
+        Output:
+            (A, a, valid)
+    '''
+    adjust_pay = 1 if antecip_pay else 0
+    adjust_benef = 1 if antecip_benef and prod == CODE_a else 0
+    valid = True
+
+    #payment
+    a = 0.
+    if 0 < t <= i - adjust_pay:
+        a, ok = pup_value(Dx, Nx, Mx, max_age, row, x + t, max(i - t, 0), k, whole_k,
+                          antecip_pay, CODE_a)
+        valid = valid and ok
+    elif i - adjust_pay < t:
+        a, ok = pup_value(Dx, Nx, Mx, max_age, row, x + t, 0, max(i + k - t, 0), whole_k,
+                          antecip_pay, CODE_a)
+        valid = valid and ok
+
+    #benefit
+    A = 0.
+    if 0 < t <= n - adjust_benef:
+        A, ok = pup_value(Dx, Nx, Mx, max_age, row, x + t, max(n - t, 0), m, whole_m,
+                          antecip_benef, prod)
+        valid = valid and ok
+    elif n - adjust_benef < t and (whole_m or t <= n + m - adjust_benef):
+        A, ok = pup_value(Dx, Nx, Mx, max_age, row, x + t, 0, max(n + m - t, 0), whole_m,
+                          antecip_benef, prod)
+        valid = valid and ok
+
+    #adjustment for points with zero reserves
+    if t == 0 or (t < n and t < i) or \
+            (not whole_m and not whole_k and t > m + n and t > k + i):
+        A = 0.
+        a = 0.
+    return A, a, valid
+
+
+@jit
+def prosp_loop(Dx, Nx, Mx, max_age, rows, x, n, m, whole_m, antecip_benef, prod,
+               i, k, whole_k, antecip_pay, pna, durations):
+    '''
+        Prospective reserves of contracts x durations
+    '''
+    reserves = np.full((len(x), len(durations)), np.nan)
+    valid = np.zeros((len(x), len(durations)), dtype=np.bool_)
+    for j in range(len(x)):
+        for d in range(len(durations)):
+            A, a, ok = prosp_parts(Dx, Nx, Mx, max_age, rows[j], x[j], n[j], m[j],
+                                   whole_m[j], antecip_benef[j], prod[j], i[j], k[j],
+                                   whole_k[j], antecip_pay[j], durations[d])
+            if ok:
+                reserves[j, d] = A - pna[j]*a
+                valid[j, d] = True
+    return reserves, valid
+
+
+@jit
+def retro_loop(Dx, Nx, Mx, max_age, rows, x, n, m, whole_m, antecip_benef, prod,
+               i, k, whole_k, antecip_pay, pna, durations):
+    '''
+        Retrospective reserves (__calc_prov_retro__) of contracts x durations
+    '''
+    reserves = np.full((len(x), len(durations)), np.nan)
+    valid = np.zeros((len(x), len(durations)), dtype=np.bool_)
+    for j in range(len(x)):
+        adjust_pay = 1 if antecip_pay[j] else 0
+        adjust_benef = 1 if antecip_benef[j] and prod[j] == CODE_a else 0
+        for d in range(len(durations)):
+            t = durations[d]
+            row = rows[j]
+            #present value factor
+            E, ok = pup_value(Dx, Nx, Mx, max_age, row, x[j], 0, t, False, antecip_pay[j],
+                              CODE_d)
+            E = 1/E
+
+            #payments made until t
+            a = 0.
+            if i[j] - adjust_pay < t:
+                term = t - i[j] if whole_k[j] else min(t - i[j], k[j])
+                a, ok_a = pup_value(Dx, Nx, Mx, max_age, row, x[j], i[j], term, False,
+                                    antecip_pay[j], CODE_a)
+                ok = ok and ok_a
+
+            #benefits paid until t
+            A = 0.
+            if n[j] - adjust_benef < t:
+                term = t - n[j] if whole_m[j] else min(t - n[j], m[j])
+                ended = not whole_m[j] and t > m[j] + n[j]
+                if prod[j] == CODE_D and not ended:
+                    A, ok_A = pup_value(Dx, Nx, Mx, max_age, row, x[j], n[j], term, False,
+                                        antecip_benef[j], CODE_A)
+                    ok = ok and ok_A
+                elif not (prod[j] == CODE_d and (whole_m[j] or t <= m[j])):
+                    A, ok_A = pup_value(Dx, Nx, Mx, max_age, row, x[j], n[j], term, False,
+                                        antecip_benef[j], prod[j])
+                    ok = ok and ok_A
+
+            #adjustment for points with zero reserves
+            if t == 0 or (t < n[j] and t < i[j]) or (not whole_m[j] and not whole_k[j] and
+                                                    t > m[j] + n[j] and t > k[j] + i[j]):
+                A = 0.
+                a = 0.
+            if ok:
+                reserves[j, d] = (pna[j]*a - A)*E
+                valid[j, d] = True
+    return reserves, valid
+
+
+@jit
+def extended_term(Dx, Nx, Mx, max_age, row, x, n, limit, antecip, prod, V):
+    '''
+        Term of the extended insurance (see batch.extended_term_batch)
+    '''
+    position = 0
+    term = 0
+    best = np.inf
+    for period in range(1, limit):
+        value, ok = pup_value(Dx, Nx, Mx, max_age, row, x, n, period, False, antecip, prod)
+        if not ok:
+            continue
+        position += 1
+        distance = abs(V - value)
+        if np.isinf(distance):
+            distance = MAX_DISTANCE
+        #the first nan is kept, as np.argmin does
+        if np.isnan(best):
+            continue
+        if np.isnan(distance) or distance < best:
+            best = distance
+            term = position
+    return term
+
+
+@jit
+def nonforfeiture_loop(Dx, Nx, Mx, pDx, pNx, pMx, max_age, rows, x, n, m, whole_m,
+                       antecip_benef, prod, i, k, whole_k, antecip_pay, pna, durations):
+    '''
+        Nonforfeiture values (__calc_paidup__) of contracts x durations, the commutations
+        starting with p are of the pricing rate
+    '''
+    shape = (len(x), len(durations))
+    paidup = np.full(shape, np.nan)
+    term = np.full(shape, np.nan)
+    endowment = np.full(shape, np.nan)
+    valid = np.zeros(shape, dtype=np.bool_)
+    for j in range(len(x)):
+        for d in range(len(durations)):
+            t = durations[d]
+            row = rows[j]
+            A, a, ok = prosp_parts(Dx, Nx, Mx, max_age, row, x[j], n[j], m[j],
+                                   whole_m[j], antecip_benef[j], prod[j], i[j], k[j],
+                                   whole_k[j], antecip_pay[j], t)
+            V = A - pna[j]*a
+            window = i[j] < t and (whole_k[j] or t < k[j])
+            if not ok:
+                continue
+            valid[j, d] = True
+            if not window:
+                paidup[j, d] = 0.
+                term[j, d] = 0.
+                continue
+            paidup[j, d] = V/A
+            term[j, d] = 0.
+            if prod[j] == CODE_d:
+                continue
+
+            search = prod[j]
+            limit = max_age - t if whole_m[j] else min(m[j], max_age - t)
+            if prod[j] == CODE_D:
+                search = CODE_A
+                if t <= n[j]:
+                    insurance, ok_ins = pup_value(pDx, pNx, pMx, max_age, row, x[j] + t,
+                                                  max(n[j] - t, 0), m[j], False,
+                                                  antecip_benef[j], CODE_A)
+                else:
+                    insurance, ok_ins = pup_value(pDx, pNx, pMx, max_age, row, x[j] + t, 0,
+                                                  m[j] - t, False, antecip_benef[j], CODE_A)
+                if not ok_ins:
+                    insurance = 0.
+                if V >= insurance:
+                    pure, ok_pure = pup_value(pDx, pNx, pMx, max_age, row, x[j] + t, 0,
+                                              m[j] + n[j] - t, False, antecip_benef[j], CODE_d)
+                    if not ok_pure:
+                        pure = 1.
+                    term[j, d] = m[j]
+                    endowment[j, d] = (V - insurance)/pure
+                    continue
+            term[j, d] = extended_term(pDx, pNx, pMx, max_age, row, x[j] + t,
+                                       min(n[j] - t, 0), limit, antecip_benef[j], search, V)
+    return paidup, term, endowment, valid
+
+
+def select_backend(backend=None):
+    '''
+        Backend of the kernels, default the fastest one installed
+    '''
+    backend = DEF_BACKEND if backend is None else backend
+    if backend not in BACKENDS:
+        raise Exception('backend must be one of {}'.format(BACKENDS))
+    if backend == 'numba' and numba is None:
+        raise Exception('O backend numba requer o pacote numba')
+    return backend
+
+
+def loop_arguments(comm, contracts, pna, durations, rows=None):
+    '''
+        Arguments of the loops: 2-D commutations, typed contract columns and product codes
+    '''
+    Dx, Nx, Cx, Mx, max_age = comm
+    typed = typed_contracts(contract_columns(contracts))
+    if np.ndim(Dx) == 1:
+        Dx, Nx, Mx = Dx[None, :], Nx[None, :], Mx[None, :]
+        rows = np.zeros(len(typed), dtype=np.int64)
+    elif rows is None:
+        rows = select_rows(comm, typed['age'])
+    prod = np.select([typed['prod'] == code for code in PRODUCT_CODES],
+                     np.arange(len(PRODUCT_CODES)), -1)
+    columns = [np.ascontiguousarray(typed[name]) for name in
+               ['age', 'dif_benef', 'term_benef', 'whole_benef', 'antecip_benef']] + [prod] + \
+        [np.ascontiguousarray(typed[name]) for name in
+         ['dif_pay', 'term_pay', 'whole_pay', 'antecip_pay']]
+    pna = np.broadcast_to(np.asarray(pna, dtype=np.float64), (len(typed),)).copy()
+    durations = np.asarray(durations, dtype=np.int64)
+    return (np.ascontiguousarray(Dx, dtype=np.float64), np.ascontiguousarray(Nx, dtype=np.float64),
+            np.ascontiguousarray(Mx, dtype=np.float64), int(max_age),
+            np.asarray(rows, dtype=np.int64)), columns + [pna, durations]
+
+
+def reserve_curves(comm, contracts, pna, durations, kind='prosp', backend=None):
+    '''
+        Reserve curves of a batch of contracts (see batch.calc_reserve_curves_batch)
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) of the reserves rate
+            contracts: contract columns (see batch.contract_columns)
+            pna: net level premiums of the contracts --> np.array
+            durations: evaluation times --> np.array of int
+            kind: prosp or retrosp --> str
+            backend: numba, numpy or python, default the fastest one installed --> str
+        Output:
+            (reserves, valid) --> (np.array contracts x durations, np.array of bool)
+    '''
+    backend = select_backend(backend)
+    if backend == 'numpy':
+        return calc_reserve_curves_batch(comm, contracts, pna, durations, kind)
+    if kind not in ['prosp', 'retrosp']:
+        raise Exception('kind must be one of {}'.format(['prosp', 'retrosp']))
+    tables, columns = loop_arguments(comm, contracts, pna, durations)
+    loop = prosp_loop if kind == 'prosp' else retro_loop
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return loop(*tables, *columns)
+
+
+def nonforfeiture_curves(comm, contracts, pna, durations, price_comm=None, backend=None):
+    '''
+        Nonforfeiture values of a batch of contracts at each duration (see
+        batch.calc_nonforfeiture_batch)
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) of the reserves rate
+            contracts: contract columns (see batch.contract_columns)
+            pna: net level premiums of the contracts --> np.array
+            durations: evaluation times --> np.array of int
+            price_comm: commutations of the pricing rate, default comm
+            backend: numba, numpy or python, default the fastest one installed --> str
+        Output:
+            dict with the arrays (contracts x durations) paidup, extended_term, extended_value
+            and valid
+    '''
+    backend = select_backend(backend)
+    price_comm = comm if price_comm is None else price_comm
+    durations = np.asarray(durations, dtype=np.int64)
+    if backend == 'numpy':
+        c = contract_columns(contracts)
+        size = len(c['age'])
+        repeated = {name: np.repeat(values, len(durations)) for name, values in c.items()}
+        pna = np.repeat(np.broadcast_to(np.asarray(pna, dtype=np.float64), (size,)),
+                        len(durations))
+        values = calc_nonforfeiture_batch(comm, repeated, pna, np.tile(durations, size),
+                                          price_comm)
+        return {name: array.reshape(size, len(durations)) for name, array in values.items()}
+
+    tables, columns = loop_arguments(comm, contracts, pna, durations)
+    prices, _ = loop_arguments(price_comm, contracts, pna, durations)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        paidup, term, endowment, valid = nonforfeiture_loop(*tables[:3], *prices[:3],
+                                                            *tables[3:], *columns)
+    return {'paidup': paidup, 'extended_term': term, 'extended_value': endowment,
+            'valid': valid}
@@ -0,0 +1,454 @@
+'''
+    Life table loaders.
+
+    Besides data/life_tables.xlsx, tables may be read from csv, parquet (requires pyarrow), SOA
+    XTbML-style xml files or a local SQLite database (table life_tables). Every reader returns
+    rows in the format of life_tables.xlsx: table, gender, age, qx, lx, dx and, for select
+    tables, duration (see selection.py). Tables given only by qx are built from RADIX lives.
+
+    Each table is normalized (sorted by age, qx, lx and dx filled) and validated:
+        - ages contiguous and without repetitions;
+        - 0 <= qx <= 1 and lx >= 0, lx not increasing;
+        - dx = lx - lx+1, within DEF_RTOL of the radix.
+    TableLibrary is a lazy registry with the interface of storage.TableStore (keys, info and
+    table): it lists the tables of the sources on creation and reads, validates and hashes a
+    table on its first use. Listing reads only metadata: the TableName of xml files, a query of
+    SQLite files, the key columns of parquet files. csv and Excel files have no metadata, so
+    their keys are scanned once and cached by file stamp (modification time and size) in
+    KEYS_PATH. The content hash (storage.content_hash) is the key of the commutations cache, so
+    cached values follow the content and not the table name.
+
+    Run "python loaders.py sources..." to validate tables, with --store to write them to a
+    TableStore.
+'''
+import json
+import hashlib
+import argparse
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+from selection import split_select, SELECT_COLUMN
+from storage import content_hash, TableStore, STORE_DTYPES
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+COLUMNS = ['table', 'gender', 'age', 'qx', 'lx', 'dx']
+#lives at the first age of the tables built from qx
+RADIX = 1000000.
+#tolerance of dx = lx - lx+1, relative to the radix
+DEF_RTOL = 1e-9
+#table of the life tables in SQLite databases
+SQLITE_TABLE = 'life_tables'
+XTBML_SUFFIXES = ['.xml', '.xtbml']
+GENDER_NAMES = {'female': 'F', 'feminino': 'F', 'male': 'M', 'masculino': 'M'}
+#keys of the csv and Excel sources, by file stamp
+KEYS_PATH = pathlib.Path(tempfile.gettempdir()).joinpath("actuarial_math_tables")
+
+
+def read_frame(path, columns=None):
+    '''
+        Reads a csv, parquet or Excel file with the columns of life_tables.xlsx
+        Input:
+            path: file path --> str or pathlib.Path
+            columns: columns read, default all --> list of str
+        Output:
+            pandas dataframe
+    '''
+    path = pathlib.Path(path)
+    suffix = path.suffix.lower()
+    if suffix == '.csv':
+        return pd.read_csv(path, usecols=columns, float_precision='round_trip')
+    if suffix == '.parquet':
+        if pyarrow is None:
+            raise Exception('Leitura de parquet requer o pacote pyarrow')
+        return pd.read_parquet(path, columns=columns)
+    if suffix in ['.xlsx', '.xls']:
+        return pd.read_excel(path, usecols=columns)
+    raise Exception('Formato não suportado: {}'.format(path.name))
+
+
+def xml_name(element):
+    '''
+        Tag of an element without the namespace
+    '''
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def xml_child(element, name):
+    '''
+        First child of an element with a tag, ignoring namespaces
+    '''
+    for child in element:
+        if xml_name(child) == name:
+            return child
+    return None
+
+
+def xtbml_identity(root, gender=None):
+    '''
+        (table, gender) of a XTbML document, the gender is taken from the table name when
+        not given
+    '''
+    classification = xml_child(root, 'ContentClassification')
+    name = xml_child(classification, 'TableName') if classification is not None else None
+    return table_identity(name.text if name is not None else None, gender)
+
+
+def table_identity(name, gender=None):
+    '''
+        (table, gender) of a XTbML TableName, the gender is taken from the name when not given
+    '''
+    if not (name or '').strip():
+        raise Exception('Arquivo XTbML sem TableName')
+    table = name.strip()
+    if gender is None:
+        words = table.lower().replace('-', ' ').split()
+        genders = {GENDER_NAMES[word] for word in words if word in GENDER_NAMES}
+        if len(genders) != 1:
+            raise Exception('Sexo da tábua {} não identificado'.format(table))
+        gender = genders.pop()
+    return table, gender
+
+
+def xtbml_keys(path):
+    '''
+        (table, gender) of a XTbML file, parsing it only up to the TableName
+    '''
+    for event, element in ET.iterparse(str(path)):
+        if xml_name(element) == 'TableName':
+            return [table_identity(element.text)]
+    raise Exception('Arquivo XTbML sem TableName')
+
+
+def read_xtbml(path, gender=None):
+    '''
+        Reads a SOA XTbML-style file: one Table with one axis (age) holds the ultimate rates and
+        one with two axes (issue age, duration) the select rates. Values are scaled by
+        10**-ScalingFactor.
+        Input:
+            path: file path --> str or pathlib.Path
+            gender: gender of the table, default from the table name --> str
+        Output:
+            pandas dataframe with table, gender, age, qx and, for select tables, duration
+    '''
+    root = ET.parse(path).getroot()
+    table, gender = xtbml_identity(root, gender)
+
+    rows = []
+    for element in root:
+        if xml_name(element) != 'Table':
+            continue
+        meta = xml_child(element, 'MetaData')
+        scaling = xml_child(meta, 'ScalingFactor') if meta is not None else None
+        scale = 10.**-int(scaling.text) if scaling is not None and scaling.text else 1.
+        values = xml_child(element, 'Values')
+        axis = xml_child(values, 'Axis') if values is not None else None
+        if axis is None:
+            continue
+        if xml_child(axis, 'Axis') is None:
+            for y in axis:
+                if (y.text or '').strip():
+                    rows.append({'age': int(y.get('t')), 'qx': float(y.text)*scale})
+            continue
+        for inner in axis:
+            if xml_name(inner) != 'Axis':
+                continue
+            for y in inner:
+                if (y.text or '').strip():
+                    rows.append({'age': int(inner.get('t')), SELECT_COLUMN: int(y.get('t')),
+                                 'qx': float(y.text)*scale})
+    if not rows:
+        raise Exception('Arquivo XTbML sem valores: {}'.format(pathlib.Path(path).name))
+    return pd.DataFrame(rows).assign(table=table, gender=gender)
+
+
+def read_sqlite(path, table=None, gender=None, name=SQLITE_TABLE):
+    '''
+        Reads life tables from a SQLite database
+        Input:
+            path: database path --> str or pathlib.Path
+            table, gender: table read, default all --> str
+            name: name of the SQL table with the columns of life_tables.xlsx --> str
+        Output:
+            pandas dataframe
+    '''
+    query = 'SELECT * FROM "{}"'.format(name)
+    params = []
+    if table is not None:
+        query += ' WHERE "table" = ? AND gender = ?'
+        params = [table, gender]
+    with sqlite3.connect(str(path)) as connection:
+        return pd.read_sql_query(query, connection, params=params)
+
+
+def scan_keys(path):
+    '''
+        (table, gender) of a csv or Excel file, reading only the key columns (Excel files are
+        streamed by openpyxl in read only mode)
+    '''
+    path = pathlib.Path(path)
+    if path.suffix.lower() != '.xlsx':
+        keys = read_frame(path, ['table', 'gender']).drop_duplicates()
+        return list(keys.itertuples(index=False, name=None))
+
+    import openpyxl
+    workbook = openpyxl.load_workbook(str(path), read_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        if 'table' not in header or 'gender' not in header:
+            raise Exception('Colunas table e gender ausentes em {}'.format(path.name))
+        columns = [header.index('table'), header.index('gender')]
+        keys = (tuple(row[column] for column in columns) for row in rows)
+        return list(dict.fromkeys(key for key in keys if None not in key))
+    finally:
+        workbook.close()
+
+
+def cached_keys(path, keys_path=KEYS_PATH):
+    '''
+        Keys of a csv or Excel file, scanned once for each file stamp (see scan_keys)
+    '''
+    path = pathlib.Path(path).resolve()
+    stat = path.stat()
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    cache = pathlib.Path(keys_path).joinpath(hashlib.sha1(str(path).encode()).hexdigest() +
+                                             '.json')
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached['stamp'] == stamp:
+            return [tuple(key) for key in cached['keys']]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    keys = scan_keys(path)
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache, 'w') as f:
+            json.dump({'path': str(path), 'stamp': stamp, 'keys': keys}, f)
+    except OSError:
+        pass
+    return keys
+
+
+def list_tables(path):
+    '''
+        (table, gender) of the tables in a source file, from its metadata (see the module
+        docstring)
+    '''
+    path = pathlib.Path(path)
+    suffix = path.suffix.lower()
+    if suffix in XTBML_SUFFIXES:
+        return xtbml_keys(path)
+    if suffix in ['.db', '.sqlite', '.sqlite3']:
+        with sqlite3.connect(str(path)) as connection:
+            keys = connection.execute('SELECT DISTINCT "table", gender FROM "{}"'.
+                                      format(SQLITE_TABLE)).fetchall()
+        return [tuple(key) for key in keys]
+    if suffix == '.parquet':
+        keys = read_frame(path, ['table', 'gender']).drop_duplicates()
+        return list(keys.itertuples(index=False, name=None))
+    return cached_keys(path)
+
+
+def normalize_table(df_, rtol=DEF_RTOL):
+    '''
+        Normalizes and validates the rows of one table and gender (see the module docstring)
+        Input:
+            df_: rows of the table, with qx, lx or both (dx optional) --> pandas dataframe
+            rtol: tolerance of dx = lx - lx+1, relative to the radix --> float
+        Output:
+            pandas dataframe with the ultimate rows (table, gender, age, qx, lx, dx) followed by
+            the select rows, when there are any
+    '''
+    table, gender = df_['table'].iloc[0], df_['gender'].iloc[0]
+    name = 'Tábua {} {}'.format(table, gender)
+    select = df_[SELECT_COLUMN].notna() if SELECT_COLUMN in df_.columns \
+        else pd.Series(False, index=df_.index)
+    ultimate = df_[~select].sort_values('age').reset_index(drop=True)
+
+    age = ultimate['age'].values
+    if not len(age):
+        raise Exception('{}: sem idades'.format(name))
+    if not (np.diff(age) == 1).all():
+        raise Exception('{}: idades não contínuas'.format(name))
+
+    has_lx = 'lx' in ultimate.columns and ultimate['lx'].notna().all()
+    if has_lx:
+        lx = ultimate['lx'].values.astype(np.float64)
+    else:
+        if 'qx' not in ultimate.columns or ultimate['qx'].isna().any():
+            raise Exception('{}: informe qx ou lx'.format(name))
+        qx = ultimate['qx'].values.astype(np.float64)
+        if ((qx < 0) | (qx > 1)).any():
+            raise Exception('{}: qx fora de [0, 1]'.format(name))
+        lx = RADIX*np.cumprod(np.append(1., 1 - qx[:-1]))
+    lx_next = np.append(lx[1:], 0.)
+    if 'dx' in ultimate.columns and ultimate['dx'].notna().all():
+        dx = ultimate['dx'].values.astype(np.float64)
+    elif has_lx:
+        dx = lx - lx_next
+    else:
+        dx = lx*qx
+
+    if (lx < 0).any():
+        raise Exception('{}: lx negativo'.format(name))
+    if (np.diff(lx) > 0).any():
+        raise Exception('{}: lx crescente na idade {}'.
+                        format(name, age[1:][np.diff(lx) > 0][0]))
+    error = np.abs(dx[:-1] - (lx[:-1] - lx_next[:-1])) > rtol*lx[0]
+    if error.any():
+        raise Exception('{}: dx diferente de lx - lx+1 na idade {}'.
+                        format(name, age[:-1][error][0]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        qx = np.where(lx > 0, dx/lx, 1.)
+
+    result = pd.DataFrame({'table': table, 'gender': gender, 'age': age,
+                           'qx': qx, 'lx': lx, 'dx': dx})
+    if not select.any():
+        return result
+
+    rows = df_[select]
+    q = rows['qx'].values.astype(np.float64)
+    if np.isnan(q).any() or ((q < 0) | (q > 1)).any():
+        raise Exception('{}: qx de seleção fora de [0, 1]'.format(name))
+    if ((rows['age'] < age[0]) | (rows['age'] > age[-1])).any():
+        raise Exception('{}: idade de seleção fora da tábua'.format(name))
+    rows = rows[['table', 'gender', 'age', SELECT_COLUMN, 'qx']]
+    return pd.concat([result, rows.sort_values(['age', SELECT_COLUMN])], ignore_index=True)
+
+
+class TableLibrary():
+    '''
+        Lazy registry of life tables from several sources (files or directories of csv,
+        parquet, xlsx, xml and SQLite files). A table is read, validated and hashed on its
+        first use; whole-file formats keep the file read until all its tables are loaded.
+    '''
+    SUFFIXES = ['.csv', '.parquet', '.xlsx', '.xls', '.db', '.sqlite', '.sqlite3'] + \
+        XTBML_SUFFIXES
+
+    def __init__(self, sources, rtol=DEF_RTOL):
+        '''
+            Lists the tables of the sources, the first source with a table wins
+            Input:
+                sources: paths of files or directories --> list of str or pathlib.Path
+                rtol: tolerance of the validation --> float
+        '''
+        self.rtol = rtol
+        self.sources = {}
+        for source in sources:
+            source = pathlib.Path(source)
+            paths = sorted(source.iterdir()) if source.is_dir() else [source]
+            for path in paths:
+                if path.suffix.lower() not in self.SUFFIXES:
+                    continue
+                for key in list_tables(path):
+                    self.sources.setdefault(key, path)
+        #tables already loaded: (table, gender) --> (dataframe, info)
+        self.tables = {}
+        #whole files read, by path
+        self.frames = {}
+        #the library is shared by the request threads and the background jobs
+        self.lock = threading.Lock()
+
+    def keys(self):
+        '''
+            List of (table, gender) in the library
+        '''
+        return list(self.sources)
+
+    def read(self, table, gender):
+        '''
+            Rows of a table as given by its source
+        '''
+        path = self.sources[(table, gender)]
+        suffix = path.suffix.lower()
+        if suffix in XTBML_SUFFIXES:
+            return read_xtbml(path, gender)
+        if suffix in ['.db', '.sqlite', '.sqlite3']:
+            return read_sqlite(path, table, gender)
+        if path not in self.frames:
+            self.frames[path] = read_frame(path)
+        frame = self.frames[path]
+        rows = frame[(frame['table'] == table) & (frame['gender'] == gender)]
+        #drops the file once all its tables are loaded
+        if all(key in self.tables or key == (table, gender)
+               for key, source in self.sources.items() if source == path):
+            del self.frames[path]
+        return rows
+
+    def load(self, table, gender):
+        '''
+            Loads a table on its first use
+            Output:
+                (dataframe, info), info with min_age, max_age, length, hash and source
+        '''
+        with self.lock:
+            loaded = self.tables.get((table, gender))
+            if loaded is not None:
+                return loaded
+            if (table, gender) not in self.sources:
+                raise Exception('Tábua {} {} não encontrada'.format(table, gender))
+            df_ = normalize_table(self.read(table, gender), self.rtol)
+            ultimate, select_lx, select_dx = split_select(df_)
+            info = {'table': table, 'gender': gender, 'length': len(ultimate),
+                    'min_age': int(ultimate['age'].iloc[0]),
+                    'max_age': int(ultimate['age'].iloc[-1]),
+                    'hash': content_hash(ultimate['lx'].values, ultimate['dx'].values,
+                                         select_lx, select_dx),
+                    'source': str(self.sources[(table, gender)])}
+            self.tables[(table, gender)] = (df_, info)
+            return df_, info
+
+    def info(self, table, gender):
+        '''
+            Entry of a table: min_age, max_age, length, hash and source
+        '''
+        return self.load(table, gender)[1]
+
+    def table(self, table, gender):
+        '''
+            Life table in the format used by InsuranceHandler (with the select rows)
+        '''
+        return self.load(table, gender)[0].copy()
+
+    def frame(self):
+        '''
+            All tables of the library in the format of life_tables.xlsx
+        '''
+        return pd.concat([self.load(table, gender)[0] for table, gender in self.keys()],
+                         ignore_index=True)
+
+    def to_store(self, path, dtype='float32'):
+        '''
+            Writes the ultimate tables of the library to a TableStore
+        '''
+        df = self.frame()
+        if SELECT_COLUMN in df.columns:
+            df = df[df[SELECT_COLUMN].isna()]
+        return TableStore.build(df[COLUMNS], path, dtype)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Validates life tables')
+    parser.add_argument('sources', nargs='+', help='files or directories of tables')
+    parser.add_argument('--rtol', type=float, default=DEF_RTOL)
+    parser.add_argument('--store', help='path of a TableStore index (.json) to write')
+    parser.add_argument('--dtype', default='float32', choices=STORE_DTYPES)
+    args = parser.parse_args()
+
+    library = TableLibrary(args.sources, args.rtol)
+    for table, gender in library.keys():
+        tb = library.info(table, gender)
+        print(table, gender, tb['min_age'], tb['max_age'], tb['hash'])
+    if args.store:
+        store = library.to_store(args.store, args.dtype)
+        print(store.size, 'rows written to', args.store)
@@ -0,0 +1,215 @@
+'''
+    Nonforfeiture values of whole batches of contracts and the expected cost of the options.
+
+    A policyholder that stops paying the premiums while they are due (dif_pay < t < term_pay)
+    may keep a paid-up benefit (the reserve over the value of the benefits, per unit of
+    benefit) or an extended term insurance bought by the reserve (for endowments, with the
+    endowment bought by the rest), as __calc_paidup__ of the scalar engine. nonforfeiture_table
+    gives these values at every duration of every contract, the tables of the filings, with
+    the vectorized term search of kernels.nonforfeiture_curves.
+
+    election_costs values the options under election rates: the yearly probabilities that a
+    policy in force elects the paid-up benefit or the extended term. With tEx the pure
+    endowment of the valuation basis and S_t the probability of no election before t:
+        cost = sum_t tEx*S_t*(paidup_rate_t*PU_t + extended_rate_t*ET_t)
+        reserve = sum_t tEx*S_t*(paidup_rate_t + extended_rate_t)*V_t
+    where PU_t and ET_t are the values of the benefits granted and V_t the reserve released.
+    On the basis of the reserves the paid-up benefit is worth the reserve and the extended
+    term about it (the closest integer term); on another valuation basis (stressed mortality,
+    current rates) the excess cost - reserve is the value of the options.
+'''
+import numpy as np
+import pandas as pd
+from batch import commutations, contract_columns, select_rows, calc_premium_batch
+from batch import calc_pup_batch, calc_reserve_parts_batch
+from kernels import reserve_curves, nonforfeiture_curves
+from recursion import year_rates
+from profit import contract_values
+
+#columns of the nonforfeiture tables
+TABLE_COLUMNS = ['contract', 't', 'attained_age', 'reserve', 'paidup', 'paidup_benefit',
+                 'extended_term', 'extended_value']
+
+
+def default_durations(comm, contracts):
+    '''
+        Durations from 0 to the end of the table for the youngest contract
+    '''
+    c = contract_columns(contracts)
+    return np.arange(int(comm[-1] - c['age'].min() + 1) if len(c['age']) else 0)
+
+
+def grid_columns(contracts, durations):
+    '''
+        Contract columns repeated for each duration, with the durations
+        Output:
+            (dict of np.array contracts*durations, np.array of durations)
+    '''
+    c = contract_columns(contracts)
+    repeated = {name: np.repeat(values, len(durations)) for name, values in c.items()}
+    return repeated, np.tile(durations, len(c['age']))
+
+
+def nonforfeiture_values(comm, contracts, pna, durations=None, price_comm=None, backend=None):
+    '''
+        Reserves and nonforfeiture values of a batch of contracts at each duration
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) of the reserves rate
+            contracts: contract columns (see batch.contract_columns)
+            pna: net level premiums of the contracts --> np.array
+            durations: evaluation times, default up to the end of the table --> np.array of int
+            price_comm: commutations of the pricing rate, used for the extended term, default comm
+            backend: backend of the kernels (see kernels.py) --> str
+        Output:
+            dict with the arrays (contracts x durations) reserve, paidup, extended_term,
+            extended_value and valid
+    '''
+    durations = default_durations(comm, contracts) if durations is None else \
+        np.asarray(durations, dtype=np.int64)
+    values = nonforfeiture_curves(comm, contracts, pna, durations, price_comm, backend)
+    reserve, valid = reserve_curves(comm, contracts, pna, durations, 'prosp', backend)
+    values['reserve'] = np.where(valid, reserve, np.nan)
+    return values
+
+
+def nonforfeiture_table(handler, contracts, durations=None, price_handler=None, backend=None):
+    '''
+        Nonforfeiture table of a batch of contracts: one row per contract and duration
+        with valid values, in the order of the contracts
+        Input:
+            handler: InsuranceHandler after select_table and gen_commutations (reserves rate)
+            contracts: contract columns (see batch.contract_columns), with an optional value
+                       column (benefit, default 1)
+            durations: evaluation times, default up to the end of the table --> np.array of int
+            price_handler: InsuranceHandler of the pricing rate, default handler
+            backend: backend of the kernels (see kernels.py) --> str
+        Output:
+            pandas dataframe with the columns TABLE_COLUMNS, values of the contract benefit
+            (paidup is per unit of benefit)
+    '''
+    comm = commutations(handler)
+    price_comm = commutations(price_handler) if price_handler is not None else comm
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    durations = default_durations(comm, c) if durations is None else \
+        np.asarray(durations, dtype=np.int64)
+    pna = calc_premium_batch(price_comm, c)['pna']
+    values = nonforfeiture_values(comm, c, pna, durations, price_comm, backend)
+    benefit = contract_values(contracts, size)[:, None]
+
+    shape = (size, len(durations))
+    table = pd.DataFrame({
+        'contract': np.repeat(np.arange(size), len(durations)),
+        't': np.tile(durations, size),
+        'attained_age': (c['age'][:, None] + durations[None, :]).ravel(),
+        'reserve': (values['reserve']*benefit).ravel(),
+        'paidup': values['paidup'].ravel(),
+        'paidup_benefit': (values['paidup']*benefit).ravel(),
+        'extended_term': values['extended_term'].ravel(),
+        'extended_value': (values['extended_value']*benefit).ravel()}, columns=TABLE_COLUMNS)
+    keep = (values['valid'] & np.isfinite(values['reserve'])).reshape(shape).ravel()
+    return table[keep].reset_index(drop=True)
+
+
+def extended_values(comm, contracts, t, term, endowment):
+    '''
+        Values of the extended term benefits at the durations given, the insurance (or annuity)
+        of the term found and, for endowments, the insurance of the remaining term plus the
+        endowment bought
+        Input:
+            comm: commutations of the valuation basis
+            contracts: contract columns repeated for each duration (see grid_columns)
+            t: durations --> np.array of int
+            term: extended terms --> np.array
+            endowment: endowment bought, nan for the other cases --> np.array
+        Output:
+            np.array
+    '''
+    c = contract_columns(contracts)
+    x = c['age'].astype(np.int64) + t
+    n = c['dif_benef'].astype(np.int64)
+    m = c['term_benef']
+    rows = select_rows(comm, c['age'])
+    prod = np.where(c['prod'] == 'D', 'A', c['prod'])
+    term = np.where(np.isfinite(term), term, 0)
+
+    #the same deferral of the search of the extended term
+    insurance, valid = calc_pup_batch(comm, x, np.minimum(n - t, 0), np.maximum(term, 1),
+                                      c['antecip_benef'], prod, rows)
+    value = np.where(valid & (term > 0), insurance, 0.)
+
+    is_endowment = np.isfinite(endowment)
+    remaining, valid_rem = calc_pup_batch(comm, x, np.where(t <= n, n - t, 0),
+                                          np.where(t <= n, m, m - t), c['antecip_benef'], 'A',
+                                          rows)
+    pure, valid_pure = calc_pup_batch(comm, x, 0, m + n - t, c['antecip_benef'], 'd', rows)
+    bought = np.where(valid_rem, remaining, 0.) + \
+        np.where(valid_pure, pure, 0.)*np.where(is_endowment, endowment, 0.)
+    return np.where(is_endowment, bought, value)
+
+
+def election_costs(handler, contracts, paidup_rates, extended_rates, durations=None,
+                   price_handler=None, value_handler=None, backend=None):
+    '''
+        Expected cost of the nonforfeiture options under election rates (see the module
+        docstring)
+        Input:
+            handler: InsuranceHandler after select_table and gen_commutations (reserves rate)
+            contracts: contract columns (see batch.contract_columns), with an optional value
+                       column (benefit, default 1)
+            paidup_rates, extended_rates: yearly election rates, a rate, the rates of each
+                                          duration or of each contract and duration (see
+                                          recursion.year_rates)
+            durations: evaluation times, default up to the end of the table --> np.array of int
+            price_handler: InsuranceHandler of the pricing rate, default handler
+            value_handler: InsuranceHandler of the valuation basis of the options, default handler
+            backend: backend of the kernels (see kernels.py) --> str
+        Output:
+            dict with the arrays (contracts) paidup_cost, extended_cost, cost, reserve (reserve
+            released by the elections), excess (cost - reserve) and valid, and cost_by_duration
+            (contracts x durations)
+    '''
+    comm = commutations(handler)
+    price_comm = commutations(price_handler) if price_handler is not None else comm
+    value_comm = commutations(value_handler) if value_handler is not None else comm
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    durations = default_durations(comm, c) if durations is None else \
+        np.asarray(durations, dtype=np.int64)
+    shape = (size, len(durations))
+    premium = calc_premium_batch(price_comm, c)
+    values = nonforfeiture_values(comm, c, premium['pna'], durations, price_comm, backend)
+    benefit = contract_values(contracts, size)
+
+    #elections are possible in the window of the paid-up values of __calc_paidup__
+    window = (c['dif_pay'][:, None] < durations[None, :]) & \
+        (durations[None, :] < c['term_pay'][:, None])
+    window &= values['valid'] & np.isfinite(values['reserve'])
+    paidup_rates = np.where(window, year_rates(paidup_rates, size, len(durations)), 0.)
+    extended_rates = np.where(window, year_rates(extended_rates, size, len(durations)), 0.)
+    no_election = np.cumprod(1 - paidup_rates - extended_rates, axis=1)
+    no_election = np.concatenate([np.ones((size, 1)), no_election[:, :-1]], axis=1)
+
+    #values of the benefits granted and pure endowments on the valuation basis
+    repeated, t = grid_columns(c, durations)
+    parts = calc_reserve_parts_batch(value_comm, repeated, t)
+    paidup_value = np.where(window, values['paidup']*parts['A'].reshape(shape), 0.)
+    extended_value = extended_values(value_comm, repeated, t, values['extended_term'].ravel(),
+                                     values['extended_value'].ravel()).reshape(shape)
+    extended_value = np.where(window, extended_value, 0.)
+    pure, valid_pure = calc_pup_batch(value_comm, repeated['age'], 0, t, True, 'd',
+                                      select_rows(value_comm, repeated['age']))
+    weight = np.where(valid_pure, pure, 0.).reshape(shape)*no_election
+
+    with np.errstate(invalid='ignore'):
+        paidup_cost = weight*paidup_rates*np.nan_to_num(paidup_value)
+        extended_cost = weight*extended_rates*np.nan_to_num(extended_value)
+        released = weight*(paidup_rates + extended_rates)*np.where(window, values['reserve'], 0.)
+    valid = premium['valid']
+    scale = np.where(valid, benefit, np.nan)
+    cost = (paidup_cost + extended_cost).sum(axis=1)*scale
+    reserve = released.sum(axis=1)*scale
+    return {'paidup_cost': paidup_cost.sum(axis=1)*scale,
+            'extended_cost': extended_cost.sum(axis=1)*scale,
+            'cost': cost, 'reserve': reserve, 'excess': cost - reserve, 'valid': valid,
+            'cost_by_duration': (paidup_cost + extended_cost)*scale[:, None]}
@@ -0,0 +1,198 @@
+'''
+    Portfolio valuation.
+
+    A policy file (csv or xlsx) is read in chunks and each chunk is valued with the vectorized
+    engine (batch.py), grouped by (table, gender, rate) so the commutations are calculated once
+    per group, and each contract shape of the group is valued once. Results are appended to a
+    csv file on disk and the aggregates are accumulated, so memory stays bounded by the chunk
+    size.
+
+    Columns of the policy file (the optional ones take the calc_premium defaults):
+        table, gender, age, prod, value                 required
+        dif_benef, term_benef, antecip_benef            optional, empty term_benef = whole life
+        dif_pay, term_pay, antecip_pay                  optional, empty term_pay = whole life
+        t                                               optional, reserve evaluation time (0)
+        rate                                            optional, interest rate of the policy
+'''
+import io
+import copy
+import base64
+import pathlib
+import tempfile
+import numpy as np
+import pandas as pd
+from batch import commutations, unique_contracts, calc_premium_batch, calc_reserves_batch
+from batch import contract_errors, invalid_integers, CONTRACT_DEFAULTS, SHAPE_COLUMNS
+from results import allocate, to_frame
+
+REQUIRED_COLUMNS = ['table', 'gender', 'age', 'prod', 'value']
+NUMERIC_COLUMNS = ['dif_benef', 'term_benef', 'dif_pay', 'term_pay', 't', 'rate']
+RESULT_DTYPE = np.dtype([('pup', np.float64), ('pna', np.float64), ('reserve', np.float64),
+                         ('valid', bool)])
+RESULT_COLUMNS = list(RESULT_DTYPE.names)
+
+#directory of the valuation results
+RESULTS_PATH = pathlib.Path(tempfile.gettempdir()).joinpath("actuarial_math_portfolio")
+
+DEF_CHUNKSIZE = 5000
+
+
+def read_policies(content, filename, chunksize=DEF_CHUNKSIZE):
+    '''
+        Reads a policy file in chunks
+        Input:
+            content: file content --> bytes
+            filename: name of the file, xlsx/xls files are read as Excel, others as csv --> str
+            chunksize: number of policies per chunk --> int
+        Output:
+            iterator of pandas dataframes
+    '''
+    if filename.lower().endswith(('.xlsx', '.xls')):
+        #Excel files can not be read in chunks
+        df = pd.read_excel(io.BytesIO(content))
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+    else:
+        for chunk in pd.read_csv(io.BytesIO(content), chunksize=chunksize):
+            yield chunk
+
+
+def count_policies(content, filename):
+    '''
+        Number of policies of a csv file (lines minus the header), None for Excel files
+    '''
+    if filename.lower().endswith(('.xlsx', '.xls')):
+        return None
+    return max(content.count(b'\n') - 1 + (not content.endswith(b'\n')), 1)
+
+
+def decode_upload(contents):
+    '''
+        Decodes the contents of a dcc.Upload ("data:<type>;base64,<data>")
+    '''
+    content_type, content_string = contents.split(',', 1)
+    return base64.b64decode(content_string)
+
+
+def normalize_policies(chunk, rate, required=REQUIRED_COLUMNS):
+    '''
+        Fills the optional columns of a chunk with their defaults
+        Input:
+            chunk: policies --> pandas dataframe
+            rate: interest rate of the policies without the rate column --> float
+            required: columns that must be in the chunk --> list of str
+        Output:
+            pandas dataframe
+    '''
+    missing = [col for col in required if col not in chunk.columns]
+    if missing:
+        raise Exception('Colunas ausentes no arquivo: {}'.format(', '.join(missing)))
+
+    chunk = chunk.copy()
+    #non-numeric entries become nan, so they are rejected instead of taking the defaults
+    for name in ['age', 'value']:
+        chunk[name] = pd.to_numeric(chunk[name], errors='coerce')
+    for name, default in list(CONTRACT_DEFAULTS.items()) + [('t', 0), ('rate', rate)]:
+        if name not in chunk.columns:
+            chunk[name] = default
+            continue
+        missing = chunk[name].isna()
+        if name in NUMERIC_COLUMNS:
+            chunk[name] = pd.to_numeric(chunk[name], errors='coerce')
+        chunk[name] = chunk[name].mask(missing, default)
+    chunk['prod'] = chunk['prod'].astype(str)
+    return chunk
+
+
+def value_policies(handler, chunk):
+    '''
+        Values a chunk of policies
+        Input:
+            handler: InsuranceHandler, used to select tables and generate the commutations
+            chunk: normalized policies --> pandas dataframe
+        Output:
+            pandas dataframe with the columns pup, pna, reserve (per unit of benefit times value)
+            and valid, same index of the chunk
+    '''
+    result = allocate(RESULT_DTYPE, len(chunk))
+    #policies without value and policies with invalid contract columns (typed_contracts) or
+    #reserve times are left invalid
+    index = chunk.index
+    chunk = chunk.assign(position=np.arange(len(chunk))).dropna(subset=['value'])
+    invalid = invalid_integers(chunk['t'].values)
+    for rows in contract_errors(chunk).values():
+        invalid |= rows
+    chunk = chunk[~invalid]
+    for (table, gender, rate), group in chunk.groupby(['table', 'gender', 'rate']):
+        try:
+            handler.select_table(table, gender)
+        except Exception:
+            continue
+        if handler.df_.empty:
+            continue
+        handler.gen_commutations(rate)
+        comm = commutations(handler)
+
+        #each shape is valued once at unit benefit
+        unit, inverse = unique_contracts(group, SHAPE_COLUMNS + ['t'])
+        premium = calc_premium_batch(comm, unit)
+        reserve, valid = calc_reserves_batch(comm, unit, premium['pna'], unit['t'])
+        value = group['value'].values
+        rows = group['position'].values
+        result['pup'][rows] = premium['pup'][inverse]*value
+        result['pna'][rows] = premium['pna'][inverse]*value
+        result['reserve'][rows] = reserve[inverse]*value
+        result['valid'][rows] = (premium['valid'] & valid)[inverse]
+    return to_frame(result, index)
+
+
+def value_portfolio(handler, content, filename, rate, out_path,
+                    chunksize=DEF_CHUNKSIZE, progress=None):
+    '''
+        Values a policy file, writing the policies with their results to a csv file
+        Input:
+            handler: InsuranceHandler (a copy is used)
+            content: policy file content --> bytes
+            filename: policy file name --> str
+            rate: default interest rate --> float
+            out_path: result file --> str or pathlib.Path
+            chunksize: policies per chunk --> int
+            progress: function called with the fraction of the policies valued, default None
+        Output:
+            dict with the number of policies, invalid policies and the aggregates by product
+            and table (pandas dataframe with policies, value, pup, pna and reserve)
+    '''
+    handler_ = copy.copy(handler)
+    total = count_policies(content, filename)
+    aggregates = []
+    policies = 0
+    invalid = 0
+    header = True
+    out_path = pathlib.Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(out_path, 'w', newline='') as out:
+        for c, chunk in enumerate(read_policies(content, filename, chunksize)):
+            chunk = normalize_policies(chunk, rate)
+            result = value_policies(handler_, chunk)
+            valued = pd.concat([chunk, result], axis=1)
+            valued.to_csv(out, index=False, header=header)
+            header = False
+
+            policies += len(valued)
+            invalid += int((~valued['valid'].astype(bool)).sum())
+            valued = valued[valued['valid'].astype(bool)]
+            valued = valued.assign(policies=1)
+            aggregates.append(valued.groupby(['prod', 'table'])
+                                    [['policies', 'value', 'pup', 'pna', 'reserve']].sum())
+
+            if progress is not None and total is not None:
+                progress(min(policies/total, 0.99))
+
+    if aggregates:
+        summary = pd.concat(aggregates).groupby(level=[0, 1]).sum().reset_index()
+    else:
+        summary = pd.DataFrame(columns=['prod', 'table', 'policies', 'value',
+                                        'pup', 'pna', 'reserve'])
+    return {'policies': policies, 'invalid': invalid, 'summary': summary,
+            'path': str(out_path)}
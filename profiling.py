@@ -0,0 +1,227 @@
+'''
+    Profiles of single requests of the app.
+
+    RequestProfiler runs a callback under cProfile when the request asks for it, with the header
+    X-Profile or the query parameter "profile". Dash callbacks are requested by the page, so the
+    parameter may also be on the page address (the Referer of the callback request):
+
+        http://localhost:8050/?profile=1
+        curl ... -H "X-Profile: 1"
+
+    Each profile is saved to the profiles directory in pstats format, beside a json file with
+    the parameters of the call and its time. The name of the profile is logged and sent back in
+    the X-Profile response header. Background jobs submitted by a profiled call through
+    RequestProfiler.job are profiled when they run and added to the same profile, with their
+    times in the json file. The profiles are read with:
+
+        python profiling.py profiles/<name>.pstats
+        python profiling.py profiles/<name>.pstats --sort tottime --limit 50
+
+    or with any pstats viewer (snakeviz, gprof2dot). Profiling is disabled unless the app is
+    started with PROFILE_PATH, and with PROFILE_TOKEN the header or parameter must be the token.
+'''
+import json
+import hmac
+import time
+import uuid
+import pstats
+import cProfile
+import inspect
+import logging
+import pathlib
+import argparse
+import datetime as dt
+import functools
+import threading
+from urllib.parse import urlparse, parse_qs
+import flask
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PARAM = 'profile'
+#number of profiles kept in the directory, the oldest are removed
+DEF_MAX_PROFILES = 100
+
+logger = logging.getLogger(__name__)
+
+
+class RequestProfiler():
+    '''
+        Profiles the calls of decorated functions when the request asks for it
+    '''
+    def __init__(self, path=None, token=None, max_profiles=DEF_MAX_PROFILES):
+        '''
+            Input:
+                path: directory of the profiles, None disables profiling --> str or pathlib.Path
+                token: value required on the header or parameter, any value when None --> str
+                max_profiles: number of profiles kept --> int
+        '''
+        self.path = pathlib.Path(path) if path else None
+        self.token = token
+        self.max_profiles = max_profiles
+        #only one profiler can be active at a time, concurrent requests run without it
+        self.lock = threading.Lock()
+        #name of the profile of the call running in each thread
+        self.local = threading.local()
+        #profiles of jobs are added to the files of their requests
+        self.files_lock = threading.Lock()
+
+    def requested(self):
+        '''
+            Indicates the current request asks for a profile
+        '''
+        if self.path is None or not flask.has_request_context():
+            return False
+        request = flask.request
+        value = request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_PARAM)
+        if value is None and request.referrer:
+            value = parse_qs(urlparse(request.referrer).query).get(PROFILE_PARAM, [None])[0]
+        if value is None:
+            return False
+        #bytes, compare_digest rejects non-ASCII str
+        return self.token is None or hmac.compare_digest(value.encode(), self.token.encode())
+
+    def profiled(self, func):
+        '''
+            Decorator of the functions profiled on request, returns the function itself when
+            profiling is disabled
+        '''
+        if self.path is None:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.requested() or not self.lock.acquire(blocking=False):
+                return func(*args, **kwargs)
+            name = '{:%Y%m%d-%H%M%S}-{}-{}'.format(dt.datetime.now(), func.__name__,
+                                                   uuid.uuid4().hex[:8])
+            self.local.name = name
+            try:
+                profile = cProfile.Profile()
+                start = time.perf_counter()
+                try:
+                    return profile.runcall(func, *args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    self.save(name, func, args, kwargs, profile, elapsed)
+            finally:
+                self.local.name = None
+                self.lock.release()
+
+        return wrapper
+
+    def job(self, func):
+        '''
+            Function of a background job submitted by a profiled call, profiled when the job
+            runs and added to the profile of the call. Returns func itself outside profiled calls
+        '''
+        name = getattr(self.local, 'name', None)
+        if name is None:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            #waits for the profile of the request, one profiler is active at a time
+            with self.lock:
+                profile = cProfile.Profile()
+                start = time.perf_counter()
+                try:
+                    return profile.runcall(func, *args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    try:
+                        self.write(name, profile, job={'function': func.__name__,
+                                                       'seconds': elapsed})
+                    except OSError as e:
+                        logger.warning('Profile of the job %s not saved: %s', name, e)
+                    else:
+                        logger.info('Profile of the job %s (%.3f s) added to %s', func.__name__,
+                                    elapsed, self.path.joinpath(name + '.pstats'))
+
+        return wrapper
+
+    def write(self, name, profile, info=None, job=None):
+        '''
+            Writes a profile, adding it to the profile of the same name when there is one
+            Input:
+                name: name of the profile --> str
+                profile: cProfile.Profile
+                info: parameters of the call, saved in the json file --> dict
+                job: function and time of a job, added to the jobs of the json file --> dict
+        '''
+        stats_file = self.path.joinpath(name + '.pstats')
+        info_file = self.path.joinpath(name + '.json')
+        with self.files_lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            if stats_file.exists():
+                stats = pstats.Stats(str(stats_file))
+                stats.add(profile)
+                stats.dump_stats(str(stats_file))
+            else:
+                profile.dump_stats(str(stats_file))
+            data = {}
+            if info_file.exists():
+                with open(info_file) as f:
+                    data = json.load(f)
+            data.update(info or {})
+            if job is not None:
+                data.setdefault('jobs', []).append(job)
+            with open(info_file, 'w') as f:
+                json.dump(data, f, default=repr, indent=1)
+
+    def save(self, name, func, args, kwargs, profile, elapsed):
+        '''
+            Writes a profile and its parameters, failures are logged without failing the request
+        '''
+        try:
+            try:
+                params = inspect.signature(func).bind(*args, **kwargs).arguments
+            except TypeError:
+                params = {'args': args, 'kwargs': kwargs}
+            self.write(name, profile, {'function': func.__name__, 'seconds': elapsed,
+                                       'params': params})
+            self.drop_old()
+        except OSError as e:
+            logger.warning('Profile %s not saved: %s', name, e)
+            return
+
+        logger.info('Profile %s of %s (%.3f s) saved to %s', name, func.__name__, elapsed,
+                    self.path.joinpath(name + '.pstats'))
+        flask.g.profile_name = name
+
+    def drop_old(self):
+        files = sorted(self.path.glob('*.pstats'))
+        for file in files[:max(len(files) - self.max_profiles, 0)]:
+            file.unlink(missing_ok=True)
+            file.with_suffix('.json').unlink(missing_ok=True)
+
+    def register(self, server):
+        '''
+            Sends the name of the profile of a request in the X-Profile response header
+        '''
+        @server.after_request
+        def profile_header(response):
+            name = flask.g.get('profile_name')
+            if name:
+                response.headers[PROFILE_HEADER] = name
+            return response
+
+
+def print_profile(file, sort='cumulative', limit=30):
+    '''
+        Prints the parameters and the functions with the largest times of a profile
+    '''
+    file = pathlib.Path(file)
+    params = file.with_suffix('.json')
+    if params.exists():
+        with open(params) as f:
+            print(json.dumps(json.load(f), indent=1))
+    pstats.Stats(str(file)).strip_dirs().sort_stats(sort).print_stats(limit)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prints a profile saved by the app')
+    parser.add_argument('file')
+    parser.add_argument('--sort', default='cumulative')
+    parser.add_argument('--limit', type=int, default=30)
+    args = parser.parse_args()
+    print_profile(args.file, args.sort, args.limit)
@@ -0,0 +1,208 @@
+'''
+    Gross premiums with expense loadings and profit testing.
+
+    Loadings (dict or contract columns with these names, missing ones are 0):
+        acquisition             fixed expense at issue, per policy
+        maintenance             fixed expense at the start of each year in force, per policy
+        acquisition_pct         fraction of the first premium
+        commission              fraction of the first premium
+        renewal_pct             fraction of the other premiums
+        renewal_commission      fraction of the other premiums
+        margin                  profit margin, fraction of every premium
+
+    The gross premium G of a contract with benefit value B follows the equivalence principle:
+        G*a_pay = B*pup + acquisition + maintenance*a_cov + G*(f1*a_first + fr*(a_pay - a_first))
+    where a_pay is the premium annuity, a_first the value of the first premium, a_cov the annuity
+    due over the contract years, f1 and fr the percentages of the first and other premiums.
+
+    The profit test projects each year of all contracts at once, as (contracts x years) arrays,
+    holding the net premium reserves of the valuation rate (batch.calc_reserves_batch, the same
+    conventions of calc_reserves):
+        profit_k = (V_k + G_k - E_k - B_k)*(1 + earned) - q*death_k - p*(B'_k + V_k+1)
+    where B_k are the benefits paid at the start of the year (annuity due, pure endowment at the
+    end of the term) and B'_k the ones paid at the end (annuity immediate). The profit signature
+    is profit_k times the probability of being in force at the start of year k, discounted at the
+    risk discount rate for the NPV. With G = pna, no expenses and the earned rate equal to the
+    valuation rate the profits are zero, except on the last age of the table for whole life
+    postecipated payments, where the engine does not calculate the reserve (taken as zero).
+'''
+import numpy as np
+from batch import commutations, contract_columns, select_rows, calc_pup_batch
+from batch import decrement_columns, cash_flow_masks
+from batch import calc_premium_batch
+from kernels import reserve_curves
+
+EXPENSES = ['acquisition', 'maintenance', 'acquisition_pct', 'commission', 'renewal_pct',
+            'renewal_commission', 'margin']
+
+DEF_RISK_DISCOUNT = 0.12
+#interval searched for the IRR
+IRR_BOUNDS = (-0.99, 10.)
+
+
+def expense_columns(contracts, expenses=None, size=None):
+    '''
+        Loadings of each contract: contract columns, expenses dict or 0
+        Output:
+            dict of np.array
+    '''
+    size = len(contracts['age']) if size is None else size
+    expenses = expenses or {}
+    columns = {}
+    for name in EXPENSES:
+        values = contracts[name] if name in contracts else expenses.get(name, 0.)
+        columns[name] = np.broadcast_to(np.asarray(values, dtype=np.float64), (size,))
+    return columns
+
+
+def contract_values(contracts, size):
+    '''
+        Benefit value of each contract, default 1
+    '''
+    if 'value' in contracts:
+        return np.asarray(contracts['value'], dtype=np.float64)
+    return np.ones(size)
+
+
+def coverage_term(c):
+    '''
+        Years from issue to the end of the benefits and payments (np.inf for whole life)
+    '''
+    return np.maximum(c['dif_benef'] + c['term_benef'], c['dif_pay'] + c['term_pay'])
+
+
+def gross_premium_batch(comm, contracts, expenses=None):
+    '''
+        Gross premiums of a batch of contracts
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) as returned by batch.commutations
+            contracts: contract columns (see batch.contract_columns), with optional value and
+                       loading columns
+            expenses: loadings of the contracts without the columns --> dict
+        Output:
+            dict with the arrays pna (net level premium), gross (gross premium) for the contract
+            value, and valid
+    '''
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    e = expense_columns(contracts, expenses, size)
+    value = contract_values(contracts, size)
+
+    premium = calc_premium_batch(comm, c)
+    rows = select_rows(comm, c['age'])
+    a_first, valid_first = calc_pup_batch(comm, c['age'], c['dif_pay'], 1.,
+                                          c['antecip_pay'], 'a', rows)
+    a_cov, valid_cov = calc_pup_batch(comm, c['age'], 0, coverage_term(c), True, 'a', rows)
+
+    first = e['acquisition_pct'] + e['commission'] + e['margin']
+    renewal = e['renewal_pct'] + e['renewal_commission'] + e['margin']
+    anui = premium['anui']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gross = (value*premium['pup'] + e['acquisition'] + e['maintenance']*a_cov) / \
+                (anui - first*a_first - renewal*(anui - a_first))
+    valid = premium['valid'] & valid_first & valid_cov & np.isfinite(gross) & (gross > 0)
+    return {'pna': premium['pna']*value, 'gross': np.where(valid, gross, np.nan),
+            'valid': valid}
+
+
+def irr_batch(signature, bounds=IRR_BOUNDS, tol=1e-10, max_iter=200):
+    '''
+        Internal rates of return of profit signatures, by bisection on all rows at once
+        Input:
+            signature: profits at the end of each year --> np.array contracts x years
+        Output:
+            np.array, nan when the NPV does not change sign in bounds
+    '''
+    years = np.arange(1, signature.shape[1] + 1)
+
+    def npv(rates):
+        return (signature*(1 + rates[:, None])**-years).sum(axis=1)
+
+    lo = np.full(len(signature), bounds[0])
+    hi = np.full(len(signature), bounds[1])
+    with np.errstate(over='ignore', invalid='ignore'):
+        f_lo = npv(lo)
+        valid = np.sign(f_lo)*np.sign(npv(hi)) < 0
+        for _ in range(max_iter):
+            mid = (lo + hi)/2
+            f_mid = npv(mid)
+            left = np.sign(f_mid) == np.sign(f_lo)
+            lo = np.where(left, mid, lo)
+            f_lo = np.where(left, f_mid, f_lo)
+            hi = np.where(left, hi, mid)
+            if (hi - lo).max(initial=0) < tol:
+                break
+    return np.where(valid, (lo + hi)/2, np.nan)
+
+
+def profit_test_batch(handler, contracts, gross, expenses=None, earned_rate=None,
+                      risk_discount=DEF_RISK_DISCOUNT):
+    '''
+        Profit test of a batch of contracts
+        Input:
+            handler: InsuranceHandler after select_table and gen_commutations, the rate of the
+                     commutations is the valuation rate of the reserves
+            contracts: contract columns (see batch.contract_columns), with optional value and
+                       loading columns
+            gross: gross premium of each contract, for its value --> np.array
+            expenses: loadings of the contracts without the columns --> dict
+            earned_rate: rate earned on the assets, default the valuation rate --> float or np.array
+            risk_discount: rate of the NPV --> float
+        Output:
+            dict with profit (contracts x years, per policy in force at the start of the year),
+            signature (contracts x years), npv and irr
+    '''
+    comm = commutations(handler)
+    max_age = comm[-1]
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    e = expense_columns(contracts, expenses, size)
+    value = contract_values(contracts, size)
+    gross = np.broadcast_to(np.asarray(gross, dtype=np.float64), (size,))
+    earned = handler.last_i_rate_used if earned_rate is None else earned_rate
+    earned = np.broadcast_to(np.asarray(earned, dtype=np.float64), (size,))[:, None]
+
+    x = c['age'].astype(np.int64)[:, None]
+    horizon = int(max_age - x.min() + 1) if size else 0
+    k = np.arange(horizon)[None, :]
+
+    #decrements of each year, zero beyond the table
+    l_k, d_k, inside = decrement_columns(handler, c['age'], horizon)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.where(l_k > 0, d_k/l_k, 1.)
+        alive = l_k/l_k[:, :1]
+    p = 1 - q
+
+    def during(start, term):
+        return (start[:, None] <= k) & (k < (start + term)[:, None])
+
+    flows = cash_flow_masks(c, horizon)
+    death = flows['death']
+    paying = flows['paying']
+    first = paying & (k == c['dif_pay'][:, None])
+    pct = np.where(first, (e['acquisition_pct'] + e['commission'])[:, None],
+                   (e['renewal_pct'] + e['renewal_commission'])[:, None])
+    premium = np.where(paying, gross[:, None]*(1 - pct), 0.)
+    antecip_pay = c['antecip_pay'][:, None]
+    fixed = np.where(k == 0, e['acquisition'][:, None], 0.) + \
+        np.where(during(np.zeros(size), coverage_term(c)), e['maintenance'][:, None], 0.)
+
+    #net premium reserves at the start of each year and at the end of the last one
+    net = calc_premium_batch(comm, c)
+    V, valid = reserve_curves(comm, c, net['pna'], np.arange(horizon + 1))
+    V = np.where(np.isfinite(V), V, 0.)*value[:, None]
+
+    start = V[:, :-1] + np.where(antecip_pay, premium, 0.) - fixed - \
+        flows['start']*value[:, None]
+    profit = start*(1 + earned) + np.where(antecip_pay, 0., premium*p) - \
+        q*death*value[:, None] - p*(flows['end']*value[:, None] + V[:, 1:])
+    profit = np.where(inside, profit, 0.)
+    signature = alive*profit
+
+    years = np.arange(1, horizon + 1)
+    npv = (signature*(1 + risk_discount)**-years).sum(axis=1)
+    ok = net['valid'] & np.isfinite(gross)
+    return {'profit': np.where(ok[:, None], profit, np.nan),
+            'signature': np.where(ok[:, None], signature, np.nan),
+            'npv': np.where(ok, npv, np.nan),
+            'irr': np.where(ok, irr_batch(np.where(ok[:, None], signature, 0.)), np.nan)}
@@ -0,0 +1,153 @@
+'''
+    Recursive reserves.
+
+    batch.py calculates each reserve from scratch as a ratio of commutations, for a single
+    interest rate and life table. This module rolls the reserves of whole batches of contracts
+    year by year instead, with the interest rate and the mortality of each year:
+
+        (V_t + P_t - B_t)*(1 + i_t) = q_t*S_t + p_t*(V_t+1 + E_t - P'_t)
+
+    where V_t is the reserve at the start of year t, before its payments (the conventions of
+    calc_reserves), P_t and P'_t the premiums paid at the start and at the end of the year,
+    B_t and E_t the survival benefits paid at the start (annuity due, pure endowment at the
+    end of the term) and at the end (annuity immediate), S_t the death benefit paid at the end
+    of the year. Prospective reserves roll backwards from zero after the last year:
+
+        V_t = B_t - P_t + (q_t*S_t + p_t*(V_t+1 + E_t - P'_t))/(1 + i_t)
+
+    and retrospective reserves forward from V_0 = 0:
+
+        V_t+1 = ((V_t + P_t - B_t)*(1 + i_t) - q_t*S_t)/p_t - E_t + P'_t
+
+    Both cost O(contracts x years) for any rates and decrements (yield curves, improvement
+    factors, stressed mortality), without new commutations. With a flat rate and the table
+    decrements they agree with calc_reserves: "python verify.py --path recursive" checks them
+    against the exact results.
+'''
+import numpy as np
+from batch import contract_columns, decrement_columns, cash_flow_masks
+
+RECURSION_KINDS = ['prosp', 'retrosp']
+
+
+def forward_rates(spot):
+    '''
+        One year forward rates of a yield curve
+        Input:
+            spot: annual spot rates, spot[t] for the term of t + 1 years --> np.array
+        Output:
+            np.array, the rate of each year
+    '''
+    spot = np.asarray(spot, dtype=np.float64)
+    growth = (1 + spot)**np.arange(1, len(spot) + 1)
+    return np.concatenate([spot[:1], growth[1:]/growth[:-1] - 1])
+
+
+def year_rates(rates, size, horizon):
+    '''
+        Interest rate of each contract year
+        Input:
+            rates: a rate, the rates of each year (a curve, the last rate is used after its end)
+                   or of each contract and year --> float, np.array or np.array contracts x years
+            size: number of contracts --> int
+            horizon: number of years --> int
+        Output:
+            np.array contracts x years
+    '''
+    rates = np.asarray(rates, dtype=np.float64)
+    if rates.ndim and rates.shape[-1] < horizon:
+        last = np.repeat(rates[..., -1:], horizon - rates.shape[-1], axis=-1)
+        rates = np.concatenate([rates, last], axis=-1)
+    if rates.ndim:
+        rates = rates[..., :horizon]
+    return np.broadcast_to(rates, (size, horizon))
+
+
+def table_decrements(handler, ages, horizon):
+    '''
+        Probabilities of death of each contract year, from the life table of a handler
+        Output:
+            (q, inside) --> np.array contracts x years, q = 1 beyond the table (inside = False)
+    '''
+    l_k, d_k, inside = decrement_columns(handler, ages, horizon)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(l_k > 0, d_k/l_k, 1.), inside
+
+
+def roll_reserves_batch(contracts, pna, q, rates, kind='prosp'):
+    '''
+        Reserves of a batch of contracts by the recursion (see the module docstring)
+        Input:
+            contracts: contract columns (see batch.contract_columns)
+            pna: net level premiums of the contracts --> np.array
+            q: probability of death of each contract year --> np.array contracts x years
+            rates: interest rates, see year_rates
+            kind: prosp or retrosp --> str
+        Output:
+            np.array contracts x (years + 1), the reserves at the durations 0 to years
+    '''
+    if kind not in RECURSION_KINDS:
+        raise Exception('kind must be one of {}'.format(RECURSION_KINDS))
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    q = np.broadcast_to(np.asarray(q, dtype=np.float64), (size, np.shape(q)[-1]))
+    horizon = q.shape[1]
+    p = 1 - q
+    rates = year_rates(rates, size, horizon)
+    pna = np.broadcast_to(np.asarray(pna, dtype=np.float64), (size,))[:, None]
+
+    flows = cash_flow_masks(c, horizon)
+    antecip_pay = c['antecip_pay'][:, None]
+    premium = np.where(flows['paying'], pna, 0.)
+    start = flows['start'] - np.where(antecip_pay, premium, 0.)
+    end = flows['end'] - np.where(antecip_pay, 0., premium)
+    death = q*flows['death']
+
+    V = np.zeros((size, horizon + 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if kind == 'prosp':
+            for t in range(horizon - 1, -1, -1):
+                V[:, t] = start[:, t] + (death[:, t] + p[:, t]*(V[:, t + 1] + end[:, t])) / \
+                    (1 + rates[:, t])
+        else:
+            for t in range(horizon):
+                V[:, t + 1] = ((V[:, t] - start[:, t])*(1 + rates[:, t]) - death[:, t]) / \
+                    p[:, t] - end[:, t]
+    return V
+
+
+def recursive_reserves_batch(handler, contracts, pna, rates=None, q=None, kind='prosp',
+                             horizon=None):
+    '''
+        Reserve curves of a batch of contracts by the recursion, with the rates and decrements
+        of each year
+        Input:
+            handler: InsuranceHandler after select_table (and gen_commutations when rates is
+                     not given)
+            contracts: contract columns (see batch.contract_columns)
+            pna: net level premiums of the contracts --> np.array
+            rates: interest rates (see year_rates), default the rate of the commutations
+            q: probabilities of death of each contract year --> np.array contracts x years,
+               default the life table of the handler
+            kind: prosp or retrosp --> str
+            horizon: number of years, default the years of q or up to the end of the table for
+                     the youngest contract --> int
+        Output:
+            (reserves, valid) --> (np.array contracts x (horizon + 1), same shape of bool), the
+            reserves at the durations 0 to horizon
+    '''
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    max_age = int(handler.max_age)
+    if horizon is None and q is not None:
+        horizon = np.shape(q)[-1]
+    elif horizon is None:
+        horizon = int(max_age - c['age'].min() + 1) if size else 0
+    rates = handler.last_i_rate_used if rates is None else rates
+    if q is None:
+        q, _ = table_decrements(handler, c['age'], horizon)
+
+    V = roll_reserves_batch(c, pna, q, rates, kind)
+    inside = c['age'].astype(np.int64)[:, None] + np.arange(horizon + 1)[None, :] <= max_age
+    valid = inside & np.isfinite(V)
+    return np.where(valid, V, np.nan), valid
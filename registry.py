@@ -0,0 +1,229 @@
+'''
+    Hot reload of the life tables and interest rates.
+
+    DataSnapshot holds the data read at one time: the life tables (dataframe, TableStore or
+    loaders.TableLibrary), the risk free rates and the values derived from them (tables of the
+    app, default rate). Snapshots are never changed after they are built: a reload builds a new
+    one and DataRegistry swaps the reference at once, so a request or job that took a handler
+    of the old snapshot keeps reading the old data until it finishes.
+
+    After a swap, only the cache entries of the tables whose content changed are dropped: the
+    caches are keyed by the content hash of the tables (see storage.content_hash), and the
+    registry calls its listeners with the hashes that are not in the new snapshot.
+
+    Files are replaced by writing a new file and renaming it over the old one, so memory maps
+    of the old snapshot keep the old content.
+'''
+import logging
+import pathlib
+import threading
+import pandas as pd
+from calc import InsuranceHandler
+from loaders import TableLibrary
+from selection import split_select
+from storage import TableStore, content_hash
+
+PATH = pathlib.Path(__file__).parent
+DATA_PATH = PATH.joinpath("data").resolve()
+
+#seconds between checks of the watcher
+DEF_RELOAD_INTERVAL = 30.
+
+logger = logging.getLogger(__name__)
+
+
+def default_rate(df_interest):
+    '''
+        Annual SELIC rate of the latest month of the risk free rates
+    '''
+    return df_interest[df_interest['month'] ==
+                       df_interest['month'].max()]['selic_year'].values[0]/100
+
+
+def file_stamps(paths):
+    '''
+        Modification time and size of the files, files of directories included
+        Output:
+            dict path --> (mtime_ns, size), None for missing files
+    '''
+    stamps = {}
+    for path in paths:
+        path = pathlib.Path(path)
+        files = sorted(path.iterdir()) if path.is_dir() else [path]
+        for file in files:
+            try:
+                stat = file.stat()
+                stamps[str(file)] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                stamps[str(file)] = None
+    return stamps
+
+
+class DataSnapshot():
+    '''
+        Data files read at one time (see the module docstring)
+    '''
+    def __init__(self, df, store, df_interest, generation=0, stamps=None):
+        '''
+            Input:
+                df: life tables --> pandas dataframe (None when store is given)
+                store: TableStore or TableLibrary --> None for df
+                df_interest: risk free rates --> pandas dataframe
+                generation: number of reloads before this snapshot --> int
+                stamps: file stamps of the files read (see file_stamps) --> dict
+        '''
+        self.df = df
+        self.store = store
+        self.df_interest = df_interest
+        self.generation = generation
+        self.stamps = stamps or {}
+        self.rate = default_rate(df_interest)
+        if store is not None:
+            self.tables = list(dict.fromkeys(tb for tb, gender in store.keys()))
+        else:
+            self.tables = list(df['table'].unique())
+
+    def handler(self, cache=None):
+        '''
+            New InsuranceHandler on the data of the snapshot
+        '''
+        return InsuranceHandler(self.df, store=self.store, cache=cache)
+
+    def keys(self):
+        '''
+            List of (table, gender) of the snapshot
+        '''
+        if self.store is not None:
+            return self.store.keys()
+        return list(self.df.groupby(['table', 'gender'], sort=False).groups)
+
+    def max_age(self, table, gender):
+        if self.store is not None:
+            return self.store.info(table, gender)['max_age']
+        return self.df.query('gender == "{}" and table == "{}"'.
+                             format(gender, table))['age'].max()
+
+    def hashes(self, keys=None):
+        '''
+            Content hashes of tables, by default of all the tables of a dataframe or TableStore
+            and of the tables already loaded by a TableLibrary (the others are loaded only when
+            keys are given)
+            Output:
+                dict (table, gender) --> hash
+        '''
+        if isinstance(self.store, TableLibrary) and keys is None:
+            return {key: info['hash'] for key, (df_, info) in list(self.store.tables.items())}
+        available = self.keys()
+        keys = available if keys is None else list(set(keys) & set(available))
+        if self.store is not None:
+            return {key: self.store.info(*key)['hash'] for key in keys}
+
+        hashes = {}
+        groups = self.df.groupby(['table', 'gender'], sort=False)
+        for key in keys:
+            df_, select_lx, select_dx = split_select(groups.get_group(key).
+                                                     sort_values('age'))
+            hashes[key] = content_hash(df_['lx'].values, df_['dx'].values, select_lx,
+                                       select_dx)
+        return hashes
+
+
+class DataRegistry():
+    '''
+        Current DataSnapshot of the app, reloaded when the data files change
+    '''
+    def __init__(self, table_store=None, table_sources=None, data_path=DATA_PATH):
+        '''
+            Reads the first snapshot
+            Input:
+                table_store: path of a TableStore index --> str
+                table_sources: table sources of a TableLibrary --> list of str
+                data_path: folder of life_tables.xlsx and risk_free.xlsx --> pathlib.Path
+        '''
+        self.table_store = table_store
+        self.table_sources = table_sources
+        self.data_path = pathlib.Path(data_path)
+        #functions called with the set of stale hashes after each swap
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.last_error = None
+        self.snapshot = self.load()
+
+    def paths(self):
+        '''
+            Files read by a snapshot, checked by the watcher
+        '''
+        paths = [self.data_path.joinpath("risk_free.xlsx")]
+        if self.table_store:
+            store = pathlib.Path(self.table_store)
+            return paths + [store, store.with_suffix('.bin')]
+        if self.table_sources:
+            return paths + list(self.table_sources)
+        return paths + [self.data_path.joinpath("life_tables.xlsx")]
+
+    def load(self, generation=0):
+        '''
+            Reads a new snapshot of the data files
+        '''
+        stamps = file_stamps(self.paths())
+        if self.table_store:
+            store, df = TableStore(self.table_store), None
+        else:
+            #life_tables.xlsx is read only when a table is first selected
+            sources = self.table_sources or [self.data_path.joinpath("life_tables.xlsx")]
+            store, df = TableLibrary(sources), None
+        df_interest = pd.read_excel(self.data_path.joinpath("risk_free.xlsx"))
+        return DataSnapshot(df, store, df_interest, generation, stamps)
+
+    def changed(self):
+        '''
+            Indicates data files changed after the current snapshot was read
+        '''
+        return file_stamps(self.paths()) != self.snapshot.stamps
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def reload(self, force=False):
+        '''
+            Reads the changed data files and swaps the snapshot. When the new files can not be
+            read (or fail the validation) the current snapshot is kept and the error raised.
+            Output:
+                set of the content hashes that are no longer in use, None when nothing changed
+        '''
+        with self.lock:
+            if not force and not self.changed():
+                return None
+            old = self.snapshot
+            new = self.load(old.generation + 1)
+
+            #tables in use (in the caches) are hashed on the new snapshot before the swap
+            old_hashes = old.hashes()
+            new_hashes = new.hashes(list(old_hashes))
+            stale = set(old_hashes.values()) - set(new_hashes.values())
+            self.snapshot = new
+
+        for listener in self.listeners:
+            listener(stale)
+        logger.info('Data reloaded (generation %d), %d tables changed',
+                    new.generation, len(stale))
+        return stale
+
+    def watch(self, interval=DEF_RELOAD_INTERVAL):
+        '''
+            Starts a background thread that reloads the data files when they change
+        '''
+        def run():
+            while not self.stop.wait(interval):
+                try:
+                    self.reload()
+                    self.last_error = None
+                except Exception as e:
+                    self.last_error = str(e)
+                    logger.warning('Data reload failed: %s', e)
+
+        if self.watcher is None:
+            self.stop = threading.Event()
+            self.watcher = threading.Thread(target=run, daemon=True)
+            self.watcher.start()
@@ -0,0 +1,97 @@
+'''
+    Result arrays of the engine.
+
+    Results are preallocated NumPy structured arrays (one allocation per result, one field per
+    column) filled by the vectorized engines, instead of lists of rows converted to dataframes:
+    the premiums of batch.calc_premium_batch, the solvers, the portfolio and the valuation at a
+    date. The fields are views of the array, so:
+
+        to_frame      dataframe whose columns share the memory of the fields (no copy)
+        to_arrow      Arrow record batch, for Parquet files and downstream systems
+        from_arrow    result array of an Arrow record batch or table
+        write_parquet Parquet file of a result
+
+    pyarrow is optional (requirements-extra.txt), the Arrow functions raise an exception without
+    it. Fields of a structured array are strided, so Arrow (columnar) gets one contiguous copy of
+    each field. verify.py checks the round trip when pyarrow is installed.
+'''
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def allocate(dtype, size):
+    '''
+        Result array with nan on the float fields and zeros (False) on the others
+        Input:
+            dtype: np.dtype or list of (name, type)
+            size: number of rows --> int
+        Output:
+            np.array of dtype
+    '''
+    records = np.zeros(size, dtype=dtype)
+    for name in records.dtype.names:
+        if np.issubdtype(records.dtype[name], np.floating):
+            records[name] = np.nan
+    return records
+
+
+def from_columns(columns, dtype=None):
+    '''
+        Result array of columns of the same length
+        Input:
+            columns: dict of arrays
+            dtype: dtype of the result, default the types of the columns
+        Output:
+            np.array of dtype
+    '''
+    columns = {name: np.asarray(values) for name, values in columns.items()}
+    if dtype is None:
+        dtype = [(name, values.dtype) for name, values in columns.items()]
+    size = len(next(iter(columns.values()))) if columns else 0
+    records = allocate(dtype, size)
+    for name, values in columns.items():
+        records[name] = values
+    return records
+
+
+def to_frame(records, index=None):
+    '''
+        Dataframe of a result array, the columns are views of the fields
+    '''
+    return pd.DataFrame({name: records[name] for name in records.dtype.names}, index=index,
+                        copy=False)
+
+
+def to_arrow(records):
+    '''
+        Arrow record batch of a result array
+    '''
+    if pyarrow is None:
+        raise Exception('pyarrow não está instalado')
+    names = list(records.dtype.names)
+    return pyarrow.RecordBatch.from_arrays([pyarrow.array(records[name]) for name in names],
+                                           names=names)
+
+
+def from_arrow(data, dtype):
+    '''
+        Result array of an Arrow record batch or table with the fields of dtype
+    '''
+    if pyarrow is None:
+        raise Exception('pyarrow não está instalado')
+    return from_columns({name: data.column(name).to_numpy(zero_copy_only=False)
+                         for name in np.dtype(dtype).names}, dtype)
+
+
+def write_parquet(records, path):
+    '''
+        Writes a result array to a Parquet file
+    '''
+    batch = to_arrow(records)
+    pyarrow.parquet.write_table(pyarrow.Table.from_batches([batch]), str(path))
@@ -0,0 +1,119 @@
+'''
+    Select and ultimate life tables.
+
+    A select table has, besides the ultimate rows of the life tables dataframe (table, gender,
+    age, qx, lx, dx), select rows with the column duration: age is the issue age and qx the
+    mortality rate in the policy year duration (0 for the first year). Durations without select
+    rows (and the ultimate rows, duration empty) follow the ultimate rates.
+
+    The select table is kept as 2-D arrays [issue age, attained age], where the attained age is
+    the issue age plus the duration. Columns are aligned with the ultimate table, so each row
+    works with the same formulas of the ultimate tables (Dx[x + n] ...), and the commutations
+    of all issue ages are calculated at once per rate:
+        l[x, x] = lx (ultimate)
+        l[x, y + 1] = l[x, y]*(1 - q[x, y])
+        d[x, y] = l[x, y]*q[x, y]
+    Entries with attained age below the issue age are zero.
+'''
+import numpy as np
+import pandas as pd
+
+SELECT_COLUMN = 'duration'
+
+
+def split_select(df_):
+    '''
+        Splits the rows of a life table in ultimate and select ones
+        Input:
+            df_: rows of one table and gender --> pandas dataframe
+        Output:
+            (ultimate, lx, dx): ultimate rows (pandas dataframe) and the 2-D select table, lx and
+            dx are None for tables without select rows
+    '''
+    if SELECT_COLUMN not in df_.columns:
+        return df_, None, None
+    select = df_[SELECT_COLUMN].notna()
+    ultimate = df_[~select].drop(columns=SELECT_COLUMN).reset_index(drop=True)
+    if not select.any():
+        return ultimate, None, None
+    lx, dx = build_select(ultimate, df_[select])
+    return ultimate, lx, dx
+
+
+def build_select(ultimate, select):
+    '''
+        2-D select table [issue age, attained age]
+        Input:
+            ultimate: ultimate rows with age, lx and dx --> pandas dataframe
+            select: select rows with age (issue age), duration and qx --> pandas dataframe
+        Output:
+            (lx, dx) --> (np.array, np.array)
+    '''
+    age = ultimate['age'].values
+    lx = ultimate['lx'].values.astype(np.float64)
+    dx = ultimate['dx'].values.astype(np.float64)
+    size = len(age)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q_ultimate = np.where(lx > 0, dx/lx, 1.)
+
+    q = np.tile(q_ultimate, (size, 1))
+    issue = select['age'].values.astype(np.int64) - age[0]
+    attained = issue + select[SELECT_COLUMN].values.astype(np.int64)
+    inside = (issue >= 0) & (attained < size)
+    q[issue[inside], attained[inside]] = select['qx'].values[inside]
+
+    after_issue = np.arange(size)[None, :] >= np.arange(size)[:, None]
+    survival = np.cumprod(np.where(after_issue, 1 - q, 1.), axis=1)
+    survival = np.hstack([np.ones((size, 1)), survival[:, :-1]])
+    lx_select = np.where(after_issue, lx[:, None]*survival, 0.)
+    dx_select = np.where(after_issue, lx_select*q, 0.)
+    return lx_select, dx_select
+
+
+def select_commutations(lx, dx, age, rate):
+    '''
+        Commutations of a 2-D select table, one row per issue age
+        Input:
+            lx, dx: select table [issue age, attained age] --> np.array
+            age: attained ages of the columns --> np.array
+            rate: interest rate --> float
+        Output:
+            (Dx, Nx, Cx, Mx) --> 2-D np.arrays
+    '''
+    v = 1/(1 + rate)
+    Dx = lx*v**age
+    Cx = dx*v**(age + 1)
+    Nx = Dx[:, ::-1].cumsum(axis=1)[:, ::-1]
+    Mx = Cx[:, ::-1].cumsum(axis=1)[:, ::-1]
+    return Dx, Nx, Cx, Mx
+
+
+def select_from_factors(df, table, gender, factors, name):
+    '''
+        Select table built from an ultimate one with selection factors, q[x]+t = f_t*q_x+t
+        Input:
+            df: life tables --> pandas dataframe
+            table, gender: ultimate table --> str
+            factors: factor of each select duration, e.g. [0.6, 0.8, 0.9] --> list of float
+            name: name of the new table --> str
+        Output:
+            pandas dataframe with the ultimate and select rows of the new table, to be
+            appended to df
+    '''
+    ultimate = df.query('table == "{}" and gender == "{}"'.format(table, gender))
+    if SELECT_COLUMN in ultimate.columns:
+        ultimate = ultimate[ultimate[SELECT_COLUMN].isna()]
+    ultimate = ultimate.assign(table=name).reset_index(drop=True)
+    age = ultimate['age'].values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.where(ultimate['lx'].values > 0,
+                     ultimate['dx'].values/ultimate['lx'].values, 1.)
+
+    rows = []
+    for duration, factor in enumerate(factors):
+        attained = np.arange(len(age)) + duration
+        inside = attained < len(age)
+        rows.append(pd.DataFrame({'table': name, 'gender': gender, 'age': age[inside],
+                                  SELECT_COLUMN: duration,
+                                  'qx': np.minimum(factor*q[attained[inside]], 1.)}))
+    return pd.concat([ultimate] + rows, ignore_index=True)
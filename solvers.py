@@ -0,0 +1,306 @@
+'''
+    Inverse solvers: the interest rate, term or benefit that gives a target premium.
+
+    All solvers work on batches of contracts (columns as in batch.py) with one target per
+    contract, the premium of the contract value (value column, default 1):
+        solve_rate_batch     interest rate, bracketed Newton with bisection fallback. The
+                             derivative is analytic: the premiums are ratios of linear
+                             combinations of the commutations, and d/di of Dx and Cx are
+                             -age*Dx/(1+i) and -(age+1)*Cx/(1+i).
+        solve_term_batch     term with the premium closest to the target, all candidate terms
+                             are priced in one vectorized call
+        solve_benefit_batch  benefit bought by a premium, the premiums are linear on the benefit
+    solve_portfolio applies them to a dataframe with several tables, and solve_rate, solve_term
+    and solve_benefit are the single contract versions with the calc_premium parameters. The
+    batch solvers return result arrays (results.py) of RESULT_DTYPES.
+'''
+import numpy as np
+from batch import commutations, contract_columns, commutations_for_rates
+from batch import calc_pup_parts_batch, calc_premium_batch
+from results import allocate, from_columns, to_frame
+
+#premiums that can be targeted
+KINDS = ['pna', 'pup']
+UNKNOWNS = ['rate', 'term', 'benefit']
+#results of the batch solvers, by unknown
+RESULT_DTYPES = {
+    'rate': np.dtype([('rate', np.float64), ('converged', bool)]),
+    'term': np.dtype([('term', np.float64), ('premium', np.float64), ('valid', bool)]),
+    'benefit': np.dtype([('benefit', np.float64), ('valid', bool)])}
+
+#interval searched by the rate solver, the engine does not accept rates <= 0
+DEF_RATE_BOUNDS = (1e-6, 1.)
+DEF_TOL = 1e-12
+DEF_MAX_ITER = 100
+
+
+def premium_parts(comm, c, kind='pna'):
+    '''
+        Numerator and denominator of the premiums of a batch, premium = num/den
+        Input:
+            comm: commutations (see batch.calc_pup_parts_batch)
+            c: contract columns (see batch.contract_columns)
+            kind: pna or pup --> str
+        Output:
+            (numerator, denominator, valid)
+    '''
+    num, den, valid = calc_pup_parts_batch(comm, c['age'], c['dif_benef'], c['term_benef'],
+                                           c['antecip_benef'], c['prod'])
+    if kind == 'pna':
+        den, _, valid_pay = calc_pup_parts_batch(comm, c['age'], c['dif_pay'], c['term_pay'],
+                                                 c['antecip_pay'], 'a')
+        valid = valid & valid_pay
+    return num, den, valid
+
+
+def commutation_derivatives(handler, comm, rates):
+    '''
+        Derivatives with respect to the interest rate of commutations_for_rates
+    '''
+    Dx, Nx, Cx, Mx, max_age = comm
+    age = handler.df_['age'].values
+    v = 1/(1 + np.asarray(rates, dtype=np.float64)[:, None])
+    dDx = -age*v*Dx
+    dCx = -(age + 1)*v*Cx
+    dNx = dDx[:, ::-1].cumsum(axis=1)[:, ::-1]
+    dMx = dCx[:, ::-1].cumsum(axis=1)[:, ::-1]
+    return dDx, dNx, dCx, dMx, max_age
+
+
+def unit_target(contracts, target, size):
+    '''
+        Target per unit of benefit (target/value)
+    '''
+    target = np.broadcast_to(np.asarray(target, dtype=np.float64), (size,))
+    if 'value' in contracts:
+        target = target/np.asarray(contracts['value'], dtype=np.float64)
+    return target
+
+
+def solve_rate_batch(handler, contracts, target, kind='pna', bounds=DEF_RATE_BOUNDS,
+                     tol=DEF_TOL, max_iter=DEF_MAX_ITER):
+    '''
+        Interest rates that give the target premiums
+        Input:
+            handler: InsuranceHandler after select_table
+            contracts: contract columns (see batch.contract_columns), with optional value
+            target: premium of each contract --> float or np.array
+            kind: premium targeted, pna or pup --> str
+            bounds: interval of the rates searched --> (float, float)
+            tol: tolerance on the premium per unit of benefit --> float
+            max_iter: maximum number of iterations --> int
+        Output:
+            np.array of RESULT_DTYPES['rate']: rate (nan when there is no rate in bounds) and
+            converged
+    '''
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    target = unit_target(contracts, target, size)
+
+    def evaluate(rates, rows, derivative=True):
+        c_ = {name: values[rows] for name, values in c.items()}
+        comm = commutations_for_rates(handler, rates, c_['age'])
+        num, den, valid = premium_parts(comm, c_, kind)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = num/den - target[rows]
+            if not derivative:
+                return f, None, valid
+            dnum, dden, _ = premium_parts(commutation_derivatives(handler, comm, rates), c_,
+                                          kind)
+            df = (dnum*den - num*dden)/den**2
+        return f, df, valid
+
+    every = np.arange(size)
+    lo = np.full(size, bounds[0], dtype=np.float64)
+    hi = np.full(size, bounds[1], dtype=np.float64)
+    f_lo, _, valid = evaluate(lo, every, False)
+    f_hi, _, _ = evaluate(hi, every, False)
+
+    #the target must be bracketed by the premiums at the bounds
+    bracket = valid & np.isfinite(f_lo) & np.isfinite(f_hi) & (np.sign(f_lo)*np.sign(f_hi) <= 0)
+    converged = bracket & ((f_lo == 0) | (f_hi == 0))
+    rate = np.where(f_lo == 0, lo, np.where(f_hi == 0, hi, (lo + hi)/2))
+    done = ~bracket | converged
+
+    for _ in range(max_iter):
+        rows = np.flatnonzero(~done)
+        if not rows.size:
+            break
+        r = rate[rows]
+        f, df, _ = evaluate(r, rows)
+        root = np.abs(f) <= tol
+
+        #keeps the root between lo and hi
+        left = np.sign(f) == np.sign(f_lo[rows])
+        lo[rows] = np.where(left, r, lo[rows])
+        f_lo[rows] = np.where(left, f, f_lo[rows])
+        hi[rows] = np.where(left, hi[rows], r)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = r - f/df
+        inside = np.isfinite(newton) & (newton > lo[rows]) & (newton < hi[rows])
+        step = np.where(inside, newton, (lo[rows] + hi[rows])/2)
+
+        rate[rows] = np.where(root, r, step)
+        converged[rows] = root | (hi[rows] - lo[rows] <= np.finfo(np.float64).eps*hi[rows])
+        done[rows] = converged[rows]
+
+    return from_columns({'rate': np.where(converged, rate, np.nan), 'converged': converged},
+                        RESULT_DTYPES['rate'])
+
+
+def solve_term_batch(comm, contracts, target, kind='pna', columns=('term_benef',),
+                     max_term=None):
+    '''
+        Terms with the premium closest to the target
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) as returned by batch.commutations
+            contracts: contract columns (see batch.contract_columns), with optional value
+            target: premium of each contract --> float or np.array
+            kind: premium targeted, pna or pup --> str
+            columns: term columns set to the candidate term, e.g. ('term_benef', 'term_pay')
+                     for contracts paid during the benefit term --> tuple of str
+            max_term: largest candidate term, default the size of the table --> int
+        Output:
+            np.array of RESULT_DTYPES['term']: term (nan when no term is valid), premium (of
+            the term found, for the contract value) and valid
+    '''
+    c = contract_columns(contracts)
+    size = len(c['age'])
+    target = unit_target(contracts, target, size)
+    value = np.asarray(contracts['value'], dtype=np.float64) if 'value' in contracts \
+        else np.ones(size)
+
+    terms = np.arange(1, (comm[-1] + 1 if max_term is None else max_term) + 1)
+    repeated = {name: np.repeat(values, len(terms)) for name, values in c.items()}
+    for name in columns:
+        repeated[name] = np.tile(terms, size).astype(np.float64)
+    premium = calc_premium_batch(comm, repeated)[kind].reshape(size, len(terms))
+
+    distance = np.abs(premium - target[:, None])
+    valid = np.isfinite(distance).any(axis=1)
+    best = np.argmin(np.where(np.isfinite(distance), distance, np.inf), axis=1)
+    rows = np.arange(size)
+    return from_columns({'term': np.where(valid, terms[best], np.nan),
+                         'premium': np.where(valid, premium[rows, best]*value, np.nan),
+                         'valid': valid}, RESULT_DTYPES['term'])
+
+
+def solve_benefit_batch(comm, contracts, premium, kind='pna'):
+    '''
+        Benefits bought by the premiums
+        Input:
+            comm: (Dx, Nx, Cx, Mx, max_age) as returned by batch.commutations
+            contracts: contract columns (see batch.contract_columns)
+            premium: premium of each contract --> float or np.array
+            kind: premium given, pna or pup --> str
+        Output:
+            np.array of RESULT_DTYPES['benefit']: benefit (nan for invalid contracts) and
+            valid
+    '''
+    unit = calc_premium_batch(comm, contracts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        benefit = np.asarray(premium, dtype=np.float64)/unit[kind]
+    valid = unit['valid'] & np.isfinite(benefit)
+    return from_columns({'benefit': np.where(valid, benefit, np.nan), 'valid': valid},
+                        RESULT_DTYPES['benefit'])
+
+
+def solve_portfolio(handler, contracts, unknown, kind='pna', **kwargs):
+    '''
+        Solves a dataframe of contracts on several tables
+        Input:
+            handler: InsuranceHandler, used to select tables and generate the commutations
+            contracts: contracts with table, gender, rate (not used when solving the rate),
+                       target and the contract columns --> pandas dataframe
+            unknown: rate, term or benefit --> str
+            kind: premium targeted, pna or pup --> str
+            kwargs: options of the solver (bounds, tol, columns, max_term...)
+        Output:
+            pandas dataframe with the solver results, same index of contracts
+    '''
+    if unknown not in UNKNOWNS:
+        raise Exception('unknown must be one of {}'.format(UNKNOWNS))
+    if kind not in KINDS:
+        raise Exception('kind must be one of {}'.format(KINDS))
+
+    keys = ['table', 'gender'] if unknown == 'rate' else ['table', 'gender', 'rate']
+    #converged of the rate solver is the valid column, fields are assigned by position
+    dtype = RESULT_DTYPES[unknown]
+    result = allocate([('valid' if name == 'converged' else name, dtype[name])
+                       for name in dtype.names], len(contracts))
+    contracts = contracts.assign(position=np.arange(len(contracts)))
+    for key, group in contracts.groupby(keys, sort=False):
+        try:
+            handler.select_table(key[0], key[1])
+        except Exception:
+            continue
+        if handler.df_.empty:
+            continue
+
+        if unknown == 'rate':
+            solved = solve_rate_batch(handler, group, group['target'].values, kind, **kwargs)
+        else:
+            handler.gen_commutations(key[2])
+            if unknown == 'term':
+                solved = solve_term_batch(commutations(handler), group, group['target'].values,
+                                          kind, **kwargs)
+            else:
+                solved = solve_benefit_batch(commutations(handler), group,
+                                             group['target'].values, kind)
+        result[group['position'].values] = solved
+    return to_frame(result, contracts.index)
+
+
+def scalar_contract(age, dif_benef=0, term_benef=np.inf, antecip_benef=True, prod='a',
+                    dif_pay=0, term_pay=np.inf, antecip_pay=True):
+    '''
+        Columns of a single contract with the calc_premium parameters
+    '''
+    return {'age': [age], 'dif_benef': [dif_benef], 'term_benef': [term_benef],
+            'antecip_benef': [antecip_benef], 'prod': [prod], 'dif_pay': [dif_pay],
+            'term_pay': [term_pay], 'antecip_pay': [antecip_pay]}
+
+
+def solve_rate(handler, target, *args, kind='pna', **kwargs):
+    '''
+        Interest rate that gives the target premium of a contract (per unit of benefit)
+        Input:
+            handler: InsuranceHandler after select_table
+            target: premium --> float
+            args, kwargs: calc_premium parameters
+        Output:
+            rate, None when there is no rate in DEF_RATE_BOUNDS --> float
+    '''
+    rate = solve_rate_batch(handler, scalar_contract(*args, **kwargs), target, kind)['rate'][0]
+    return float(rate) if np.isfinite(rate) else None
+
+
+def solve_term(handler, target, *args, kind='pna', columns=('term_benef',), **kwargs):
+    '''
+        Term with the premium closest to the target (per unit of benefit)
+        Input:
+            handler: InsuranceHandler after select_table and gen_commutations
+            target: premium --> float
+            args, kwargs: calc_premium parameters
+        Output:
+            term, None when no term is valid --> int
+    '''
+    term = solve_term_batch(commutations(handler), scalar_contract(*args, **kwargs), target,
+                            kind, columns)['term'][0]
+    return int(term) if np.isfinite(term) else None
+
+
+def solve_benefit(handler, premium, *args, kind='pna', **kwargs):
+    '''
+        Benefit bought by a premium
+        Input:
+            handler: InsuranceHandler after select_table and gen_commutations
+            premium: premium --> float
+            args, kwargs: calc_premium parameters
+        Output:
+            benefit, None for invalid contracts --> float
+    '''
+    benefit = solve_benefit_batch(commutations(handler), scalar_contract(*args, **kwargs),
+                                  premium, kind)['benefit'][0]
+    return float(benefit) if np.isfinite(benefit) else None
@@ -0,0 +1,238 @@
+'''
+    Compact storage for large life table libraries.
+
+    TableStore keeps the lx and dx columns of every (table, gender) in a single contiguous
+    memory-mapped file, with a json index beside it. Workers map the same file, so the table
+    pages are shared through the OS page cache and the resident memory of each worker does
+    not grow with the library. CommutationCache keeps the commutations of the most recently
+    used (table, rate) in a bounded LRU, by the content hash of the table.
+
+    Error bounds of the float32 mode, compared with float64 storage:
+        - lx and dx are rounded once, with relative error <= 2**-24 (about 6.0e-8);
+        - commutations are calculated in float64 from the stored values, so Dx, Cx and the sums
+          Nx, Mx (positive terms only) keep a relative error <= 6.0e-8;
+        - net single premiums are ratios of sums of positive terms, relative error <= 1.2e-7;
+        - net level premiums (pup/anui) have relative error <= 2.4e-7;
+        - reserves V = A - P*a have absolute error <= 2.4e-7*(A + P*a) per unit of benefit,
+          the relative error is larger when A and P*a cancel (V near zero).
+    Run "python storage.py" to measure the errors on data/life_tables.xlsx. The float64 mode
+    reproduces the Excel values exactly. Commutations cached as float32 lose more precision
+    on differences like Mx[x] - Mx[x+m] (cancellation), so the cache stores float64 by default.
+'''
+import json
+import hashlib
+import pathlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+PATH = pathlib.Path(__file__).parent
+DATA_PATH = PATH.joinpath("data").resolve()
+
+STORE_DTYPES = ['float32', 'float64']
+
+
+def table_hash(lx, dx):
+    '''
+        Content hash of a life table
+        Input:
+            lx, dx: life table columns --> np.array
+        Output:
+            sha1 hex digest of the float64 values
+    '''
+    values = np.ascontiguousarray(np.stack([lx, dx]).astype(np.float64))
+    return hashlib.sha1(values.tobytes()).hexdigest()
+
+
+def content_hash(lx, dx, select_lx=None, select_dx=None):
+    '''
+        Content hash of a life table, select tables are identified by the 2-D select table
+        (see selection.py), which also holds the ultimate rates
+    '''
+    if select_lx is not None:
+        return table_hash(select_lx.ravel(), select_dx.ravel())
+    return table_hash(lx, dx)
+
+
+class TableStore():
+    '''
+        Memory-mapped storage of a life tables library.
+        The data file holds a (2, size) array: lx on the first row and dx on the second one,
+        each table occupying the columns [offset, offset + length). Ages of a table are
+        contiguous, from min_age to max_age.
+    '''
+    def __init__(self, path):
+        '''
+            Opens an existing store (read only)
+            Input:
+                path: path of the store index (.json), the data file has the same name with
+                      the .bin suffix --> str or pathlib.Path
+        '''
+        self.path = pathlib.Path(path)
+        with open(self.path) as f:
+            index = json.load(f)
+        self.dtype = index['dtype']
+        self.size = index['size']
+        self.index = {(tb['table'], tb['gender']): tb for tb in index['tables']}
+        self.data = np.memmap(self.path.with_suffix('.bin'), dtype=self.dtype,
+                              mode='r', shape=(2, self.size))
+
+    @classmethod
+    def build(cls, df, path, dtype='float32'):
+        '''
+            Writes a store with all tables of a dataframe
+            Input:
+                df: life tables with the columns table, gender, age, lx and dx --> pandas dataframe
+                path: path of the store index (.json) --> str or pathlib.Path
+                dtype: float32 or float64 --> str
+            Output:
+                the TableStore opened
+        '''
+        if dtype not in STORE_DTYPES:
+            raise Exception('dtype must be one of {}'.format(STORE_DTYPES))
+
+        path = pathlib.Path(path)
+        tables = []
+        offset = 0
+        for (table, gender), df_ in df.groupby(['table', 'gender'], sort=False):
+            df_ = df_.sort_values('age')
+            age = df_['age'].values
+            if not (np.diff(age) == 1).all():
+                raise Exception('Tábua {} {} com idades não contínuas'.format(table, gender))
+            tables.append({'table': table, 'gender': gender,
+                           'offset': offset, 'length': len(age),
+                           'min_age': int(age[0]), 'max_age': int(age[-1]),
+                           'hash': table_hash(df_['lx'].values, df_['dx'].values)})
+            offset += len(age)
+
+        data = np.memmap(path.with_suffix('.bin'), dtype=dtype, mode='w+', shape=(2, offset))
+        for tb, (key, df_) in zip(tables, df.groupby(['table', 'gender'], sort=False)):
+            df_ = df_.sort_values('age')
+            data[0, tb['offset']:tb['offset'] + tb['length']] = df_['lx'].values
+            data[1, tb['offset']:tb['offset'] + tb['length']] = df_['dx'].values
+        data.flush()
+        del data
+
+        with open(path, 'w') as f:
+            json.dump({'dtype': dtype, 'size': offset, 'tables': tables}, f)
+
+        return cls(path)
+
+    def keys(self):
+        '''
+            List of (table, gender) in the store
+        '''
+        return list(self.index)
+
+    def info(self, table, gender):
+        '''
+            Index entry of a table: offset, length, min_age, max_age and hash
+        '''
+        try:
+            return self.index[(table, gender)]
+        except KeyError:
+            raise Exception('Tábua {} {} não encontrada'.format(table, gender))
+
+    def columns(self, table, gender):
+        '''
+            lx and dx of a table as read-only views of the memory map
+        '''
+        tb = self.info(table, gender)
+        cols = self.data[:, tb['offset']:tb['offset'] + tb['length']]
+        return cols[0], cols[1]
+
+    def table(self, table, gender):
+        '''
+            Life table in the format used by InsuranceHandler (age, lx and dx as float64)
+        '''
+        tb = self.info(table, gender)
+        lx, dx = self.columns(table, gender)
+        return pd.DataFrame({'age': np.arange(tb['min_age'], tb['max_age'] + 1),
+                             'lx': np.asarray(lx, dtype=np.float64),
+                             'dx': np.asarray(dx, dtype=np.float64)})
+
+
+class CommutationCache():
+    '''
+        Bounded LRU cache of commutations by (content hash of the table, rate).
+        Each entry is a single (4, n) array with Dx, Nx, Cx and Mx.
+    '''
+    def __init__(self, max_entries=256, dtype='float64'):
+        self.max_entries = max_entries
+        self.dtype = dtype
+        self.entries = OrderedDict()
+        #the cache is shared by the request threads and the background jobs
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+            Returns (Dx, Nx, Cx, Mx) or None when the key is not cached
+        '''
+        with self.lock:
+            values = self.entries.get(key)
+            if values is None:
+                return None
+            self.entries.move_to_end(key)
+        return values[0], values[1], values[2], values[3]
+
+    def set(self, key, Dx, Nx, Cx, Mx):
+        values = np.stack([Dx, Nx, Cx, Mx]).astype(self.dtype)
+        with self.lock:
+            self.entries[key] = values
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, hashes):
+        '''
+            Drops the entries of the tables with the content hashes given
+        '''
+        with self.lock:
+            for key in [key for key in self.entries if key[0] in hashes]:
+                del self.entries[key]
+
+    def nbytes(self):
+        return sum(values.nbytes for values in self.entries.values())
+
+
+def measure_errors(df, store, rates=(0.02, 0.06, 0.10), ages=range(0, 81, 5)):
+    '''
+        Measures the relative error of premiums calculated from a store against the float64
+        dataframe, for all tables in the store.
+        Output:
+            dict with the max relative error of pup and pna
+    '''
+    from calc import InsuranceHandler
+    from controls import PRODUCTS
+
+    exact = InsuranceHandler(df)
+    compact = InsuranceHandler(None, store=store)
+    errors = {'pup': 0., 'pna': 0.}
+    for table, gender in store.keys():
+        exact.select_table(table, gender)
+        compact.select_table(table, gender)
+        for rate in rates:
+            exact.gen_commutations(rate)
+            compact.gen_commutations(rate)
+            for age in ages:
+                for prod in PRODUCTS:
+                    try:
+                        exact.calc_premium(age, 0, 10, True, prod, 0, 10, True)
+                    except Exception:
+                        continue
+                    compact.calc_premium(age, 0, 10, True, prod, 0, 10, True)
+                    for name in errors:
+                        value = getattr(exact, name)
+                        if value:
+                            error = abs(getattr(compact, name) - value)/abs(value)
+                            errors[name] = max(errors[name], error)
+    return errors
+
+
+if __name__ == "__main__":
+    df = pd.read_excel(DATA_PATH.joinpath("life_tables.xlsx"))
+    store = TableStore.build(df, DATA_PATH.joinpath("life_tables.store.json"))
+    print(store.size, 'rows,', store.data.nbytes, 'bytes')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        print(measure_errors(df, store))
@@ -0,0 +1,139 @@
+'''
+    Precomputed surfaces of the main premium plot.
+
+    The main plot surface (MAIN_PLOT_AGES x MAIN_PLOT_RATES) depends only on the life table and
+    the contract parameters, so the surfaces of the most common contracts are precomputed by
+
+        python tiles.py
+
+    and stored in a single memory-mapped float32 file (data/tiles.bin) with a json index
+    (data/tiles.json). The app serves the stored surfaces and only calculates them on a miss.
+    Surfaces are stored per unit of benefit, float32 keeps about 7 significant digits, more
+    than the plot shows. Keys include the content hash of the table, so a changed table is a
+    miss instead of a stale surface.
+'''
+import json
+import pathlib
+import numpy as np
+import pandas as pd
+from calc import InsuranceHandler
+from calc import calc_main_surface
+from calc import MAIN_PLOT_AGES, MAIN_PLOT_RATES
+
+PATH = pathlib.Path(__file__).parent
+DATA_PATH = PATH.joinpath("data").resolve()
+TILES_PATH = DATA_PATH.joinpath("tiles.json")
+
+#contracts precomputed for every table and gender:
+#(product, dif_benef, term_benef, antecip_benef, dif_pay, term_pay, antecip_pay)
+COMMON_CONTRACTS = [
+    ('D', 0, 10, True, 0, 10, True),
+    ('D', 0, 15, True, 0, 15, True),
+    ('D', 0, 20, True, 0, 20, True),
+    ('D', 0, 30, True, 0, 30, True),
+    ('d', 0, 10, True, 0, 10, True),
+    ('d', 0, 20, True, 0, 20, True),
+    ('A', 0, np.inf, True, 0, np.inf, True),
+    ('A', 0, np.inf, True, 0, 20, True),
+    ('A', 0, 10, True, 0, 10, True),
+    ('A', 0, 20, True, 0, 20, True),
+    ('a', 0, np.inf, True, 0, 1, True),
+    ('a', 0, np.inf, False, 0, 1, True),
+    ('a', 10, np.inf, True, 0, 10, True),
+    ('a', 20, np.inf, True, 0, 20, True),
+    ('a', 0, 1, True, 0, 1, True),
+]
+
+
+def tile_key(tb_hash, dif_benef, term_benef, product, antecip_benef,
+             dif_pay, term_pay, antecip_pay):
+    '''
+        Key of a surface. Periods are normalized, so 10 and 10.0 are the same key.
+    '''
+    period = lambda v: 'inf' if v == np.inf else str(int(v))
+    return '|'.join([tb_hash, product,
+                     period(dif_benef), period(term_benef), str(bool(antecip_benef)),
+                     period(dif_pay), period(term_pay), str(bool(antecip_pay))])
+
+
+def handler_hash(handler):
+    '''
+        Content hash of the life table selected in a handler
+    '''
+    return handler.table_hash
+
+
+class SurfaceTiles():
+    '''
+        Read-only index of precomputed surfaces
+    '''
+    def __init__(self, path=TILES_PATH):
+        self.path = pathlib.Path(path)
+        with open(self.path) as f:
+            self.index = json.load(f)
+        self.data = np.memmap(self.path.with_suffix('.bin'), dtype='float32', mode='r',
+                              shape=(len(self.index), len(MAIN_PLOT_AGES),
+                                     len(MAIN_PLOT_RATES)))
+
+    def lookup(self, handler, dif_benef, term_benef, product, antecip_benef,
+               dif_pay=0, term_pay=np.inf, antecip_pay=True):
+        '''
+            Returns the stored surface (ages x rates, float64) or None on a miss
+        '''
+        key = tile_key(handler_hash(handler), dif_benef, term_benef, product, antecip_benef,
+                       dif_pay, term_pay, antecip_pay)
+        row = self.index.get(key)
+        if row is None:
+            return None
+        return np.array(self.data[row], dtype=np.float64)
+
+
+def precompute(handler, tables, contracts=COMMON_CONTRACTS, path=TILES_PATH):
+    '''
+        Calculates and stores the surfaces of the contracts for all tables
+        Input:
+            handler: InsuranceHandler
+            tables: list of (table, gender)
+            contracts: list of (product, dif_benef, term_benef, antecip_benef,
+                       dif_pay, term_pay, antecip_pay)
+            path: path of the index (.json) --> str or pathlib.Path
+        Output:
+            SurfaceTiles with the stored surfaces
+    '''
+    path = pathlib.Path(path)
+    index = {}
+    surfaces = []
+    for table, gender in tables:
+        handler.select_table(table, gender)
+        tb_hash = handler_hash(handler)
+        for product, dif_benef, term_benef, antecip_benef, \
+                dif_pay, term_pay, antecip_pay in contracts:
+            key = tile_key(tb_hash, dif_benef, term_benef, product, antecip_benef,
+                           dif_pay, term_pay, antecip_pay)
+            if key in index:
+                continue
+            index[key] = len(surfaces)
+            surfaces.append(calc_main_surface(handler, dif_benef, term_benef, product,
+                                              antecip_benef, dif_pay, term_pay, antecip_pay))
+
+    if not surfaces:
+        raise Exception('Nenhuma superfície calculada')
+
+    data = np.memmap(path.with_suffix('.bin'), dtype='float32', mode='w+',
+                     shape=(len(surfaces), len(MAIN_PLOT_AGES), len(MAIN_PLOT_RATES)))
+    data[:] = np.stack(surfaces)
+    data.flush()
+    del data
+
+    with open(path, 'w') as f:
+        json.dump(index, f)
+
+    return SurfaceTiles(path)
+
+
+if __name__ == "__main__":
+    df = pd.read_excel(DATA_PATH.joinpath("life_tables.xlsx"))
+    tables = list(df[['table', 'gender']].drop_duplicates().itertuples(index=False, name=None))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tiles = precompute(InsuranceHandler(df), tables)
+    print(len(tiles.index), 'surfaces stored in', tiles.path)
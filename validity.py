@@ -0,0 +1,108 @@
+'''
+    Closed form validity ranges of the contracts.
+
+    __verify_prod__ and the indexes of __calc_pup__ accept a benefit of age x, deferral n and
+    term m when x + offset <= max_age, with the offset (years of the table used after x):
+
+        annuity            n + m + s    (whole life: n + s), s = 0 for annuity due, else 1
+        pure endowment     m            (only n = 0, no whole life)
+        life insurance     n + m        (whole life: n)
+        endowment          n + m        (no whole life)
+
+    so the issue ages accepted by calc_premium are 0 to max_age - max(offsets of the benefit and
+    of the payments). The reserves of an accepted contract are defined from t = 0 to
+    max_age - x - offset, with the duration offsets:
+
+        prospective        s of the payments, or s of a whole life annuity when it is larger
+        retrospective      1 for whole life payments or a whole life annuity with s = 1, else 0
+
+    (after the payments end the engine values an annuity of term 0 at x + t, and retrospective
+    reserves discount from x + t). validity_ranges gives these limits for a batch of contract
+    shapes without pricing them, for a table max age: the app uses them for the limits of the
+    controls and to size the sweeps of the plots, which need no exception probing.
+'''
+import numpy as np
+from batch import contract_columns, PRODUCT_CODES
+from results import allocate
+
+#last valid issue age and duration offsets of each contract shape, -1 when no age is valid
+RANGE_DTYPE = np.dtype([('age_max', np.int64), ('prosp_offset', np.int64),
+                        ('retro_offset', np.int64)])
+
+
+def pup_offset(n, m, whole, antecip, prod):
+    '''
+        Years of the table used after the age by a benefit of __calc_pup__ (see the module
+        docstring), -1 for the combinations __verify_prod__ rejects
+        Input:
+            n, m: deferral and term (any value for whole life) --> np.array of int
+            whole: whole life flags --> np.array of bool
+            antecip, prod: np.array
+        Output:
+            np.array of int
+    '''
+    is_a = prod == 'a'
+    m = np.where(whole, 0, m)
+    step = np.where(is_a & ~antecip, 1, 0)
+    offset = np.where(prod == 'd', m, n + m + step)
+    rejected = ((prod == 'd') & (n > 0)) | (((prod == 'd') | (prod == 'D')) & whole)
+    rejected |= ~np.isin(prod, PRODUCT_CODES) | (n < 0) | (m < 0)
+    return np.where(rejected, -1, offset)
+
+
+def validity_ranges(max_age, contracts):
+    '''
+        Validity ranges of contract shapes on a table
+        Input:
+            max_age: max age of the table --> int
+            contracts: contract columns (see batch.contract_columns), the ages are not used
+        Output:
+            np.array of RANGE_DTYPE, valid ages 0 to age_max and, for the age x, valid
+            durations 0 to max_age - x - offset (see duration_limits)
+    '''
+    c = contract_columns(contracts)
+    prod = c['prod']
+    whole_benef = np.isinf(c['term_benef'])
+    whole_pay = np.isinf(c['term_pay'])
+    benefit = pup_offset(c['dif_benef'].astype(np.int64),
+                         np.where(whole_benef, 0, c['term_benef']).astype(np.int64),
+                         whole_benef, c['antecip_benef'], prod)
+    payment = pup_offset(c['dif_pay'].astype(np.int64),
+                         np.where(whole_pay, 0, c['term_pay']).astype(np.int64),
+                         whole_pay, c['antecip_pay'], 'a')
+    rejected = (benefit < 0) | (payment < 0)
+
+    step_pay = np.where(c['antecip_pay'], 0, 1)
+    step_annuity = np.where((prod == 'a') & ~c['antecip_benef'] & whole_benef, 1, 0)
+    ranges = allocate(RANGE_DTYPE, len(prod))
+    age_max = np.maximum(max_age - np.maximum(benefit, payment), -1)
+    ranges['age_max'] = np.where(rejected, -1, age_max)
+    ranges['prosp_offset'] = np.maximum(step_pay, step_annuity)
+    ranges['retro_offset'] = np.maximum(step_pay*whole_pay, step_annuity)
+    return ranges
+
+
+def age_limits(max_age, contracts):
+    '''
+        Last issue age accepted by calc_premium for each contract shape, -1 when there is none
+    '''
+    return validity_ranges(max_age, contracts)['age_max']
+
+
+def duration_limits(max_age, contracts, kind='prosp'):
+    '''
+        Last duration with a reserve for each contract, -1 when the contract is not valid
+        Input:
+            max_age: max age of the table --> int
+            contracts: contract columns (see batch.contract_columns)
+            kind: prosp or retrosp --> str
+        Output:
+            np.array of int
+    '''
+    if kind not in ['prosp', 'retrosp']:
+        raise Exception('kind must be one of {}'.format(['prosp', 'retrosp']))
+    ranges = validity_ranges(max_age, contracts)
+    age = contract_columns(contracts)['age'].astype(np.int64)
+    offset = ranges['prosp_offset' if kind == 'prosp' else 'retro_offset']
+    valid = (age >= 0) & (age <= ranges['age_max'])
+    return np.where(valid, max_age - age - offset, -1)
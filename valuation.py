@@ -0,0 +1,146 @@
+'''
+    Policy-year valuation at fractional durations.
+
+    The duration of each policy at the valuation date is split into completed policy years t
+    (anniversaries of the issue date) and the elapsed fraction s of the current policy year.
+    Reserves between the integer durations of the engine are interpolated:
+        linear            V(t + s) = (1 - s)*V(t) + s*V(t + 1)
+        unearned          V(t + s) = (1 - s)*(V(t) + P) + s*V(t + 1)
+    V(t) is the prospective reserve before the premium due at t, so the unearned premium
+    method adds the premium P paid at the anniversary (antecipated payments in the payment
+    term), of which the fraction 1 - s is not earned yet.
+
+    Reserve curves are calculated once per contract shape (issue age and contract columns) for
+    each (table, gender, rate), at unit benefit, and shared by all policies with that shape.
+'''
+import numpy as np
+import pandas as pd
+from batch import commutations, contract_columns, unique_contracts, calc_premium_batch
+from batch import contract_errors
+from kernels import reserve_curves
+from results import allocate, to_frame
+
+METHODS = ['linear', 'unearned']
+RESULT_DTYPE = np.dtype([('t', np.float64), ('pna', np.float64), ('reserve', np.float64),
+                         ('valid', bool)])
+
+
+def anniversaries(issue_dates, years):
+    '''
+        Anniversaries of issue dates, policies issued on February 29 have the anniversary on
+        February 28 of non-leap years
+        Input:
+            issue_dates: pandas series of datetimes
+            years: number of years after the issue --> np.array of int
+        Output:
+            pandas series of datetimes
+    '''
+    issue_dates = pd.Series(pd.to_datetime(issue_dates)).reset_index(drop=True)
+    year = issue_dates.dt.year.values + years
+    month = issue_dates.dt.month.values
+    first = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': 1}))
+    day = np.minimum(issue_dates.dt.day.values, first.dt.days_in_month.values)
+    return pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': day}))
+
+
+def policy_durations(issue_dates, valuation_date):
+    '''
+        Durations of policies at a valuation date
+        Input:
+            issue_dates: issue date of each policy --> pandas series or array of dates
+            valuation_date: valuation date --> str or datetime
+        Output:
+            (t, s): completed policy years (np.array of int, -1 for policies issued after the
+                    valuation date or without a valid issue date) and fraction of the current
+                    policy year (np.array of float, nan without a valid issue date)
+    '''
+    issue = pd.Series(pd.to_datetime(issue_dates, errors='coerce')).reset_index(drop=True)
+    valuation = pd.Timestamp(valuation_date)
+    t = valuation.year - issue.dt.year.values
+    #one year less when the anniversary of the valuation year is not reached
+    t = t - (anniversaries(issue, t) > valuation).values.astype(np.int64)
+    start = anniversaries(issue, t)
+    end = anniversaries(issue, t + 1)
+    s = ((valuation - start).dt.days/(end - start).dt.days).values
+    #missing issue dates give nan durations
+    missing = issue.isna().values
+    return np.where(missing, -1, t).astype(np.int64), np.where(missing, np.nan, s)
+
+
+def premium_due(c, t):
+    '''
+        Indicates the policies with an antecipated premium due at the integer duration t
+    '''
+    return c['antecip_pay'] & (c['dif_pay'] <= t) & (t < c['dif_pay'] + c['term_pay'])
+
+
+def interpolate_reserves(V0, V1, s, premium=0.):
+    '''
+        Reserves at t + s from the reserves at t and t + 1 (see the module docstring)
+        Input:
+            V0, V1: reserves at t and t + 1 --> np.array
+            s: fraction of the policy year --> np.array
+            premium: premium paid at t, 0 for the linear method --> np.array
+    '''
+    return (1 - s)*(V0 + premium) + s*V1
+
+
+def value_at_date(handler, policies, valuation_date, method='linear'):
+    '''
+        Reserves of policies at a valuation date
+        Input:
+            handler: InsuranceHandler, used to select tables and generate the commutations
+            policies: normalized policies (see portfolio.normalize_policies) with the column
+                      issue_date --> pandas dataframe
+            valuation_date: valuation date --> str or datetime
+            method: linear or unearned --> str
+        Output:
+            pandas dataframe with the columns t (fractional duration), pna and reserve (for the
+            policy value) and valid, same index of policies
+    '''
+    if method not in METHODS:
+        raise Exception('method must be one of {}'.format(METHODS))
+
+    t, s = policy_durations(policies['issue_date'], valuation_date)
+    index = policies.index
+    policies = policies.assign(t_=t, s_=s, position=np.arange(len(policies)))
+    result = allocate(RESULT_DTYPE, len(policies))
+    result['t'] = np.where(t >= 0, t + s, np.nan)
+    #policies without age, value or issue date, with invalid contract columns (typed_contracts)
+    #and issued after the valuation date are invalid
+    policies = policies.dropna(subset=['age', 'value'])
+    invalid = policies['t_'].values < 0
+    for rows in contract_errors(policies).values():
+        invalid |= rows
+    policies = policies[~invalid]
+
+    for (table, gender, rate), group in policies.groupby(['table', 'gender', 'rate']):
+        try:
+            handler.select_table(table, gender)
+        except Exception:
+            continue
+        if handler.df_.empty:
+            continue
+        handler.gen_commutations(rate)
+        comm = commutations(handler)
+
+        c = contract_columns(group)
+        unit, inverse = unique_contracts(c)
+        premium = calc_premium_batch(comm, unit)
+        durations = np.arange(group['t_'].max() + 2)
+        curves, valid = reserve_curves(comm, unit, premium['pna'], durations)
+
+        t_ = group['t_'].values.astype(np.int64)
+        V0 = curves[inverse, t_]
+        V1 = curves[inverse, t_ + 1]
+        pna = premium['pna'][inverse]
+        paid = np.where(premium_due(c, t_), pna, 0.) if method == 'unearned' else 0.
+        reserve = interpolate_reserves(V0, V1, group['s_'].values, paid)
+
+        value = group['value'].values
+        rows = group['position'].values
+        ok = premium['valid'][inverse] & valid[inverse, t_] & valid[inverse, t_ + 1]
+        result['pna'][rows] = pna*value
+        result['reserve'][rows] = np.where(ok, reserve*value, np.nan)
+        result['valid'][rows] = ok
+    return to_frame(result, index)
@@ -0,0 +1,572 @@
+'''
+    Verification mode for the insurance engine.
+
+    Premiums and reserves are recomputed with exact rational arithmetic (fractions.Fraction)
+    and compared with the float64 paths of the engine and with the reference commutations
+    stored in data/test_calcs.xlsx. Exact results are cached on disk, so after the first run
+    the check is cheap enough to be used as a regression gate:
+
+        python verify.py
+        python verify.py --rtol 1e-9 --atol 1e-12
+'''
+import sys
+import json
+import hashlib
+import pathlib
+import argparse
+import tempfile
+from decimal import Decimal, localcontext
+from fractions import Fraction
+import numpy as np
+import pandas as pd
+from calc import InsuranceHandler, FIGURE_DIGITS
+from calc import generate_main_plot, generate_reserves_plot
+from batch import commutations, calc_premium_batch, calc_reserves_batch, PREMIUM_DTYPE
+from batch import calc_reserve_curves_batch
+from recursion import recursive_reserves_batch
+from portfolio import normalize_policies
+from valuation import value_at_date
+from results import to_frame, to_arrow, from_arrow, write_parquet, pyarrow
+
+PATH = pathlib.Path(__file__).parent
+DATA_PATH = PATH.joinpath("data").resolve()
+CACHE_PATH = PATH.joinpath(".verify_cache").resolve()
+
+#bump it when the exact formulas change, so old cached values are discarded
+CACHE_VERSION = 1
+
+#default tolerances: engine x exact and spreadsheet x engine
+DEF_RTOL = 1e-10
+DEF_ATOL = 1e-12
+DEF_SHEET_RTOL = 1e-9
+
+#the forward recursion divides by p every year, so the rounding of its retrospective reserves
+#grows with the duration: (path, kind) checked with a larger relative tolerance
+PATH_RTOL = {('recursive', 'retrosp'): 1e-8}
+
+#reserves at durations with pure endowment tEx below it are not checked: retrospective reserves
+#are divided by tEx, so float64 rounding is amplified by 1/tEx (ill conditioned by construction)
+MIN_PURE_ENDOWMENT = 1e-4
+
+#contracts checked by default, all combinations with TABLES, RATES and AGES
+CONTRACTS = [
+    dict(prod='a', dif_benef=0, term_benef=np.inf, antecip_benef=True,
+         dif_pay=0, term_pay=1, antecip_pay=True),
+    dict(prod='a', dif_benef=2, term_benef=15, antecip_benef=True,
+         dif_pay=0, term_pay=2, antecip_pay=True),
+    dict(prod='a', dif_benef=10, term_benef=np.inf, antecip_benef=False,
+         dif_pay=0, term_pay=10, antecip_pay=True),
+    dict(prod='A', dif_benef=0, term_benef=np.inf, antecip_benef=True,
+         dif_pay=0, term_pay=np.inf, antecip_pay=True),
+    dict(prod='A', dif_benef=2, term_benef=20, antecip_benef=True,
+         dif_pay=0, term_pay=10, antecip_pay=True),
+    dict(prod='d', dif_benef=0, term_benef=20, antecip_benef=True,
+         dif_pay=0, term_pay=20, antecip_pay=True),
+    dict(prod='D', dif_benef=0, term_benef=10, antecip_benef=True,
+         dif_pay=0, term_pay=10, antecip_pay=True),
+    dict(prod='D', dif_benef=5, term_benef=15, antecip_benef=True,
+         dif_pay=1, term_pay=5, antecip_pay=False),
+]
+
+TABLES = [(' AT2000', 'M'), ('BR-EMSsb-v.2015', 'F'), ('IBGE 2009', 'M')]
+RATES = [0.0416, 0.08]
+AGES = [0, 35, 60]
+
+
+class ExactInsuranceHandler(InsuranceHandler):
+    '''
+        InsuranceHandler using exact rational arithmetic.
+        The life table values and the interest rate are converted to fractions without rounding,
+        so the only difference to the float64 engine is the rounding of the float operations.
+        Paid-up and extended values are not calculated.
+    '''
+    def __init__(self, df):
+        super().__init__(df)
+        #life table columns as fractions
+        self.lx_ = None
+        self.dx_ = None
+        #rate used on the last reserves commutations
+        self.reserves_rate = None
+
+    def __pv_calc__(self, n, i=0):
+        rate = Fraction(i) if i > 0 else self.last_i_rate_used
+        return np.array([1/(1 + rate)**int(k) for k in n], dtype=object)
+
+    def __calc_Dx__(self, i=0):
+        return self.lx_*self.__pv_calc__(self.df_['age'].values, i)
+
+    def __calc_Cx__(self, i=0):
+        return self.dx_*self.__pv_calc__(self.df_['age'].values + 1, i)
+
+    def __calc_paidup__(self, A, V, i, k, t, n, m, prod, benef_antecip):
+        self.paidup = None
+        self.extended = None
+
+    def select_table(self, table, gender):
+        super().select_table(table, gender)
+        self.lx_ = np.array([Fraction(v) for v in self.df_['lx'].values], dtype=object)
+        self.dx_ = np.array([Fraction(v) for v in self.df_['dx'].values], dtype=object)
+        self.reserves_rate = None
+
+    def gen_commutations(self, i_rate):
+        super().gen_commutations(Fraction(i_rate))
+        self.reserves_rate = None
+
+    def calc_reserves(self, t, kind="prosp", rate=0):
+        #same as InsuranceHandler.calc_reserves, but the exact commutations are only
+        #recalculated when the rate changes
+        rate_ = Fraction(rate) if rate > 0 else self.last_i_rate_used
+        if rate_ != self.reserves_rate:
+            self.Dx__ = self.__calc_Dx__(rate_)
+            self.Nx__ = self.__calc_Nx__('reserves')
+            self.Cx__ = self.__calc_Cx__(rate_)
+            self.Mx__ = self.__calc_Mx__('reserves')
+            self.reserves_rate = rate_
+
+        if kind == 'prosp':
+            result = self.__calc_prov_prosp__(t)
+            self.last_prosp_reserve = result
+        elif kind == 'retrosp':
+            result = self.__calc_prov_retro__(t)
+            self.last_retro_reserve = result
+
+        return result
+
+
+def to_decimal_str(value, digits=40):
+    '''
+        Converts an exact value to a string with "digits" significant digits
+    '''
+    value = Fraction(value)
+    with localcontext() as ctx:
+        ctx.prec = digits
+        return str(Decimal(value.numerator)/Decimal(value.denominator))
+
+
+def reserve_durations(contract, age, lx, rate):
+    '''
+        Durations checked on the reserves of a contract
+        Input:
+            contract: dict with the calc_premium parameters
+            age: age --> int
+            lx: lx column of the life table --> np.array
+            rate: interest rate --> float
+    '''
+    horizon = max(contract['dif_benef'] + contract['term_benef'],
+                  contract['dif_pay'] + contract['term_pay'])
+    last = min(horizon + 1, len(lx) - age - 1)
+    return [t for t in range(0, int(last) + 1)
+            if float(lx[age + t])/(1 + float(rate))**t >= MIN_PURE_ENDOWMENT*float(lx[age])]
+
+
+def price_contract(handler, contract, age, rate):
+    '''
+        Prices a contract with a handler, already filtered and with commutations generated.
+        Input:
+            handler: InsuranceHandler or ExactInsuranceHandler
+            contract: dict with the calc_premium parameters, except age
+            age: age --> int
+            rate: interest rate --> float
+        Output:
+            dict with pup, pna and the prospective and retrospective reserves by t. None
+            indicates a value that could not be calculated.
+    '''
+    result = {'pup': None, 'pna': None, 'prosp': {}, 'retrosp': {}}
+    try:
+        handler.calc_premium(age=age, **contract)
+    except Exception:
+        return result
+
+    result['pup'] = handler.pup
+    result['pna'] = handler.pna
+    for t in reserve_durations(contract, age, handler.df_['lx'].values, rate):
+        for kind in ['prosp', 'retrosp']:
+            try:
+                result[kind][t] = handler.calc_reserves(t, kind, rate)
+            except Exception:
+                result[kind][t] = None
+    return result
+
+
+def scalar_path(df, table, gender, rate, contract, age):
+    '''
+        float64 results of the scalar InsuranceHandler
+    '''
+    handler = InsuranceHandler(df)
+    handler.select_table(table, gender)
+    handler.gen_commutations(rate)
+    #the end of the tables (lx = 0) gives nan and inf, compared as "not calculated"
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return price_contract(handler, contract, age, rate)
+
+
+def batch_path(df, table, gender, rate, contract, age):
+    '''
+        float64 results of the vectorized engine (batch.py), all durations in one call.
+        Only prospective reserves are calculated by it.
+    '''
+    handler = InsuranceHandler(df)
+    handler.select_table(table, gender)
+    handler.gen_commutations(rate)
+    comm = commutations(handler)
+    result = {'pup': None, 'pna': None, 'prosp': {}}
+
+    premium = calc_premium_batch(comm, dict(contract, age=[age]))
+    if not premium['valid'][0]:
+        return result
+    result['pup'] = premium['pup'][0]
+    result['pna'] = premium['pna'][0]
+
+    t = np.array(reserve_durations(contract, age, handler.df_['lx'].values, rate))
+    contracts = {name: np.repeat(value, len(t)) for name, value in contract.items()}
+    contracts['age'] = np.repeat(age, len(t))
+    reserves, valid = calc_reserves_batch(comm, contracts, premium['pna'][0], t)
+    for t_, value, valid_ in zip(t, reserves, valid):
+        result['prosp'][int(t_)] = value if valid_ else None
+    return result
+
+
+def recursive_path(df, table, gender, rate, contract, age):
+    '''
+        float64 results of the recursive reserves (recursion.py) with the flat rate and the
+        table decrements, the premiums of the vectorized engine. The recursion also gives the
+        reserves at the last age of the table, left out where the engine does not calculate them.
+    '''
+    handler = InsuranceHandler(df)
+    handler.select_table(table, gender)
+    handler.gen_commutations(rate)
+    comm = commutations(handler)
+    result = {'pup': None, 'pna': None, 'prosp': {}, 'retrosp': {}}
+
+    contracts = dict(contract, age=[age])
+    premium = calc_premium_batch(comm, contracts)
+    if not premium['valid'][0]:
+        return result
+    result['pup'] = premium['pup'][0]
+    result['pna'] = premium['pna'][0]
+
+    t = reserve_durations(contract, age, handler.df_['lx'].values, rate)
+    for kind in ['prosp', 'retrosp']:
+        reserves, valid = recursive_reserves_batch(handler, contracts, premium['pna'],
+                                                   kind=kind)
+        engine, calculated = calc_reserve_curves_batch(comm, contracts, premium['pna'], t, kind)
+        calculated &= np.isfinite(engine)
+        for j, t_ in enumerate(t):
+            result[kind][t_] = reserves[0, t_] if valid[0, t_] and calculated[0, j] else None
+    return result
+
+
+#fast paths compared with the exact results: name -> function(df, table, gender, rate, contract, age)
+#a path may leave out the reserves kinds it does not calculate
+PATHS = {'scalar': scalar_path, 'batch': batch_path, 'recursive': recursive_path}
+
+
+def table_hash(df, table, gender):
+    '''
+        Content hash of a life table, used to invalidate the cache when the table changes
+    '''
+    df_ = df.query('table == "{}" and gender == "{}"'.format(table, gender))
+    values = df_[['age', 'lx', 'dx']].values.astype(np.float64)
+    return hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+
+def contract_key(tb_hash, rate, contract, age):
+    key = json.dumps([CACHE_VERSION, tb_hash, repr(float(rate)), age,
+                      sorted((k, str(v)) for k, v in contract.items())])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class ExactCache():
+    '''
+        Disk cache for the exact results, stored as decimal strings in a json file
+    '''
+    def __init__(self, path=CACHE_PATH):
+        self.path = pathlib.Path(path)
+        self.file = self.path.joinpath('exact.json')
+        self.values = {}
+        self.changed = False
+        if self.file.exists():
+            with open(self.file) as f:
+                self.values = json.load(f)
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+        self.changed = True
+
+    def save(self):
+        if self.changed:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.file, 'w') as f:
+                json.dump(self.values, f)
+            self.changed = False
+
+
+def exact_results(df, table, gender, rate, contract, age, cache, handlers):
+    '''
+        Exact results of a contract, read from the cache when available.
+        Values are returned as floats of the exact results (the nearest float64).
+    '''
+    tb_hash = handlers.setdefault(('hash', table, gender), table_hash(df, table, gender))
+    key = contract_key(tb_hash, rate, contract, age)
+    stored = cache.get(key)
+
+    if stored is None:
+        handler = handlers.get((table, gender, rate))
+        if handler is None:
+            handler = ExactInsuranceHandler(df)
+            handler.select_table(table, gender)
+            handler.gen_commutations(rate)
+            handlers[(table, gender, rate)] = handler
+        result = price_contract(handler, contract, age, rate)
+        stored = {'pup': None if result['pup'] is None else to_decimal_str(result['pup']),
+                  'pna': None if result['pna'] is None else to_decimal_str(result['pna'])}
+        for kind in ['prosp', 'retrosp']:
+            stored[kind] = {str(t): None if v is None else to_decimal_str(v)
+                            for t, v in result[kind].items()}
+        cache.set(key, stored)
+
+    to_float = lambda v: None if v is None else float(Decimal(v))
+    return {'pup': to_float(stored['pup']),
+            'pna': to_float(stored['pna']),
+            'prosp': {int(t): to_float(v) for t, v in stored['prosp'].items()},
+            'retrosp': {int(t): to_float(v) for t, v in stored['retrosp'].items()}}
+
+
+def compare(name, value, expected, rtol, atol):
+    '''
+        Compares a value with the expected one. Returns an error message or None
+    '''
+    #values that could not be calculated (exceptions or non finite floats) must match
+    value = None if value is None or not np.isfinite(float(value)) else value
+    expected = None if expected is None or not np.isfinite(float(expected)) else expected
+    if value is None and expected is None:
+        return None
+    if value is None or expected is None:
+        return '{}: {} != {}'.format(name, value, expected)
+    if abs(value - expected) > atol + rtol*abs(expected):
+        return '{}: {:.17g} != {:.17g} (diff {:.3g})'.format(name, value, expected,
+                                                              abs(value - expected))
+    return None
+
+
+def verify_engine(df, paths=None, tables=TABLES, rates=RATES, ages=AGES,
+                  contracts=CONTRACTS, rtol=DEF_RTOL, atol=DEF_ATOL, cache_path=CACHE_PATH):
+    '''
+        Compares the fast paths with the exact results
+        Input:
+            df: life tables --> pandas dataframe
+            paths: fast paths to verify, default all in PATHS --> list of str
+            tables, rates, ages, contracts: cases to verify
+            rtol, atol: relative and absolute tolerances --> float
+            cache_path: directory of the exact results cache
+        Output:
+            (number of values compared, list of error messages)
+    '''
+    paths = list(PATHS) if paths is None else paths
+    cache = ExactCache(cache_path)
+    handlers = {}
+    checked = 0
+    errors = []
+    try:
+        for table, gender in tables:
+            for rate in rates:
+                for age in ages:
+                    for c, contract in enumerate(contracts):
+                        expected = exact_results(df, table, gender, rate, contract, age,
+                                                 cache, handlers)
+                        for path in paths:
+                            result = PATHS[path](df, table, gender, rate, contract, age)
+                            case = '{} {}/{} i={} x={} contract {}'.format(path, table.strip(),
+                                                                          gender, rate, age, c)
+                            for name in ['pup', 'pna']:
+                                checked += 1
+                                error = compare(name, result[name], expected[name], rtol, atol)
+                                if error:
+                                    errors.append('{} {}'.format(case, error))
+                            for kind in ['prosp', 'retrosp']:
+                                if kind not in result:
+                                    continue
+                                rtol_ = max(rtol, PATH_RTOL.get((path, kind), 0))
+                                for t, value in expected[kind].items():
+                                    checked += 1
+                                    error = compare('{}[{}]'.format(kind, t),
+                                                    result[kind].get(t), value, rtol_, atol)
+                                    if error:
+                                        errors.append('{} {}'.format(case, error))
+    finally:
+        cache.save()
+
+    return checked, errors
+
+
+def verify_spreadsheet(df, file=DATA_PATH.joinpath("test_calcs.xlsx"), rtol=DEF_SHEET_RTOL):
+    '''
+        Compares the engine commutations with the reference spreadsheet.
+        The spreadsheet has the rate in its first header cell and the columns
+        table, gender, idade, qx, lx, dx, fator, Dx, Nx, Cx and Mx.
+        Output:
+            (number of values compared, list of error messages)
+    '''
+    sheet = pd.read_excel(file)
+    rate = float(sheet.columns[0])
+    sheet = sheet.dropna(subset=['Dx'])
+    table = str(sheet.iloc[0, 0]).strip()
+    gender = str(sheet.iloc[0, 1]).strip()
+
+    #the spreadsheet table names are not padded as in life_tables.xlsx
+    names = [tb for tb in df['table'].unique() if tb.strip() == table]
+    if not names:
+        return 0, ['spreadsheet table {} not found'.format(table)]
+
+    handler = InsuranceHandler(df)
+    handler.select_table(names[0], gender)
+    handler.gen_commutations(rate)
+
+    checked = 0
+    errors = []
+    ages = sheet['idade'].values.astype(int)
+    for name in ['Dx', 'Nx', 'Cx', 'Mx']:
+        values = getattr(handler, name)
+        for age, expected in zip(ages, sheet[name].values.astype(np.float64)):
+            checked += 1
+            error = compare('{}[{}]'.format(name, age), values[age], expected, rtol, 0)
+            if error:
+                errors.append('spreadsheet {}/{} i={} {}'.format(table, gender, rate, error))
+    return checked, errors
+
+
+def verify_figures(df, digits=FIGURE_DIGITS):
+    '''
+        Compares the rounded values of the figures of a unit benefit contract (A at 30, the
+        default of the app) with the full values: rounding must not change what is shown
+        Output:
+            (number of values compared, list of error messages)
+    '''
+    handler = InsuranceHandler(df)
+    handler.select_table(' AT2000', 'M')
+    handler.gen_commutations(0.05)
+    handler.calc_premium(30, 0, np.inf, True, 'A', 0, np.inf, True)
+    figures = {'reserves': lambda digits_: generate_reserves_plot(handler, 1, digits_),
+               'main': lambda digits_: generate_main_plot(handler, 0, np.inf, 'A', True, 1,
+                                                          digits=digits_)}
+    checked = 0
+    errors = []
+    for name, figure in figures.items():
+        rounded, full = figure(digits), figure(None)
+        for trace, trace_ in zip(rounded.data, full.data):
+            values = np.asarray(trace.z if trace.type == 'surface' else trace.y, dtype=np.float64)
+            expected = np.asarray(trace_.z if trace_.type == 'surface' else trace_.y,
+                                  dtype=np.float64)
+            for index, value in np.ndenumerate(values):
+                checked += 1
+                error = compare('{}{}'.format(name, list(index)), value, expected[index],
+                                10.**(1 - digits), 0)
+                if error:
+                    errors.append('figure {}'.format(error))
+    return checked, errors
+
+
+def verify_valuation(df):
+    '''
+        Values policies at a date with missing and invalid issue dates: they must be reported
+        as invalid without changing the values of the other policies
+        Output:
+            (number of values compared, list of error messages)
+    '''
+    policies = normalize_policies(pd.DataFrame({
+        'table': ' AT2000', 'gender': 'F', 'age': [30, 40, 50, 60], 'prod': 'D',
+        'term_benef': 20., 'term_pay': 10., 'value': 1000.,
+        'issue_date': pd.to_datetime(['2015-03-10', None, 'data', '2019-11-30'],
+                                     errors='coerce')}), 0.05)
+    handler = InsuranceHandler(df)
+    result = value_at_date(handler, policies, '2024-06-30')
+    expected = value_at_date(handler, policies.iloc[[0, 3]], '2024-06-30')
+
+    checked = 0
+    errors = []
+    for row in policies.index:
+        checked += 1
+        if row in expected.index:
+            error = compare('reserve[{}]'.format(row), result['reserve'][row],
+                            expected['reserve'][row], DEF_RTOL, DEF_ATOL)
+        elif result['valid'][row]:
+            error = 'reserve[{}]: policy without issue date is valid'.format(row)
+        else:
+            error = None
+        if error:
+            errors.append('valuation {}'.format(error))
+    return checked, errors
+
+
+def verify_results(df):
+    '''
+        Result arrays of the premiums: the dataframe must share the memory of the fields, and
+        the Arrow record batch and the Parquet file must give back the same values (skipped
+        without pyarrow)
+        Output:
+            (number of values compared, list of error messages)
+    '''
+    handler = InsuranceHandler(df)
+    handler.select_table(' AT2000', 'F')
+    handler.gen_commutations(0.05)
+    premium = calc_premium_batch(commutations(handler), {
+        'age': [30, 60, 110], 'prod': 'D', 'term_benef': 20., 'term_pay': 10.})
+
+    checked = 0
+    errors = []
+    frame = to_frame(premium)
+    for name in PREMIUM_DTYPE.names:
+        checked += 1
+        if not np.shares_memory(frame[name].values, premium[name]):
+            errors.append('results {}: dataframe column is a copy'.format(name))
+    if pyarrow is None:
+        print('results: pyarrow not installed, Arrow round trip not checked')
+        return checked, errors
+
+    with tempfile.TemporaryDirectory() as path:
+        path = pathlib.Path(path).joinpath('premium.parquet')
+        write_parquet(premium, path)
+        copies = {'arrow': from_arrow(to_arrow(premium), PREMIUM_DTYPE),
+                  'parquet': from_arrow(pyarrow.parquet.read_table(str(path)), PREMIUM_DTYPE)}
+    for kind, records in copies.items():
+        for name in PREMIUM_DTYPE.names:
+            checked += 1
+            if not np.array_equal(records[name], premium[name],
+                                  equal_nan=premium[name].dtype.kind == 'f'):
+                errors.append('results {} {}: values changed'.format(kind, name))
+    return checked, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Verifies the engine against exact results')
+    parser.add_argument('--rtol', type=float, default=DEF_RTOL)
+    parser.add_argument('--atol', type=float, default=DEF_ATOL)
+    parser.add_argument('--sheet-rtol', type=float, default=DEF_SHEET_RTOL)
+    parser.add_argument('--path', action='append', choices=sorted(PATHS),
+                        help='fast path to verify, default all')
+    parser.add_argument('--cache', default=str(CACHE_PATH))
+    args = parser.parse_args(argv)
+
+    df = pd.read_excel(DATA_PATH.joinpath("life_tables.xlsx"))
+
+    checked, errors = verify_spreadsheet(df, rtol=args.sheet_rtol)
+    checked_, errors_ = verify_engine(df, paths=args.path, rtol=args.rtol,
+                                      atol=args.atol, cache_path=args.cache)
+    checked += checked_
+    errors += errors_
+    for verify in [verify_figures, verify_valuation, verify_results]:
+        checked_, errors_ = verify(df)
+        checked += checked_
+        errors += errors_
+
+    for error in errors:
+        print(error)
+    print('{} values checked, {} errors'.format(checked, len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())